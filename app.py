@@ -3,35 +3,145 @@
 
 import os
 import modal
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse, HTMLResponse, Response
+from fastapi import FastAPI, File, Header, HTTPException, Query, Request, UploadFile
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from fastapi.middleware.cors import CORSMiddleware
 import time
 import uuid
-from typing import Optional
+import json
+import asyncio
+from typing import List, Optional
 import io
-import base64
+import contextlib
+
+from utils.metrics import (
+    ADMISSION_REJECTIONS_TOTAL,
+    COALESCED_REQUESTS_TOTAL,
+    INFLIGHT_COST,
+    QUEUE_DEPTH,
+    REQUEST_SECONDS,
+    REQUESTS_TOTAL,
+    observe_prediction,
+    observe_timings,
+)
+from utils.tracing import format_trace_id, get_tracer, record_remote_spans
+from utils.profiling import find_profile
+from utils.memory import MEMORY_PROFILES
+from utils.admission import AdmissionController, AdmissionRejected, RequestTooExpensive, estimate_cost
+from utils.coalesce import SingleFlight, request_key
+from utils.scheduling import Client, ExceedsBurst, RateLimited, RateLimiter, UnknownApiKey, identify_client, load_api_keys
+from utils.batches import BatchStore
+from utils.compile import COMPILE_ENABLED, COMPILE_MEMORY_PROFILE, snap_to_bucket
+from utils.text_encoding import REMOTE_TEXT_ENCODING
+from utils.concurrency import GPU_CONCURRENT_INPUTS, GpuLane
+from utils.results import GeneratedImage, GenerationResult
+from utils.latency import REQUEST_KINDS, LatencyModel, request_kind
+from utils.step_cache import MAX_CACHE_INTERVAL
+from utils.hires import HIRES_STRENGTH, MAX_HIRES_SCALE, hires_plan
+from utils.tiling import tile_coverage
+from utils.onnx_backend import BACKEND, ONNX_ENABLED, ONNX_PRECISION
+from utils.quantization import QUANTIZATION, QUANTIZATION_ENABLED
+from utils.tensor_store import TENSOR_STORE_ENABLED
+from utils.images import (
+    IMG2IMG_STRENGTH,
+    INPAINT_STRENGTH,
+    InvalidImage,
+    decode_image,
+    denoising_steps,
+    edit_size,
+    max_request_bytes,
+    read_upload,
+)
+from utils.warmpool import SCALEDOWN_WINDOW, WARM_POOL_ENABLED, WARM_POOL_INTERVAL
 
 # Get Hugging Face token from environment variable (will be set during deployment)
 HF_TOKEN = os.environ.get("HF_TOKEN", "")
 
+# Token required for privileged requests such as profiling; admin features are disabled when unset
+ADMIN_TOKEN = os.environ.get("SD_ADMIN_TOKEN", "")
+
 # Create a Modal image with all required dependencies
 image = modal.Image.debian_slim().pip_install(
-    "diffusers>=0.26.3",
+    "diffusers>=0.28.0",
     "transformers>=4.36.2",
     "accelerate>=0.27.2",
-    "torch>=2.2.0",
+    "torch>=2.5.0",
     "pillow>=10.1.0",
     "fastapi>=0.109.0",
+    "python-multipart>=0.0.7",
     "python-dotenv>=1.0.0",
     "safetensors>=0.4.1",
     "huggingface-hub>=0.19.0",
     "sentencepiece>=0.1.99",
+    "prometheus-client>=0.19.0",
+    "opentelemetry-sdk>=1.22.0",
 )
 
-# Add local Python modules to the image
-image = image.add_local_python_source("utils")
-image = image.add_local_python_source("app")
+# ONNX Runtime is only installed in the generation containers' image, and only
+# with the ONNX Runtime backend; CPU-only containers get the smaller CPU build
+onnx_image = image.pip_install(
+    # onnx 1.21+ needs protobuf 6, which the Modal client doesn't support
+    "onnx>=1.15.0,<1.21",
+    "onnxruntime>=1.17.0" if os.environ.get("SD_GPU") == "cpu" else "onnxruntime-gpu>=1.17.0",
+)
+
+# Pass deployment settings from the local environment through to the containers
+DEPLOYMENT_SETTINGS = [
+    "SD_MEMORY_PROFILE",
+    "SD_TRACE_EXPORTER",
+    "SD_TRACE_FILE",
+    "SD_COMPILE",
+    "SD_COMPILE_MODE",
+    "SD_COMPILE_WARMUP_STEPS",
+    "SD_MAX_REQUEST_COST",
+    "SD_MAX_TILED_REQUEST_COST",
+    "SD_MAX_INFLIGHT_COST",
+    "SD_MAX_QUEUE",
+    "SD_MAX_BATCH_QUEUE",
+    "SD_ADMISSION_THROUGHPUT",
+    "SD_CLIENT_RATE",
+    "SD_CLIENT_BURST",
+    "SD_DRR_QUANTUM",
+    "SD_REMOTE_TEXT_ENCODING",
+    "SD_EMBEDDING_CACHE_SIZE",
+    "SD_PIPELINE",
+    "SD_PIPELINE_QUEUE_SIZE",
+    "SD_GPU_CONCURRENT_INPUTS",
+    "SD_WARM_POOL",
+    "SD_WARM_POOL_INTERVAL",
+    "SD_WARM_POOL_MIN",
+    "SD_WARM_POOL_MAX",
+    "SD_WARM_POOL_SERVICE_SECONDS",
+    "SD_WARM_POOL_HORIZON",
+    "SD_WARM_POOL_HEADROOM",
+    "SD_COLD_START_SECONDS",
+    "SD_SCALEDOWN_WINDOW",
+    "SD_LATENCY_PRIOR_STEP_SECONDS",
+    "SD_LATENCY_PRIOR_OVERHEAD_SECONDS",
+    "SD_LATENCY_EXACT_MIN_SAMPLES",
+    "SD_HIRES_STRENGTH",
+    "SD_MAX_UPLOAD_BYTES",
+    "SD_MAX_INPUT_PIXELS",
+    "SD_IMG2IMG_STRENGTH",
+    "SD_TILE_SIZE",
+    "SD_TILE_OVERLAP",
+    "SD_TILE_BATCH_SIZE",
+    "SD_BACKEND",
+    "SD_ONNX_PRECISION",
+    "SD_GPU",
+    "SD_QUANTIZATION",
+    "SD_TENSOR_STORE",
+]
+settings = {name: os.environ[name] for name in DEPLOYMENT_SETTINGS if name in os.environ}
+
+# Add local Python modules to the images
+image = image.env(settings).add_local_python_source("utils").add_local_python_source("app")
+onnx_image = onnx_image.env(settings).add_local_python_source("utils").add_local_python_source("app")
+
+# Image of the generation containers
+model_image = onnx_image if ONNX_ENABLED else image
 
 # Create a Modal app
 app = modal.App("stable-diffusion-app")
@@ -39,10 +149,61 @@ app = modal.App("stable-diffusion-app")
 # Create a volume for storing generated images
 volume = modal.Volume.from_name("stable-diffusion-images", create_if_missing=True)
 VOLUME_PATH = "/images"
+PROFILES_PATH = f"{VOLUME_PATH}/profiles"
+BATCHES_PATH = f"{VOLUME_PATH}/batches"
+WARM_POOL_PATH = f"{VOLUME_PATH}/warm_pool"
 
 # Create a volume for storing models
 model_volume = modal.Volume.from_name("stable-diffusion-models", create_if_missing=True)
 MODEL_VOLUME_PATH = "/models"
+COMPILE_CACHE_PATH = f"{MODEL_VOLUME_PATH}/compile_cache"
+ONNX_CACHE_PATH = f"{MODEL_VOLUME_PATH}/onnx"
+QUANTIZED_CACHE_PATH = f"{MODEL_VOLUME_PATH}/quantized"
+TENSOR_STORE_PATH = f"{MODEL_VOLUME_PATH}/store"
+
+# Request arrival times recorded by the web tier, drained by the warm pool controller
+arrival_queue = modal.Queue.from_name("stable-diffusion-arrivals", create_if_missing=True)
+
+# The warm pool controller's forecaster state and latest decision
+warm_pool_state = modal.Dict.from_name("stable-diffusion-warm-pool", create_if_missing=True)
+
+# GPU containers with a loaded pipeline, keyed by task id
+warm_containers = modal.Dict.from_name("stable-diffusion-warm-containers", create_if_missing=True)
+
+# The latency model fitted by the web containers, so new ones start from it
+latency_state = modal.Dict.from_name("stable-diffusion-latency-model", create_if_missing=True)
+
+# Hugging Face model used when the local checkpoint isn't available
+FALLBACK_MODEL_ID = "stabilityai/stable-diffusion-xl-base-1.0"
+
+# GPU the generation containers run on; "cpu" runs them on CPU-only
+# containers, with the ONNX Runtime backend (SD_BACKEND=onnx) or the torch
+# backend in fp32, best quantised (SD_QUANTIZATION=int8-dynamic)
+GPU_TYPE = os.environ.get("SD_GPU", "A10G")
+
+# Cores and memory (MB) of CPU-only generation containers
+CPU_CONTAINER_CORES = 8.0
+CPU_CONTAINER_MEMORY = 32768
+
+# Number of requests a single web container handles concurrently
+WEB_CONCURRENT_INPUTS = 100
+
+# Largest number of images generated by one /generate request
+MAX_IMAGES_PER_REQUEST = 8
+
+# Largest number of items accepted in one batch
+MAX_BATCH_ITEMS = 10000
+
+# Items of one batch submitted to the GPU containers at once; admission control
+# decides how many of them actually run, and batch items waiting for budget
+# only count against the batch lane's queue (SD_MAX_BATCH_QUEUE)
+BATCH_CONCURRENCY = 64
+
+# Finished batch items between volume commits of the batch results log
+BATCH_COMMIT_INTERVAL = 25
+
+# Finished requests between saves of the latency model
+LATENCY_SAVE_INTERVAL = 20
 
 # Create a FastAPI app
 fastapi_app = FastAPI(title="Stable Diffusion API")
@@ -56,6 +217,36 @@ fastapi_app.add_middleware(
     allow_headers=["*"],
 )
 
+# Files uploaded by the endpoints taking input images, whose request bodies
+# are size-checked before the form is parsed
+UPLOAD_ENDPOINTS = {"/img2img": 1, "/inpaint": 2}
+
+@fastapi_app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    """
+    Reject uploads that are too large before their form is parsed.
+    
+    FastAPI parses and spools the whole multipart body before the endpoint
+    runs, so the declared Content-Length is checked here instead.
+    
+    Args:
+        request: The incoming request
+        call_next: The rest of the application
+    
+    Returns:
+        A 411 or 413 response, or the application's response
+    """
+    files = UPLOAD_ENDPOINTS.get(request.url.path)
+    if files is None or request.method != "POST":
+        return await call_next(request)
+    length = request.headers.get("content-length")
+    if length is None or not length.isdigit():
+        return JSONResponse(status_code=411, content={"detail": "Uploads need a Content-Length header"})
+    limit = max_request_bytes(files)
+    if int(length) > limit:
+        return JSONResponse(status_code=413, content={"detail": f"Request body is larger than {limit} bytes"})
+    return await call_next(request)
+
 # Try to get the Hugging Face token secret
 try:
     hf_secret = modal.Secret.from_name("huggingface-token")
@@ -65,6 +256,14 @@ except Exception as e:
     print("The application will still work, but may not be able to access gated models.")
     hf_secret = None
 
+# Try to get the admin token secret (provides SD_ADMIN_TOKEN for privileged requests)
+try:
+    admin_secret = modal.Secret.from_name("sd-admin-token")
+except Exception as e:
+    print(f"Warning: Could not load admin token secret: {str(e)}")
+    print("Admin features such as request profiling will be disabled.")
+    admin_secret = None
+
 # Create directories
 @app.function(
     image=image, 
@@ -89,23 +288,290 @@ def create_directories():
     
     return "Directories created"
 
+def load_sdxl_pipeline(checkpoint_path, torch_dtype, use_store=TENSOR_STORE_ENABLED, **components):
+    """
+    Load the SDXL pipeline from the local checkpoint, or from Hugging Face if there is none.
+    
+    Args:
+        checkpoint_path: Path of the local checkpoint, or None to use Hugging Face
+        torch_dtype: The dtype to load the weights in
+        use_store: Load the local checkpoint through the tensor store,
+            ingesting it first if it isn't there yet
+        **components: Pipeline components to override; a component passed as
+            None isn't loaded at all
+    
+    Returns:
+        The loaded StableDiffusionXLPipeline, on the CPU. Pipelines loaded
+        through the tensor store carry the load report as _store_report
+    """
+    from diffusers import StableDiffusionXLPipeline
+    import huggingface_hub
+    
+    # Check if we have a Hugging Face token
+    if "HUGGING_FACE_HUB_TOKEN" in os.environ and os.environ["HUGGING_FACE_HUB_TOKEN"]:
+        print("Using Hugging Face token for authentication")
+        huggingface_hub.login(token=os.environ["HUGGING_FACE_HUB_TOKEN"])
+    
+    if checkpoint_path is not None and use_store:
+        from utils.tensor_store import TensorStore
+        
+        store = TensorStore(TENSOR_STORE_PATH)
+        pipe, report = store.load_pipeline(ensure_in_store(store, checkpoint_path), torch_dtype, **components)
+        pipe._store_report = report
+        return pipe
+    
+    if checkpoint_path is not None:
+        print(f"Loading local Illustrious XL checkpoint from {checkpoint_path}")
+        return StableDiffusionXLPipeline.from_single_file(
+            checkpoint_path,
+            torch_dtype=torch_dtype,
+            use_safetensors=True,
+            variant="fp16",
+            **components,
+        )
+    
+    # Initialize the pipeline from Hugging Face
+    print("Loading SDXL from Hugging Face")
+    return StableDiffusionXLPipeline.from_pretrained(
+        FALLBACK_MODEL_ID,
+        torch_dtype=torch_dtype,
+        use_safetensors=True,
+        variant="fp16",
+        **components,
+    )
+
+def ensure_in_store(store, checkpoint_path):
+    """
+    Ingest a local checkpoint into the tensor store, unless it is already there.
+    
+    Models are stored under the checkpoint's file name, and re-ingested when
+    the checkpoint's hash changes.
+    
+    Args:
+        store: The TensorStore
+        checkpoint_path: Path of the local checkpoint
+    
+    Returns:
+        The name of the model in the store
+    """
+    import torch
+    from utils.onnx_backend import model_hash
+    
+    name = os.path.splitext(os.path.basename(checkpoint_path))[0]
+    digest = model_hash(checkpoint_path, FALLBACK_MODEL_ID, TENSOR_STORE_PATH)
+    if store.has_model(name, digest):
+        return name
+    
+    print(f"{name} isn't in the tensor store, ingesting {checkpoint_path}")
+    pipe = load_sdxl_pipeline(checkpoint_path, torch.float16, use_store=False)
+    store.ingest(name, pipe, digest)
+    del pipe
+    model_volume.commit()
+    return name
+
+# Splits every checkpoint on the models volume into the tensor store and
+# reports the deduplication: modal run app.py::ingest_models
+@app.function(
+    image=image,
+    cpu=8.0,
+    memory=32768,
+    timeout=3600,
+    volumes={MODEL_VOLUME_PATH: model_volume},
+    secrets=[hf_secret] if hf_secret is not None else []
+)
+def ingest_models():
+    """
+    Ingest the checkpoints on the models volume into the tensor store.
+    
+    Returns:
+        The store's deduplication report from TensorStore.stats
+    """
+    from utils.tensor_store import TensorStore
+    
+    if "HF_TOKEN" in os.environ and os.environ["HF_TOKEN"]:
+        os.environ["HUGGING_FACE_HUB_TOKEN"] = os.environ["HF_TOKEN"]
+    
+    store = TensorStore(TENSOR_STORE_PATH)
+    for filename in sorted(os.listdir(MODEL_VOLUME_PATH)):
+        if filename.endswith(".safetensors"):
+            ensure_in_store(store, os.path.join(MODEL_VOLUME_PATH, filename))
+    
+    stats = store.stats()
+    for name, model in stats["models"].items():
+        shared = ", ".join(model["shared_components"]) or "nothing"
+        print(f"{name}: {model['bytes'] / 1024 ** 3:.2f} GB, {model['unique_bytes'] / 1024 ** 3:.2f} GB unique, shares {shared}")
+    print(
+        f"Store: {stats['logical_bytes'] / 1024 ** 3:.2f} GB of checkpoints in "
+        f"{stats['stored_bytes'] / 1024 ** 3:.2f} GB of blobs, dedup ratio {stats['dedup_ratio']:.2f}"
+    )
+    return stats
+
+def ensure_onnx_export(checkpoint_path, precision=ONNX_PRECISION):
+    """
+    Export the SDXL components to ONNX, unless this checkpoint is already exported in this precision.
+    
+    Exports are cached on the models volume by the hash of the checkpoint,
+    so a new checkpoint gets a new export and containers never re-export
+    one that is cached.
+    
+    Args:
+        checkpoint_path: Path of the local checkpoint, or None to use Hugging Face
+        precision: "fp32", "fp16" or "int8"
+    
+    Returns:
+        The path of the export directory
+    """
+    import torch
+    from utils.onnx_backend import export_path, export_pipeline, model_hash
+    
+    digest = model_hash(checkpoint_path, FALLBACK_MODEL_ID, ONNX_CACHE_PATH)
+    path = export_path(ONNX_CACHE_PATH, digest, precision)
+    if os.path.exists(path):
+        print(f"Using cached ONNX export at {path}")
+        return path
+    
+    print(f"No ONNX export at {path}, exporting")
+    pipe = load_sdxl_pipeline(checkpoint_path, torch.float16 if precision == "fp16" else torch.float32)
+    manifest = export_pipeline(pipe, path, precision, digest)
+    print(f"Exported in {sum(manifest['export_seconds'].values()):.1f}s, {sum(manifest['bytes'].values()) / 1024 ** 3:.2f} GB")
+    del pipe
+    model_volume.commit()
+    return path
+
+# Exports the SDXL components to ONNX on the models volume:
+# modal run app.py::export_onnx --precision int8
+@app.function(
+    image=onnx_image,
+    gpu="A10G",
+    memory=65536,
+    timeout=3600,
+    volumes={MODEL_VOLUME_PATH: model_volume},
+    secrets=[hf_secret] if hf_secret is not None else []
+)
+def export_onnx(precision: str = ONNX_PRECISION):
+    """
+    Export the SDXL components to ONNX for the ONNX Runtime backend.
+    
+    Args:
+        precision: "fp32", "fp16" or "int8"
+    
+    Returns:
+        The path of the export directory
+    """
+    if "HF_TOKEN" in os.environ and os.environ["HF_TOKEN"]:
+        os.environ["HUGGING_FACE_HUB_TOKEN"] = os.environ["HF_TOKEN"]
+    
+    checkpoint_path = f"{MODEL_VOLUME_PATH}/illustrious_xl.safetensors"
+    return ensure_onnx_export(checkpoint_path if os.path.exists(checkpoint_path) else None, precision)
+
+# Encodes prompts on CPU workers when SD_REMOTE_TEXT_ENCODING=1, so the GPU
+# containers hold only the UNet and VAE
+@app.cls(
+    image=image,
+    cpu=4.0,
+    memory=8192,
+    timeout=600,
+    volumes={MODEL_VOLUME_PATH: model_volume},
+    secrets=[hf_secret] if hf_secret is not None else []
+)
+class TextEncoder:
+    @modal.enter()
+    def load(self):
+        """Load the two SDXL text encoders and their tokenizers."""
+        import torch
+        from utils.text_encoding import EmbeddingCache, fp16_weight_bytes
+        
+        if "HF_TOKEN" in os.environ and os.environ["HF_TOKEN"]:
+            os.environ["HUGGING_FACE_HUB_TOKEN"] = os.environ["HF_TOKEN"]
+        
+        checkpoint_path = f"{MODEL_VOLUME_PATH}/illustrious_xl.safetensors"
+        # fp16 matmuls are slow on the CPU, so encode in fp32 and ship fp16
+        self.pipe = load_sdxl_pipeline(
+            checkpoint_path if os.path.exists(checkpoint_path) else None,
+            torch.float32,
+            unet=None,
+            vae=None,
+        )
+        self.cache = EmbeddingCache()
+        self.encoder_bytes = fp16_weight_bytes(self.pipe.text_encoder, self.pipe.text_encoder_2)
+        print(f"Text encoders loaded, {self.encoder_bytes / 1024 ** 3:.2f} GB in fp16")
+    
+    @modal.method()
+    def encode(self, prompt: str, negative_prompt: Optional[str] = None, guidance_scale: float = 7.5):
+        """
+        Encode a prompt, reusing the embeddings of an identical earlier prompt.
+        
+        Args:
+            prompt: The text prompt
+            negative_prompt: Optional negative prompt
+            guidance_scale: Guidance scale; negative embeddings are only
+                computed when classifier-free guidance is enabled
+        
+        Returns:
+            The packed fp16 embeddings, whether they came from the cache, the
+            encode time and the GPU memory the text encoders would take
+        """
+        import torch
+        from utils.stages import encode_prompt
+        from utils.text_encoding import embedding_key, pack_embeddings
+        
+        start = time.perf_counter()
+        key = embedding_key(prompt, negative_prompt, guidance_scale)
+        packed = self.cache.get(key)
+        cached = packed is not None
+        if not cached:
+            with torch.inference_mode():
+                packed = pack_embeddings(encode_prompt(self.pipe, prompt, negative_prompt, guidance_scale, device="cpu"))
+            self.cache.put(key, packed)
+        
+        return {
+            "embeddings": packed,
+            "cached": cached,
+            "seconds": time.perf_counter() - start,
+            "encoder_bytes": self.encoder_bytes,
+        }
+
 # Define the Stable Diffusion model class
 @app.cls(
-    image=image, 
-    gpu="A10G", 
+    image=model_image, 
+    gpu=None if GPU_TYPE == "cpu" else GPU_TYPE, 
+    cpu=CPU_CONTAINER_CORES if GPU_TYPE == "cpu" else None,
+    memory=CPU_CONTAINER_MEMORY if GPU_TYPE == "cpu" else None,
     timeout=900, 
+    scaledown_window=SCALEDOWN_WINDOW,
     volumes={
         VOLUME_PATH: volume,
         MODEL_VOLUME_PATH: model_volume
     },
     secrets=[hf_secret] if hf_secret is not None else []
 )
+# Several inputs share a container: one uses the GPU while the others fetch
+# embeddings, wait their turn or save and encode images. GPU stages are
+# serialised by gpu_lane
+@modal.concurrent(max_inputs=GPU_CONCURRENT_INPUTS)
 class StableDiffusionModel:
     def __init__(self):
+        # Record when the container started initialising, for cold-start tracing
+        self.init_start_ns = time.time_ns()
+        self.cold_start = True
+        self.container_id = os.environ.get("MODAL_TASK_ID", str(uuid.uuid4()))
+        
         # Use Illustrious XL checkpoint if available, otherwise fall back to HF
         self.illustrious_path = f"{MODEL_VOLUME_PATH}/illustrious_xl.safetensors"
         self.local_checkpoint_exists = False
         
+        # The pipeline is loaded lazily by _get_pipeline and reused across calls
+        self.pipe = None
+        self.derived_pipes = {}
+        self.compile_report = None
+        self.quantization_report = None
+        
+        # Held while a request uses the pipeline on the GPU; decoding runs on
+        # the post_processor's worker thread and CPU stages in each input's
+        # own thread, both outside the lane
+        self.gpu_lane = GpuLane()
+        self.post_processor = None
+        
         # Set Hugging Face token in environment if available
         if "HF_TOKEN" in os.environ and os.environ["HF_TOKEN"]:
             print("Hugging Face token found in environment")
@@ -123,11 +589,235 @@ class StableDiffusionModel:
             print(f"Found local Illustrious XL checkpoint at {self.illustrious_path}")
             print(f"File size: {os.path.getsize(self.illustrious_path) / (1024 * 1024 * 1024):.2f} GB")
             self.local_checkpoint_exists = True
+            self.model_id = os.path.basename(self.illustrious_path)
         else:
+            self.model_id = FALLBACK_MODEL_ID
             print(f"Local checkpoint not found at {self.illustrious_path}")
             print(f"Will use SDXL from Hugging Face instead")
             print(f"Contents of {MODEL_VOLUME_PATH}: {os.listdir(MODEL_VOLUME_PATH)}")
+        
+        self.init_end_ns = time.time_ns()
+    
+    @modal.enter()
+    def warm_up(self):
+        """
+        Load the pipeline, and compile it when compiled mode is on, before the first request.
+        
+        Containers kept warm by the warm pool controller are then ready to
+        serve at once, and register themselves for the /ready endpoint. In
+        compiled mode every resolution bucket is also warmed up; the compile
+        cache lives on the models volume and is committed afterwards, so later
+        containers load the compiled graphs instead of rebuilding them. With
+        the ONNX Runtime backend the export is loaded, or made if there is none;
+        in the quantised mode the quantised weights are loaded, or made and
+        cached if there are none.
+        """
+        if ONNX_ENABLED or GPU_TYPE == "cpu":
+            # Without a GPU there are no memory profiles to prepare
+            self._get_pipeline()
+        elif COMPILE_ENABLED:
+            self._compile()
+        else:
+            import torch
+            from utils.memory import apply_memory_profile, resolve_memory_profile
+            
+            # Prepare for the default request size
+            apply_memory_profile(
+                self._get_pipeline(),
+                resolve_memory_profile(
+                    None,
+                    1024,
+                    1024,
+                    torch.cuda.get_device_properties(0).total_memory,
+                    text_encoders=not REMOTE_TEXT_ENCODING,
+                    weight_savings_gb=self._weight_savings_gb(),
+                ),
+            )
+        
+        # The load now belongs to container start-up in cold-start traces
+        self.init_end_ns = time.time_ns()
+        warm_containers.put(self.container_id, {"model_id": self.model_id, "loaded_at": time.time()})
+    
+    @modal.exit()
+    def deregister(self):
+        """Remove this container from the warm containers reported by /ready."""
+        try:
+            warm_containers.pop(self.container_id)
+        except KeyError:
+            pass
+    
+    def _compile(self):
+        """Compile the UNet and warm up every resolution bucket."""
+        from utils.compile import COMPILE_WARMUP_STEPS, configure_compile_cache, warm_up_buckets
+        from utils.memory import apply_memory_profile
+        
+        print(f"Compiled mode enabled, using compile cache at {COMPILE_CACHE_PATH}")
+        configure_compile_cache(COMPILE_CACHE_PATH)
+        pipe = self._get_pipeline()
+        apply_memory_profile(pipe, COMPILE_MEMORY_PROFILE)
+        
+        embeds = self._encode_prompt(pipe, "warmup", None, 7.5)
+        
+        def generate(width, height):
+            pipe(
+                **embeds,
+                width=width,
+                height=height,
+                num_inference_steps=COMPILE_WARMUP_STEPS,
+                output_type="latent",
+            )
+        
+        self.compile_report = warm_up_buckets(pipe, generate)
+        print(f"Compile warmup finished: {self.compile_report['compile_seconds']:.2f}s compiling, cache {self.compile_report['cache']}")
+        model_volume.commit()
     
+    @modal.method()
+    def get_compile_report(self):
+        """
+        Get the compile report produced by the warmup of this container.
+        
+        Returns:
+            The per-bucket compile times and speedups, or None if compiled mode is off
+        """
+        return self.compile_report
+    
+    def _get_pipeline(self):
+        """
+        Get the SDXL pipeline, loading it onto the GPU on first use.
+
+        The pipeline is kept on the instance so later calls in the same
+        container skip the checkpoint load.
+
+        Returns:
+            The loaded StableDiffusionXLPipeline
+        """
+        if self.pipe is not None:
+            return self.pipe
+
+        import torch
+
+        checkpoint_path = self.illustrious_path if self.local_checkpoint_exists else None
+        if ONNX_ENABLED:
+            from utils.onnx_backend import load_onnx_pipeline
+
+            # The ONNX Runtime components run where ONNX Runtime places them,
+            # so memory profiles don't apply
+            self.pipe = load_onnx_pipeline(
+                ensure_onnx_export(checkpoint_path),
+                text_encoders=not REMOTE_TEXT_ENCODING,
+            )
+            return self.pipe
+
+        # With remote text encoding the prompts arrive already encoded, so the
+        # text encoders and tokenizers are never loaded
+        components = {}
+        if REMOTE_TEXT_ENCODING:
+            print("Remote text encoding enabled, loading only the UNet and VAE")
+            components = {"text_encoder": None, "text_encoder_2": None, "tokenizer": None, "tokenizer_2": None}
+
+        # CPU-only containers run in fp32, which the CPU kernels are made for
+        pipe = load_sdxl_pipeline(checkpoint_path, torch.float32 if GPU_TYPE == "cpu" else torch.float16, **components)
+
+        # Quantised weights are cached on the models volume by the hash of the
+        # checkpoint, so each checkpoint is quantised once
+        if QUANTIZATION_ENABLED:
+            from utils.onnx_backend import model_hash
+            from utils.quantization import quantize_pipeline
+
+            digest = model_hash(checkpoint_path, FALLBACK_MODEL_ID, QUANTIZED_CACHE_PATH)
+            self.quantization_report = quantize_pipeline(
+                pipe, QUANTIZATION, os.path.join(QUANTIZED_CACHE_PATH, digest[:16])
+            )
+            if not self.quantization_report["cached"]:
+                model_volume.commit()
+
+        # Device placement is left to apply_memory_profile, since offloading
+        # profiles keep parts of the pipeline on the CPU
+        self.pipe = pipe
+        return self.pipe
+
+    def _weight_savings_gb(self):
+        """
+        Get the weight memory quantisation saved, for choosing memory profiles.
+
+        Returns:
+            The GB saved, 0 when the pipeline isn't quantised
+        """
+        report = self.quantization_report
+        if report is None:
+            return 0.0
+        return (report["bytes"] - report["quantized_bytes"]) / 1024 ** 3
+
+    def _get_derived_pipeline(self, kind):
+        """
+        Get the img2img ("img2img") or inpainting ("inpaint") pipeline.
+
+        It is built on first use from the loaded SDXL pipeline with from_pipe,
+        so it shares its UNet, VAE and text encoders and loads no extra weights.
+
+        Args:
+            kind: "img2img" or "inpaint"
+
+        Returns:
+            The StableDiffusionXLImg2ImgPipeline or StableDiffusionXLInpaintPipeline
+        """
+        if kind not in self.derived_pipes:
+            from diffusers import StableDiffusionXLImg2ImgPipeline, StableDiffusionXLInpaintPipeline
+            
+            pipeline_class = {
+                "img2img": StableDiffusionXLImg2ImgPipeline,
+                "inpaint": StableDiffusionXLInpaintPipeline,
+            }[kind]
+            # from_pipe casts the shared components (to float32 unless told
+            # otherwise), so pipelined decodes with an upcast VAE finish first
+            if self.post_processor is not None:
+                self.post_processor.drain()
+            pipe = self._get_pipeline()
+            self.derived_pipes[kind] = pipeline_class.from_pipe(pipe, torch_dtype=pipe.unet.dtype)
+        return self.derived_pipes[kind]
+    
+    def _get_post_processor(self):
+        """
+        Get the executor that post-processes denoised latents, starting it on first use.
+
+        Its worker decodes on a side CUDA stream, so the VAE decode of one
+        request can overlap with the denoising of the next.
+
+        Returns:
+            The PostProcessExecutor
+        """
+        if self.post_processor is None:
+            import torch
+            from utils.pipelining import PostProcessExecutor
+
+            stream = torch.cuda.Stream()
+            self.post_processor = PostProcessExecutor(initializer=lambda: torch.cuda.set_stream(stream))
+        return self.post_processor
+
+    def _encode_prompt(self, pipe, prompt, negative_prompt, guidance_scale, embeddings=None):
+        """
+        Get the embeddings of a prompt.
+
+        Args:
+            pipe: The loaded pipeline
+            prompt: The text prompt
+            negative_prompt: Optional negative prompt
+            guidance_scale: Guidance scale of the request
+            embeddings: Optional embeddings already packed by the TextEncoder
+
+        Returns:
+            A dictionary of embedding keyword arguments accepted by the pipeline call
+        """
+        from utils.stages import encode_prompt
+        from utils.text_encoding import unpack_embeddings
+
+        if embeddings is None and REMOTE_TEXT_ENCODING:
+            # Callers that bypass the web tier still need the CPU workers
+            embeddings = TextEncoder().encode.remote(prompt, negative_prompt, guidance_scale)["embeddings"]
+        if embeddings is not None:
+            return unpack_embeddings(embeddings, device=pipe._execution_device)
+        return encode_prompt(pipe, prompt, negative_prompt, guidance_scale, device=pipe._execution_device)
+
     @modal.method()
     def generate_image(
         self,
@@ -138,6 +828,22 @@ class StableDiffusionModel:
         num_inference_steps: int = 30,
         guidance_scale: float = 7.5,
         negative_prompt: Optional[str] = None,
+        trace_id: Optional[str] = None,
+        submitted_at_ns: Optional[int] = None,
+        profile_request_id: Optional[str] = None,
+        memory_profile: Optional[str] = None,
+        num_images: int = 1,
+        seeds: Optional[List[int]] = None,
+        seed: Optional[int] = None,
+        embeddings: Optional[dict] = None,
+        cache_interval: int = 1,
+        guidance_cutoff: float = 1.0,
+        hires_scale: float = 1.0,
+        hires_strength: Optional[float] = None,
+        init_image: Optional[bytes] = None,
+        mask_image: Optional[bytes] = None,
+        strength: float = 1.0,
+        tiled: bool = False,
     ):
         """
         Generate an image from a text prompt using Stable Diffusion XL.
@@ -150,15 +856,58 @@ class StableDiffusionModel:
             num_inference_steps: Number of denoising steps
             guidance_scale: Guidance scale for the diffusion process
             negative_prompt: Optional negative prompt for the generation
+            trace_id: Optional trace id of the web request this call belongs to
+            submitted_at_ns: Optional time (ns since the epoch) the web tier
+                submitted the call, used to record the queueing span
+            profile_request_id: Optional request id; when set, the call runs
+                under the profiler and the trace is saved under this id
+            memory_profile: Optional memory profile name, or "auto" to pick
+                one from the image size and GPU memory
+            num_images: Number of images to generate in one batched pipeline call
+            seeds: Optional list with one seed per image
+            seed: Optional base seed; image i uses seed + i
+            embeddings: Optional prompt embeddings packed by the TextEncoder;
+                the prompt is only used for logging when they are given
+            cache_interval: Run the whole UNet on one step in every
+                cache_interval and reuse its deep features on the others;
+                1 recomputes every step
+            guidance_cutoff: Fraction of the steps run with classifier-free
+                guidance; the rest run the UNet on the conditional batch only
+            hires_scale: When above 1, denoise at the size divided by
+                hires_scale, upscale the latents and refine them at full size
+            hires_strength: Fraction of the schedule the refinement pass
+                re-runs; defaults to SD_HIRES_STRENGTH
+            init_image: Optional encoded input image; when given, the image is
+                generated from it with img2img, resized to width x height
+            mask_image: Optional encoded mask for inpainting init_image; white
+                areas are regenerated and black areas kept
+            strength: Fraction of the schedule run on top of init_image; only
+                that many steps are denoised
+            tiled: Denoise latents larger than SD_TILE_SIZE as overlapping
+                tiles blended every step, and decode them tile by tile, so
+                GPU memory is bounded by the tile size rather than the image
         
         Returns:
-            The path to the generated image and the base64-encoded image data
+            A GenerationResult with the path, PNG data and seed of each image,
+            the per-stage timings and the trace spans of the request
         """
+        entry_ns = time.time_ns()
+        cold_start = self.cold_start
+        self.cold_start = False
         try:
             import torch
-            from diffusers import StableDiffusionXLPipeline, AutoencoderKL
-            from PIL import Image
-            import huggingface_hub
+            from utils.metrics import StageTimer
+            from utils.stages import decode_latents
+            from utils.profiling import maybe_profile
+            from utils.memory import MEMORY_PROFILES, apply_memory_profile, resolve_memory_profile
+            from utils.helpers import numbered_output_paths, resolve_seeds
+            from utils.pipelining import PIPELINE_ENABLED
+            from utils.step_cache import step_cache
+            from utils.guidance import count_unet_calls, guidance_cutoff_callback
+            from utils.hires import hires_plan, upscale_latents
+            from utils.images import prepare_input_image
+            from utils.tiling import TILE_BATCH_SIZE, TILE_SIZE, tiled_unet
+            from utils.onnx_backend import onnx_size
             
             # Print some information
             print(f"Generating image for prompt: {prompt}")
@@ -166,76 +915,295 @@ class StableDiffusionModel:
             print(f"Width: {width}, Height: {height}")
             print(f"Steps: {num_inference_steps}, Guidance scale: {guidance_scale}")
             
-            # Check if we have a Hugging Face token
-            if "HUGGING_FACE_HUB_TOKEN" in os.environ and os.environ["HUGGING_FACE_HUB_TOKEN"]:
-                print("Using Hugging Face token for authentication")
-                huggingface_hub.login(token=os.environ["HUGGING_FACE_HUB_TOKEN"])
+            # One seed and output path per image
+            seeds = resolve_seeds(num_images, seeds, seed)
+            output_paths = numbered_output_paths(output_path, num_images)
+            print(f"Images: {num_images}, Seeds: {seeds}")
             
-            # Start timing
-            start_time = time.time()
+            # In compiled mode, sizes snap to the warmed-up buckets and the memory
+            # profile is pinned so the compiled graphs stay valid; the UNet's
+            # blocks can't be wrapped for step caching either, and halving the
+            # batch part way through or a second size would recompile it
+            if COMPILE_ENABLED:
+                width, height = snap_to_bucket(width, height)
+                memory_profile = COMPILE_MEMORY_PROFILE
+                cache_interval = 1
+                guidance_cutoff = 1.0
+                hires_scale = 1.0
+                tiled = False
+                print(f"Compiled mode: snapped to bucket {width}x{height}")
             
-            # Initialize the pipeline
-            if self.local_checkpoint_exists:
-                print(f"Loading local Illustrious XL checkpoint from {self.illustrious_path}")
-                pipe = StableDiffusionXLPipeline.from_single_file(
-                    self.illustrious_path,
-                    torch_dtype=torch.float16,
-                    use_safetensors=True,
-                    variant="fp16",
-                )
-            else:
-                # Initialize the pipeline from Hugging Face
-                print("Loading SDXL from Hugging Face")
-                pipe = StableDiffusionXLPipeline.from_pretrained(
-                    "stabilityai/stable-diffusion-xl-base-1.0",
-                    torch_dtype=torch.float16,
-                    use_safetensors=True,
-                    variant="fp16",
-                )
+            # The ONNX Runtime backend runs graphs traced from the torch modules:
+            # sizes have to suit the traced UNet, and there are no UNet blocks to
+            # cache or VAE tiles to decode
+            if ONNX_ENABLED:
+                width, height = onnx_size(width, height)
+                cache_interval = 1
+                tiled = False
+                print(f"ONNX Runtime backend: generating at {width}x{height}")
             
-            print("Moving pipeline to CUDA...")
-            pipe = pipe.to("cuda")
+            # Step caching would reuse one tile's deep features for every tile
+            if tiled:
+                cache_interval = 1
             
-            # Generate the image
-            print("Generating image with SDXL...")
-            image = pipe(
-                prompt=prompt,
-                negative_prompt=negative_prompt,
-                width=width,
-                height=height,
-                num_inference_steps=num_inference_steps,
-                guidance_scale=guidance_scale,
-            ).images[0]
+            # A hires generation denoises at a smaller base size first; img2img
+            # and inpainting start from an input image at the requested size
+            hires = None
+            base_width, base_height = width, height
+            if hires_scale > 1 and init_image is None:
+                hires = hires_plan(width, height, num_inference_steps, hires_scale, hires_strength)
+                base_width, base_height = hires["base"]
+                print(f"Hires: base pass at {base_width}x{base_height}, refining {hires['refine_steps']} steps")
             
-            # Create the output directory if it doesn't exist
-            print(f"Creating output directory: {os.path.dirname(output_path)}")
-            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            # Pick the memory profile for this request; a tiled generation
+            # only ever runs a batch of tiles through the UNet and VAE. ONNX
+            # Runtime manages its own memory and CPU-only containers have no
+            # GPU memory to manage, so neither has a profile
+            if ONNX_ENABLED or GPU_TYPE == "cpu":
+                memory_profile = None
+            else:
+                memory_width, memory_height, memory_batch = width, height, num_images
+                if tiled:
+                    memory_width, memory_height = min(width, TILE_SIZE), min(height, TILE_SIZE)
+                    memory_batch = num_images * TILE_BATCH_SIZE
+                memory_profile = resolve_memory_profile(
+                    memory_profile,
+                    memory_width,
+                    memory_height,
+                    torch.cuda.get_device_properties(0).total_memory,
+                    memory_batch,
+                    text_encoders=not REMOTE_TEXT_ENCODING,
+                    weight_savings_gb=self._weight_savings_gb(),
+                )
+                print(f"Memory profile: {memory_profile}")
             
-            # Save the image
-            print(f"Saving image to: {output_path}")
-            image.save(output_path)
+            # Start timing; only the current thread's stream is synchronised, and
+            # only around GPU stages, so timing one request doesn't stall on the
+            # work of another. CPU-only containers have nothing to synchronise
+            timer = StageTimer(
+                sync=(lambda: torch.cuda.current_stream().synchronize()) if torch.cuda.is_available() else None
+            )
             
-            # Check if the file was saved
-            if os.path.exists(output_path):
-                print(f"Image file exists at {output_path}")
-                print(f"File size: {os.path.getsize(output_path)} bytes")
-            else:
-                print(f"WARNING: Image file does not exist at {output_path}")
+            # Record the phases before this call started: queueing (which
+            # includes container start-up on a cold start) and container init
+            if submitted_at_ns is not None:
+                timer.add_span("queue_wait", submitted_at_ns, entry_ns)
+            if cold_start:
+                timer.add_span("container_init", self.init_start_ns, self.init_end_ns)
             
-            # List the contents of the volume
-            contents = os.listdir(VOLUME_PATH)
-            print(f"Contents of {VOLUME_PATH} after saving image: {contents}")
+            # Profile the call only when explicitly requested
+            with maybe_profile(profile_request_id, PROFILES_PATH) as profiler:
+                # Post-processing is pipelined unless the request is profiled or
+                # its profile offloads, since offload hooks move the VAE around;
+                # ONNX Runtime doesn't run on the side stream
+                pipelined = (
+                    PIPELINE_ENABLED
+                    and profiler is None
+                    and memory_profile is not None
+                    and MEMORY_PROFILES[memory_profile]["offload"] is None
+                )
+                
+                def decode(latents, denoised=None):
+                    if denoised is not None:
+                        # Wait for the denoise on the side stream, and keep the latents
+                        # alive until the side stream is done with them
+                        torch.cuda.current_stream().wait_event(denoised)
+                        latents.record_stream(torch.cuda.current_stream())
+                    
+                    with timer.stage("vae_decode"):
+                        return decode_latents(pipe, latents, tiled=tiled)
+                
+                # Fetching embeddings is network I/O, so callers that bypass the
+                # web tier do it before queueing for the GPU
+                if embeddings is None and REMOTE_TEXT_ENCODING:
+                    with timer.stage("text_encoding", sync=False):
+                        embeddings = TextEncoder().encode.remote(prompt, negative_prompt, guidance_scale)["embeddings"]
+                
+                # Input images only need the CPU, so they are decoded before
+                # queueing for the GPU too
+                if init_image is not None:
+                    with timer.stage("image_decode", sync=False):
+                        init_image = prepare_input_image(init_image, width, height)
+                        if mask_image is not None:
+                            mask_image = prepare_input_image(mask_image, width, height, mode="L")
+                
+                with timer.stage("gpu_wait"):
+                    ahead = self.gpu_lane.acquire()
+                if ahead:
+                    print(f"Waited for {ahead} requests ahead of this one on the GPU")
+                peak_bytes = None
+                try:
+                    # Peak memory is tracked per device, so it is only measured
+                    # while this request holds the GPU
+                    if memory_profile is not None:
+                        torch.cuda.reset_peak_memory_stats()
+                    with timer.stage("pipeline_acquisition"):
+                        pipe = self._get_pipeline()
+                        if memory_profile is not None:
+                            if getattr(pipe, "_memory_profile", None) != memory_profile and self.post_processor is not None:
+                                # Earlier requests may still be decoding with the current settings
+                                self.post_processor.drain()
+                            apply_memory_profile(pipe, memory_profile)
+                    
+                    with timer.stage("prompt_encoding"):
+                        embeds = self._encode_prompt(pipe, prompt, negative_prompt, guidance_scale, embeddings)
+                    
+                    # Text-to-image denoises from noise at the base size; img2img and
+                    # inpainting use pipelines that share the loaded components
+                    if init_image is None:
+                        denoiser, inputs, guided_inputs = pipe, {"width": base_width, "height": base_height}, ()
+                    else:
+                        # Encoding the input image may upcast the shared VAE, so the
+                        # pipelined decodes of earlier requests have to finish first
+                        if self.post_processor is not None:
+                            self.post_processor.drain()
+                        inputs = {"image": init_image, "strength": strength}
+                        if mask_image is None:
+                            denoiser, guided_inputs = self._get_derived_pipeline("img2img"), ()
+                        else:
+                            denoiser = self._get_derived_pipeline("inpaint")
+                            inputs.update(mask_image=mask_image, width=width, height=height)
+                            guided_inputs = ("mask", "masked_image_latents")
+                    
+                    # Generate the latents for all images in one batch; the prompt is
+                    # encoded once and the pipeline repeats the embeddings per image.
+                    # With guidance off (guidance_scale <= 1) the pipeline already runs
+                    # the UNet on the conditional batch alone; the cutoff does the same
+                    # for the steps after it
+                    print("Generating image with SDXL...")
+                    step_callback, step_tensors = guidance_cutoff_callback(
+                        guidance_cutoff, timer.step_callback, guided_inputs
+                    )
+                    with contextlib.ExitStack() as unet_hooks:
+                        cache = None
+                        if not COMPILE_ENABLED and not ONNX_ENABLED:
+                            cache = unet_hooks.enter_context(step_cache(pipe.unet, cache_interval))
+                        tiler = None
+                        if tiled:
+                            tiler = unet_hooks.enter_context(
+                                tiled_unet(pipe.unet, vae_scale_factor=pipe.vae_scale_factor)
+                            )
+                        counter = unet_hooks.enter_context(
+                            count_unet_calls(
+                                pipe.unet,
+                                num_images,
+                                kind=(lambda: "shallow" if cache.reusing else "full") if cache is not None else None,
+                                measure_flops=not COMPILE_ENABLED and not ONNX_ENABLED,
+                            )
+                        )
+                        with timer.stage("denoise"):
+                            timer.start_steps()
+                            latents = denoiser(
+                                **embeds,
+                                **inputs,
+                                num_inference_steps=num_inference_steps,
+                                guidance_scale=guidance_scale,
+                                num_images_per_prompt=num_images,
+                                generator=[torch.Generator(device=pipe._execution_device).manual_seed(s) for s in seeds],
+                                output_type="latent",
+                                callback_on_step_end=step_callback,
+                                callback_on_step_end_tensor_inputs=step_tensors,
+                            ).images
+                        
+                        # Refine the upscaled latents with img2img at the requested
+                        # size; the img2img pipeline shares the loaded components
+                        if hires is not None:
+                            with timer.stage("hires_refine"):
+                                timer.start_steps()
+                                latents = self._get_derived_pipeline("img2img")(
+                                    **embeds,
+                                    image=upscale_latents(latents, width, height, pipe.vae_scale_factor),
+                                    strength=hires["strength"],
+                                    num_inference_steps=num_inference_steps,
+                                    guidance_scale=guidance_scale,
+                                    num_images_per_prompt=num_images,
+                                    generator=[torch.Generator(device=pipe._execution_device).manual_seed(s) for s in seeds],
+                                    output_type="latent",
+                                    callback_on_step_end=step_callback,
+                                    callback_on_step_end_tensor_inputs=step_tensors,
+                                ).images
+                    
+                    if pipelined:
+                        # Hand the latents over while still holding the lane: decodes
+                        # run in denoise order, and a full hand-off queue holds back the
+                        # next denoise
+                        denoised = torch.cuda.Event()
+                        denoised.record()
+                        decoded = self._get_post_processor().submit(decode, latents, denoised)
+                    else:
+                        # Decoding may upcast the shared VAE, so the pipelined decodes
+                        # of earlier requests have to finish first
+                        if self.post_processor is not None:
+                            self.post_processor.drain()
+                        images = decode(latents)
+                    if memory_profile is not None:
+                        peak_bytes = torch.cuda.max_memory_allocated()
+                finally:
+                    self.gpu_lane.release()
+                
+                if pipelined:
+                    images = decoded.result()
+                
+                # Saving and encoding only need the CPU, so they run in this input's
+                # thread while other requests use the GPU
+                with timer.stage("volume_write", sync=False):
+                    # Create the output directory if it doesn't exist
+                    print(f"Creating output directory: {os.path.dirname(output_path)}")
+                    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+                
+                    # Save the images
+                    for image, path in zip(images, output_paths):
+                        print(f"Saving image to: {path}")
+                        image.save(path)
+                
+                # Check if the files were saved
+                for path in output_paths:
+                    if os.path.exists(path):
+                        print(f"Image file exists at {path}")
+                        print(f"File size: {os.path.getsize(path)} bytes")
+                    else:
+                        print(f"WARNING: Image file does not exist at {path}")
+                
+                # Encode the images as PNG to return them with the result
+                with timer.stage("image_encode", sync=False):
+                    pngs = []
+                    for image in images:
+                        buffered = io.BytesIO()
+                        image.save(buffered, format="PNG")
+                        pngs.append(buffered.getvalue())
             
-            # Convert the image to base64 for direct embedding
-            buffered = io.BytesIO()
-            image.save(buffered, format="PNG")
-            img_str = base64.b64encode(buffered.getvalue()).decode()
+            if profiler is not None:
+                volume.commit()
             
             # Print the time taken
-            end_time = time.time()
-            print(f"Image generated in {end_time - start_time:.2f} seconds")
+            timings = timer.as_dict()
+            print(f"Image generated in {timings['total']:.2f} seconds")
+            print(f"Stage timings: {timings['stages']}")
             
-            return {"path": output_path, "base64_image": img_str}
+            return GenerationResult(
+                images=[
+                    GeneratedImage(path=path, png=png, seed=image_seed)
+                    for path, png, image_seed in zip(output_paths, pngs, seeds)
+                ],
+                model_id=self.model_id,
+                timings=timings,
+                trace={"trace_id": trace_id, "cold_start": cold_start, "spans": timer.spans},
+                memory={
+                    "profile": memory_profile,
+                    "peak_bytes": peak_bytes,
+                },
+                profile_path=profiler.path if profiler is not None else None,
+                compile={"bucket": [width, height]} if COMPILE_ENABLED else None,
+                backend=f"onnx-{ONNX_PRECISION}" if ONNX_ENABLED else BACKEND,
+                quantization=self.quantization_report,
+                unet={
+                    **(cache.stats() if cache is not None else {}),
+                    **counter.stats(),
+                    "guidance_cutoff": guidance_cutoff,
+                },
+                hires=hires,
+                tiles=tiler.stats() if tiler is not None else None,
+            )
         except Exception as e:
             print(f"Error in generate_image: {str(e)}")
             import traceback
@@ -245,6 +1213,115 @@ class StableDiffusionModel:
 # Initialize the Stable Diffusion model
 sd_model = StableDiffusionModel()
 
+# CPU workers that encode prompts when remote text encoding is enabled
+text_encoder = TextEncoder()
+
+# Coalesces identical generation requests that are in flight at the same time
+generation_flights = SingleFlight()
+
+# Limits the GPU work admitted at once; budgets apply per web container
+admission = AdmissionController()
+
+# API keys, and the per-client token buckets charged in GPU cost units
+api_keys = load_api_keys()
+rate_limiter = RateLimiter()
+
+# Items and results of batch jobs, kept on the images volume
+batch_store = BatchStore(BATCHES_PATH)
+INFLIGHT_COST.set_function(lambda: admission.inflight_cost)
+QUEUE_DEPTH.set_function(lambda: admission.queue_depth)
+
+# Predicts request latency from the stage timings of finished requests
+latency_model = LatencyModel()
+
+# Writes to Modal objects still running in the background
+background_tasks = set()
+
+def run_in_background(coroutine, description):
+    """
+    Run a coroutine without waiting for it, logging it if it fails.
+    
+    Args:
+        coroutine: The coroutine to run
+        description: What the coroutine does, for the log message
+    """
+    def done(task):
+        background_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Could not {description}: {task.exception()}")
+    
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(done)
+
+def record_arrival():
+    """
+    Record the arrival of a /generate request for the warm pool controller.
+    
+    The record is sent in the background, so requests never wait for it and
+    a failure only costs the forecast one data point.
+    """
+    run_in_background(arrival_queue.put.aio(time.time()), "record request arrival")
+
+def restore_latency_model():
+    """Start from the latency model saved by earlier web containers, if any."""
+    global latency_model
+    state = latency_state.get("model")
+    if state is not None:
+        latency_model = LatencyModel.from_dict(state)
+        print(f"Restored latency model fitted on {latency_model.observations} requests")
+
+def estimate_latency(width, height, num_inference_steps, num_images=1, kind="txt2img", hires=None):
+    """
+    Predict the latency of a generation request arriving now.
+    
+    Args:
+        width: The width of the generated image
+        height: The height of the generated image
+        num_inference_steps: Number of denoising steps run; for img2img and
+            inpainting, only the part of the schedule given by strength
+        num_images: Number of images generated by the request
+        kind: The kind of request, one of REQUEST_KINDS
+        hires: The passes of a hires generation, from hires_plan
+    
+    Returns:
+        The predicted total seconds, split into waiting for admission and
+        running, with the per-stage prediction, its basis and the current
+        queue depth
+    """
+    cost = estimate_cost(width, height, num_inference_steps, num_images=num_images)
+    prediction = latency_model.predict(width, height, num_inference_steps, num_images, kind=kind, hires=hires)
+    queue_seconds = admission.expected_wait(cost)
+    return {
+        "seconds": queue_seconds + prediction["seconds"],
+        "queue_seconds": queue_seconds,
+        "service_seconds": prediction["seconds"],
+        "stages": prediction["stages"],
+        "basis": prediction["basis"],
+        "samples": prediction["samples"],
+        "queue_depth": admission.queue_depth,
+    }
+
+def estimate_batch_seconds(items):
+    """
+    Predict how long the given batch items take to finish.
+    
+    The items run side by side as admission control allows, so the batch
+    takes about as long as admission needs to get through their cost, plus
+    the latency of the last item.
+    
+    Args:
+        items: The batch items still to generate
+    
+    Returns:
+        The predicted seconds
+    """
+    if not items:
+        return 0.0
+    cost = sum(estimate_cost(item["width"], item["height"], item["num_inference_steps"]) for item in items)
+    last = max(latency_model.predict(item["width"], item["height"], item["num_inference_steps"])["seconds"] for item in items)
+    return admission.expected_wait(0) + cost / admission.throughput + last
+
 @fastapi_app.get("/", response_class=HTMLResponse)
 async def read_root():
     # Return the HTML content directly
@@ -306,7 +1383,7 @@ async def read_root():
             <div class="result-container">
                 <div id="loading" class="hidden">
                     <div class="spinner"></div>
-                    <p>Generating image... This may take a minute.</p>
+                    <p id="loading-message">Generating image... This may take a minute.</p>
                 </div>
                 
                 <div id="result" class="hidden">
@@ -550,6 +1627,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const form = document.getElementById('generation-form');
     const generateBtn = document.getElementById('generate-btn');
     const loadingDiv = document.getElementById('loading');
+    const loadingMessage = document.getElementById('loading-message');
     const resultDiv = document.getElementById('result');
     const errorDiv = document.getElementById('error');
     const errorMessage = document.getElementById('error-message');
@@ -581,6 +1659,17 @@ document.addEventListener('DOMContentLoaded', () => {
             params.append(key, value);
         }
         
+        // Show how long the generation is expected to take
+        loadingMessage.textContent = 'Generating image... This may take a minute.';
+        fetch(`/estimate?${params.toString()}`)
+            .then(response => response.ok ? response.json() : null)
+            .then(estimate => {
+                if (estimate) {
+                    loadingMessage.textContent = `Generating image... This should take about ${Math.ceil(estimate.seconds)} seconds.`;
+                }
+            })
+            .catch(() => {});
+        
         try {
             // Send request to the API
             const response = await fetch(`/generate?${params.toString()}`, {
@@ -652,57 +1741,884 @@ async def api_root():
     return {"message": "Welcome to the Stable Diffusion API"}
 
 @fastapi_app.post("/generate")
-async def generate_image(prompt: str, width: int = 1024, height: int = 1024, num_inference_steps: int = 30, guidance_scale: float = 7.5):
+async def generate_image(
+    request: Request,
+    prompt: str,
+    width: int = 1024,
+    height: int = 1024,
+    num_inference_steps: int = 30,
+    guidance_scale: float = 7.5,
+    negative_prompt: Optional[str] = None,
+    memory_profile: Optional[str] = None,
+    num_images: int = 1,
+    seed: Optional[int] = None,
+    seeds: Optional[List[int]] = Query(None),
+    cache_interval: int = 1,
+    guidance_cutoff: float = 1.0,
+    hires_scale: float = 1.0,
+    hires_strength: Optional[float] = None,
+    tiled: bool = False,
+    x_profile: bool = Header(False),
+    x_admin_token: Optional[str] = Header(None),
+    x_api_key: Optional[str] = Header(None),
+    accept: Optional[str] = Header(None),
+):
     """
     Generate an image from a text prompt using Stable Diffusion XL.
     
     Args:
+        request: The incoming request, used to identify anonymous clients
         prompt: The text prompt to generate an image from
         width: The width of the generated image
         height: The height of the generated image
         num_inference_steps: Number of denoising steps
         guidance_scale: Guidance scale for the diffusion process
+        negative_prompt: Optional text describing what the image should not contain
+        memory_profile: Optional memory profile name (see utils.memory), or "auto"
+        num_images: Number of images to generate from the prompt in one batch
+        seed: Optional base seed; image i uses seed + i
+        seeds: Optional list with one seed per image (repeat the query parameter)
+        cache_interval: Step caching dial; the whole UNet runs on one step in
+            every cache_interval and its deep features are reused in between.
+            1 (the default) is full quality, higher values are faster
+        guidance_cutoff: Fraction of the steps run with classifier-free
+            guidance; later steps skip the unconditional pass. 1 (the
+            default) guides every step
+        hires_scale: Hires fix; when above 1, the image is first denoised at
+            its size divided by hires_scale, then the latents are upscaled
+            and refined at full size
+        hires_strength: Fraction of the schedule the hires refinement
+            re-runs (defaults to SD_HIRES_STRENGTH)
+        tiled: Denoise and decode the image in overlapping tiles, so sizes
+            well beyond what fits on the GPU at once (2048x2048 and up) can
+            be generated; tiles overlap, so more pixels are denoised
+        x_profile: Privileged flag (X-Profile header) to profile this request
+        x_admin_token: Admin token (X-Admin-Token header), required for profiling
+        x_api_key: Optional API key (X-API-Key header) identifying the client
+        accept: Accept header; "image/png" returns the raw image instead of JSON,
+            for single-image requests only
+    
+    Returns:
+        A URL to the generated image, plus the URL, data and seed of every image;
+        or the PNG itself if requested
+    """
+    wants_png = check_request(x_profile, x_admin_token, memory_profile, num_images, seeds, accept)
+    if not 1 <= cache_interval <= MAX_CACHE_INTERVAL:
+        raise HTTPException(status_code=400, detail=f"cache_interval must be between 1 and {MAX_CACHE_INTERVAL}")
+    if not 0 < guidance_cutoff <= 1:
+        raise HTTPException(status_code=400, detail="guidance_cutoff must be greater than 0 and at most 1")
+    if not 1 <= hires_scale <= MAX_HIRES_SCALE:
+        raise HTTPException(status_code=400, detail=f"hires_scale must be between 1 and {MAX_HIRES_SCALE}")
+    if hires_strength is not None and not 0 < hires_strength <= 1:
+        raise HTTPException(status_code=400, detail="hires_strength must be greater than 0 and at most 1")
+    if hires_scale > 1 and denoising_steps(num_inference_steps, HIRES_STRENGTH if hires_strength is None else hires_strength) < 1:
+        raise HTTPException(status_code=400, detail="hires_strength is too low to run any refinement steps")
+    
+    # Rejected requests count too: they are demand the warm pool should have met
+    if WARM_POOL_ENABLED:
+        record_arrival()
+    
+    # Overlapping tiles denoise some pixels more than once
+    cost = estimate_cost(width, height, num_inference_steps, num_images=num_images)
+    if tiled:
+        cost *= tile_coverage(width, height)
+    client = charge_client(request, x_api_key, cost)
+    
+    params = {
+        "prompt": prompt,
+        "width": width,
+        "height": height,
+        "num_inference_steps": num_inference_steps,
+        "guidance_scale": guidance_scale,
+        "negative_prompt": negative_prompt,
+        "memory_profile": memory_profile,
+        "num_images": num_images,
+        "seed": seed,
+        "seeds": seeds,
+        "cache_interval": cache_interval,
+        "guidance_cutoff": guidance_cutoff,
+        "hires_scale": hires_scale,
+        "hires_strength": hires_strength,
+        "tiled": tiled,
+    }
+    
+    return await serve_generation("generate", params, client, x_profile, wants_png)
+
+def check_request(x_profile, x_admin_token, memory_profile, num_images, seeds, accept):
+    """
+    Validate the parameters shared by /generate, /img2img and /inpaint.
+    
+    Args:
+        x_profile: Whether the request asks to be profiled
+        x_admin_token: The admin token sent with the request
+        memory_profile: The requested memory profile
+        num_images: Number of images requested
+        seeds: Optional list with one seed per image
+        accept: The Accept header of the request
+    
+    Returns:
+        Whether the client asked for the PNG itself rather than JSON
+    
+    Raises:
+        HTTPException: If a parameter is invalid, or profiling isn't allowed
+    """
+    if x_profile:
+        require_admin(x_admin_token)
+    if memory_profile not in (None, "auto") and memory_profile not in MEMORY_PROFILES:
+        raise HTTPException(status_code=400, detail=f"Unknown memory profile: {memory_profile}")
+    if not 1 <= num_images <= MAX_IMAGES_PER_REQUEST:
+        raise HTTPException(status_code=400, detail=f"num_images must be between 1 and {MAX_IMAGES_PER_REQUEST}")
+    if seeds is not None and len(seeds) != num_images:
+        raise HTTPException(status_code=400, detail=f"Expected {num_images} seeds, got {len(seeds)}")
+    wants_png = accept is not None and accept.split(";")[0].strip() == "image/png"
+    if wants_png and num_images != 1:
+        raise HTTPException(status_code=400, detail="image/png responses hold a single image; use JSON for num_images > 1")
+    return wants_png
+
+def charge_client(request, x_api_key, cost):
+    """
+    Identify the client of a request and charge the request to its token bucket.
+    
+    Args:
+        request: The incoming request, used to identify anonymous clients
+        x_api_key: Optional API key identifying the client
+        cost: The estimated cost of the request in megapixel-steps
     
     Returns:
-        A URL to the generated image
+        The Client the request belongs to
+    
+    Raises:
+        HTTPException: If the API key is unknown (401), the request costs more
+            than the client's burst (400) or the client is over its rate (429)
     """
     try:
-        # Generate a unique ID for this image
-        image_id = str(uuid.uuid4())
-        
-        # Generate the image
-        image_path = f"{VOLUME_PATH}/{image_id}.png"
-        
-        # Print debug information
-        print(f"Generating image with prompt: '{prompt}'")
-        print(f"Parameters: width={width}, height={height}, steps={num_inference_steps}, guidance={guidance_scale}")
-        print(f"Image will be saved to: {image_path}")
-        
-        # Call the Modal function to generate the image
+        client = identify_client(x_api_key, request.client.host if request.client else "unknown", api_keys)
+        rate_limiter.consume(client, cost)
+    except UnknownApiKey as e:
+        raise HTTPException(status_code=401, detail=str(e))
+    except ExceedsBurst as e:
+        ADMISSION_REJECTIONS_TOTAL.labels(reason="too_expensive").inc()
+        REQUESTS_TOTAL.labels(status="rejected").inc()
+        raise HTTPException(status_code=400, detail=str(e))
+    except RateLimited as e:
+        ADMISSION_REJECTIONS_TOTAL.labels(reason="rate_limited").inc()
+        REQUESTS_TOTAL.labels(status="rejected").inc()
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    return client
+
+async def serve_generation(span_name, params, client, x_profile=False, wants_png=False):
+    """
+    Run an admitted generation request and build its response.
+    
+    Args:
+        span_name: The name of the request's root span, e.g. "generate"
+        params: The generation parameters accepted by StableDiffusionModel.generate_image
+        client: The Client the request belongs to
+        x_profile: Whether to profile the request
+        wants_png: Whether to return the PNG itself rather than JSON; only
+            single-image requests may ask for it (see check_request)
+    
+    Returns:
+        A URL to the generated image, plus the URL, data and seed of every image;
+        or the PNG itself if requested. Only the PNG is passed through as it
+        came from the GPU container; JSON responses base64-encode each image once
+    """
+    prompt = params["prompt"]
+    width, height = params["width"], params["height"]
+    num_inference_steps, guidance_scale = params["num_inference_steps"], params["guidance_scale"]
+    
+    # Every request gets a root span; its trace id is passed to the GPU container
+    with get_tracer().start_as_current_span(span_name) as root_span:
+        trace_id = format_trace_id(root_span)
         try:
-            result = sd_model.generate_image.remote(
-                prompt=prompt,
-                output_path=image_path,
-                width=width,
-                height=height,
-                num_inference_steps=num_inference_steps,
-                guidance_scale=guidance_scale
-            )
-            print(f"Image generation completed successfully")
+            # Print debug information
+            print(f"Generating image with prompt: '{prompt}'")
+            print(f"Parameters: width={width}, height={height}, steps={num_inference_steps}, guidance={guidance_scale}")
+            print(f"Trace id: {trace_id}")
+            root_span.set_attributes({
+                "client.name": client.name,
+                "client.lane": client.lane,
+                "image.width": width,
+                "image.height": height,
+                "image.steps": num_inference_steps,
+            })
             
-            # Return both the URL and the base64-encoded image
-            return {
-                "image_url": f"/images/{image_id}.png", 
-                "base64_image": result["base64_image"],
-                "status": "success"
-            }
+            # Call the Modal function to generate the image
+            try:
+                with get_tracer().start_as_current_span("rpc"):
+                    rpc_start = time.perf_counter()
+                    if x_profile:
+                        # Profiled requests always get their own run
+                        image_id, result = await run_generation(params, trace_id, client, profile=True)
+                        shared = False
+                    else:
+                        # Identical requests already in flight share one GPU job
+                        (image_id, result), shared = await generation_flights.do(
+                            request_key(params),
+                            lambda: run_generation(params, trace_id, client),
+                        )
+                    rpc_seconds = time.perf_counter() - rpc_start
+                    
+                    # Replay the spans recorded in the GPU container under this trace
+                    trace_info = result.trace
+                    if not shared:
+                        record_remote_spans(
+                            trace_info.get("spans", []),
+                            attributes={"container.cold_start": bool(trace_info.get("cold_start"))},
+                        )
+                print(f"Image generation completed successfully{' (coalesced)' if shared else ''}")
+                
+                # Aggregate the model-side stage timings into the Prometheus metrics;
+                # a coalesced request only adds to the request-level metrics
+                timings = result.timings
+                if shared:
+                    COALESCED_REQUESTS_TOTAL.inc()
+                    rpc_overhead = None
+                else:
+                    rpc_overhead = observe_timings(timings, rpc_seconds=rpc_seconds)
+                REQUEST_SECONDS.observe(rpc_seconds)
+                REQUESTS_TOTAL.labels(status="success").inc()
+                root_span.set_attributes({
+                    "image.id": image_id,
+                    "container.cold_start": bool(trace_info.get("cold_start")),
+                    "request.coalesced": shared,
+                })
+                if shared and trace_info.get("trace_id"):
+                    root_span.set_attribute("request.coalesced_with", trace_info["trace_id"])
+                
+                # Clients asking for image/png get the PNG bytes as they came
+                # from the GPU container, with the metadata in headers
+                if wants_png:
+                    return Response(
+                        content=result.images[0].png,
+                        media_type="image/png",
+                        headers={
+                            "X-Image-Id": image_id,
+                            "X-Seed": str(result.images[0].seed),
+                            "X-Trace-Id": trace_id,
+                            "X-Coalesced": str(shared).lower(),
+                        },
+                    )
+                
+                # Return both the URL and the base64-encoded image; the first
+                # image's encoding is reused for the top-level field
+                encoded = [image.base64_png for image in result.images]
+                return {
+                    "image_url": f"/images/{image_id}.png", 
+                    "base64_image": encoded[0],
+                    "status": "success",
+                    "timings": {**timings, "rpc_overhead": rpc_overhead},
+                    "trace_id": trace_id,
+                    "profile_url": f"/admin/profiles/{image_id}" if x_profile else None,
+                    "memory": result.memory,
+                    "model_id": result.model_id,
+                    "backend": result.backend,
+                    "quantization": result.quantization["mode"] if result.quantization is not None else None,
+                    "unet": result.unet,
+                    "hires": result.hires,
+                    "tiles": result.tiles,
+                    "coalesced": shared,
+                    "images": [
+                        {
+                            "image_id": os.path.splitext(os.path.basename(image.path))[0],
+                            "image_url": f"/images/{os.path.basename(image.path)}",
+                            "base64_image": base64_image,
+                            "seed": image.seed,
+                        }
+                        for image, base64_image in zip(result.images, encoded)
+                    ],
+                }
+            except Exception as e:
+                print(f"Error in generate_image.remote: {str(e)}")
+                raise
+            
+        except RequestTooExpensive as e:
+            ADMISSION_REJECTIONS_TOTAL.labels(reason="too_expensive").inc()
+            REQUESTS_TOTAL.labels(status="rejected").inc()
+            raise HTTPException(status_code=400, detail=str(e))
+        except AdmissionRejected as e:
+            print(f"Rejecting request, retry after {e.retry_after}s")
+            ADMISSION_REJECTIONS_TOTAL.labels(reason="saturated").inc()
+            REQUESTS_TOTAL.labels(status="rejected").inc()
+            raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
         except Exception as e:
-            print(f"Error in generate_image.remote: {str(e)}")
-            raise
+            print(f"Error in {span_name} endpoint: {str(e)}")
+            REQUESTS_TOTAL.labels(status="error").inc()
+            root_span.record_exception(e)
+            raise HTTPException(status_code=500, detail=str(e))
+
+@fastapi_app.post("/img2img")
+async def img2img(
+    request: Request,
+    prompt: str,
+    image: UploadFile = File(...),
+    strength: float = IMG2IMG_STRENGTH,
+    width: Optional[int] = None,
+    height: Optional[int] = None,
+    num_inference_steps: int = 30,
+    guidance_scale: float = 7.5,
+    negative_prompt: Optional[str] = None,
+    memory_profile: Optional[str] = None,
+    num_images: int = 1,
+    seed: Optional[int] = None,
+    seeds: Optional[List[int]] = Query(None),
+    x_profile: bool = Header(False),
+    x_admin_token: Optional[str] = Header(None),
+    x_api_key: Optional[str] = Header(None),
+    accept: Optional[str] = Header(None),
+):
+    """
+    Generate an image from an input image and a text prompt.
+    
+    The input image is uploaded as multipart form data; the other parameters
+    are query parameters, as for /generate.
+    
+    Args:
+        request: The incoming request, used to identify anonymous clients
+        prompt: The text prompt to generate an image from
+        image: The input image (PNG, JPEG, WebP, ...)
+        strength: Fraction of the schedule run on top of the input image; 1
+            ignores it entirely, lower values stay closer to it and run
+            proportionally fewer steps
+        width: Optional width to generate at, given together with height;
+            defaults to the input's, scaled down to about a megapixel
+        height: Optional height to generate at, given together with width;
+            defaults to the input's
+        num_inference_steps: Number of denoising steps of a full schedule
+        guidance_scale: Guidance scale for the diffusion process
+        negative_prompt: Optional text describing what the image should not contain
+        memory_profile: Optional memory profile name (see utils.memory), or "auto"
+        num_images: Number of images to generate from the input in one batch
+        seed: Optional base seed; image i uses seed + i
+        seeds: Optional list with one seed per image (repeat the query parameter)
+        x_profile: Privileged flag (X-Profile header) to profile this request
+        x_admin_token: Admin token (X-Admin-Token header), required for profiling
+        x_api_key: Optional API key (X-API-Key header) identifying the client
+        accept: Accept header; "image/png" returns the raw image instead of JSON,
+            for single-image requests only
+    
+    Returns:
+        The same response as /generate
+    """
+    return await serve_edit(
+        "img2img", request, image, None, prompt, strength, width, height, num_inference_steps, guidance_scale,
+        negative_prompt, memory_profile, num_images, seed, seeds, x_profile, x_admin_token, x_api_key, accept,
+    )
+
+@fastapi_app.post("/inpaint")
+async def inpaint(
+    request: Request,
+    prompt: str,
+    image: UploadFile = File(...),
+    mask: UploadFile = File(...),
+    strength: float = INPAINT_STRENGTH,
+    width: Optional[int] = None,
+    height: Optional[int] = None,
+    num_inference_steps: int = 30,
+    guidance_scale: float = 7.5,
+    negative_prompt: Optional[str] = None,
+    memory_profile: Optional[str] = None,
+    num_images: int = 1,
+    seed: Optional[int] = None,
+    seeds: Optional[List[int]] = Query(None),
+    x_profile: bool = Header(False),
+    x_admin_token: Optional[str] = Header(None),
+    x_api_key: Optional[str] = Header(None),
+    accept: Optional[str] = Header(None),
+):
+    """
+    Regenerate the masked area of an input image from a text prompt.
+    
+    The input image and mask are uploaded as multipart form data; the other
+    parameters are query parameters, as for /generate.
+    
+    Args:
+        request: The incoming request, used to identify anonymous clients
+        prompt: The text prompt describing the masked area
+        image: The input image (PNG, JPEG, WebP, ...)
+        mask: The mask; white areas are regenerated and black areas kept
+        strength: Fraction of the schedule run on the masked area; 1 (the
+            default) regenerates it from pure noise
+        width: Optional width to generate at, given together with height;
+            defaults to the input's, scaled down to about a megapixel
+        height: Optional height to generate at, given together with width;
+            defaults to the input's
+        num_inference_steps: Number of denoising steps of a full schedule
+        guidance_scale: Guidance scale for the diffusion process
+        negative_prompt: Optional text describing what the image should not contain
+        memory_profile: Optional memory profile name (see utils.memory), or "auto"
+        num_images: Number of images to generate from the input in one batch
+        seed: Optional base seed; image i uses seed + i
+        seeds: Optional list with one seed per image (repeat the query parameter)
+        x_profile: Privileged flag (X-Profile header) to profile this request
+        x_admin_token: Admin token (X-Admin-Token header), required for profiling
+        x_api_key: Optional API key (X-API-Key header) identifying the client
+        accept: Accept header; "image/png" returns the raw image instead of JSON,
+            for single-image requests only
+    
+    Returns:
+        The same response as /generate
+    """
+    return await serve_edit(
+        "inpaint", request, image, mask, prompt, strength, width, height, num_inference_steps, guidance_scale,
+        negative_prompt, memory_profile, num_images, seed, seeds, x_profile, x_admin_token, x_api_key, accept,
+    )
+
+async def serve_edit(
+    span_name, request, image_upload, mask_upload, prompt, strength, width, height, num_inference_steps,
+    guidance_scale, negative_prompt, memory_profile, num_images, seed, seeds, x_profile, x_admin_token,
+    x_api_key, accept,
+):
+    """
+    Read the uploads of an /img2img or /inpaint request and run it.
+    
+    The uploads are read in chunks and decoded in a worker thread, so large
+    images don't hold up the event loop. The decoded images only validate
+    the input and give the default size; the encoded bytes are what the GPU
+    container receives, since they are much smaller.
+    
+    Args:
+        span_name: The name of the request's root span
+        request: The incoming request
+        image_upload: The uploaded input image
+        mask_upload: The uploaded mask, or None for img2img
+        The other arguments are those of the /img2img and /inpaint endpoints
+    
+    Returns:
+        The same response as /generate
+    """
+    wants_png = check_request(x_profile, x_admin_token, memory_profile, num_images, seeds, accept)
+    if not 0 < strength <= 1:
+        raise HTTPException(status_code=400, detail="strength must be greater than 0 and at most 1")
+    if denoising_steps(num_inference_steps, strength) < 1:
+        raise HTTPException(status_code=400, detail="strength is too low to run any denoising steps")
+    if (width is None) != (height is None):
+        raise HTTPException(status_code=400, detail="Give both width and height, or neither")
+    
+    try:
+        init_image = await read_upload(image_upload)
+        input_image = await asyncio.to_thread(decode_image, init_image)
+        mask_image = None
+        if mask_upload is not None:
+            mask_image = await read_upload(mask_upload)
+            await asyncio.to_thread(decode_image, mask_image, "L")
+    except InvalidImage as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if width is None:
+        width, height = edit_size(*input_image.size)
+    
+    # Rejected requests count too: they are demand the warm pool should have met
+    if WARM_POOL_ENABLED:
+        record_arrival()
+    
+    # Only the truncated schedule runs, so that is what the client is charged for
+    steps = denoising_steps(num_inference_steps, strength)
+    client = charge_client(request, x_api_key, estimate_cost(width, height, steps, num_images=num_images))
+    
+    params = {
+        "prompt": prompt,
+        "width": width,
+        "height": height,
+        "num_inference_steps": num_inference_steps,
+        "guidance_scale": guidance_scale,
+        "negative_prompt": negative_prompt,
+        "memory_profile": memory_profile,
+        "num_images": num_images,
+        "seed": seed,
+        "seeds": seeds,
+        "init_image": init_image,
+        "mask_image": mask_image,
+        "strength": strength,
+    }
+    return await serve_generation(span_name, params, client, x_profile, wants_png)
+
+async def run_generation(params, trace_id, client, profile=False):
+    """
+    Generate one image on the GPU container.
+    
+    Args:
+        params: The generation parameters accepted by StableDiffusionModel.generate_image
+        trace_id: The trace id of the request that started the generation
+        client: The Client the generation is queued for
+        profile: Whether to run the generation under the profiler
+    
+    Returns:
+        The id of the generated image and the result of generate_image
+    
+    Raises:
+        RequestTooExpensive: If the request exceeds the per-request cost budget
+        AdmissionRejected: If the service is saturated
+    """
+    # Generate a unique ID for this image
+    image_id = str(uuid.uuid4())
+    image_path = f"{VOLUME_PATH}/{image_id}.png"
+    print(f"Image will be saved to: {image_path}")
+    
+    # Wait for GPU budget; raises if the request is too expensive or the queue is full
+    # img2img and inpainting only run the part of the schedule given by strength
+    num_images = params.get("num_images", 1)
+    steps = params["num_inference_steps"]
+    if params.get("init_image") is not None:
+        steps = denoising_steps(steps, params["strength"])
+    cost = estimate_cost(params["width"], params["height"], steps, num_images=num_images)
+    if params.get("tiled"):
+        cost *= tile_coverage(params["width"], params["height"])
+    kind = request_kind(params)
+    hires = None
+    if kind == "hires":
+        hires = hires_plan(params["width"], params["height"], steps, params["hires_scale"], params.get("hires_strength"))
+    estimate = estimate_latency(params["width"], params["height"], steps, num_images, kind, hires)
+    start = time.perf_counter()
+    
+    # Encode the prompt on the CPU workers before taking GPU budget, so the
+    # encoding overlaps with other requests' denoising
+    encoded = None
+    if REMOTE_TEXT_ENCODING:
+        encode_start = time.perf_counter()
+        encoded = await text_encoder.encode.remote.aio(
+            params["prompt"], params.get("negative_prompt"), params["guidance_scale"]
+        )
+        encode_seconds = time.perf_counter() - encode_start
+    
+    queued = time.perf_counter()
+    async with admission.admit(cost, client.name, client.lane, tiled=bool(params.get("tiled"))):
+        admitted = time.perf_counter()
+        result = await sd_model.generate_image.remote.aio(
+            **params,
+            output_path=image_path,
+            trace_id=trace_id,
+            submitted_at_ns=time.time_ns(),
+            profile_request_id=image_id if profile else None,
+            embeddings=encoded["embeddings"] if encoded is not None else None,
+        )
+    
+    if encoded is not None:
+        # Report the encoding as a stage of the request and the GPU memory it saved
+        result.timings["stages"]["text_encoding"] = encode_seconds
+        result.timings["total"] += encode_seconds
+        result.memory["text_encoders_offloaded_bytes"] = encoded["encoder_bytes"]
+        result.memory["embeddings_cached"] = encoded["cached"]
+    
+    # Profiling slows a request down and tiled ones denoise overlapping tiles,
+    # so they don't train the latency model. Each kind of request is fitted
+    # separately, and hires passes are observed at the sizes and steps they
+    # ran; compiled mode runs hires requests as plain ones
+    seconds = time.perf_counter() - start
+    observe_prediction(estimate["seconds"], seconds)
+    result.timings["predicted"] = estimate["seconds"]
+    if kind == "hires" and result.hires is None:
+        kind = "txt2img"
+    if not profile and result.tiles is None:
+        latency_model.observe(
+            result.model_id,
+            params["width"],
+            params["height"],
+            steps,
+            result.timings["stages"],
+            seconds - (admitted - queued),
+            num_images=num_images,
+            kind=kind,
+            hires=result.hires,
+        )
+        if latency_model.observations % LATENCY_SAVE_INTERVAL == 0:
+            run_in_background(latency_state.put.aio("model", latency_model.to_dict()), "save the latency model")
+    return image_id, result
+
+class BatchItem(BaseModel):
+    """One item of a batch generation request."""
+    prompt: str
+    width: int = 1024
+    height: int = 1024
+    num_inference_steps: int = 30
+    guidance_scale: float = 7.5
+    negative_prompt: Optional[str] = None
+    seed: Optional[int] = None
+
+class BatchRequest(BaseModel):
+    """A batch generation request: new items, or the id of a batch to resume."""
+    items: Optional[List[BatchItem]] = None
+    batch_id: Optional[str] = None
+
+@fastapi_app.post("/generate/batch")
+async def generate_batch(body: BatchRequest, request: Request, x_api_key: Optional[str] = Header(None)):
+    """
+    Generate a batch of images, streaming results back as they finish.
+    
+    Items are fanned out across the GPU containers and every finished item is
+    written to the batch's results log. Resubmitting with the returned
+    batch_id (and no items) resumes the batch, skipping items that already
+    succeeded and retrying those that failed.
+    
+    Args:
+        body: The items to generate, or the batch_id of a batch to resume
+        request: The incoming request, used to identify anonymous clients
+        x_api_key: Optional API key (X-API-Key header) identifying the client
+    
+    Returns:
+        An NDJSON stream: a header line, one line per item in completion
+        order, and a summary line
+    """
+    try:
+        client = identify_client(x_api_key, request.client.host if request.client else "unknown", api_keys)
+    except UnknownApiKey as e:
+        raise HTTPException(status_code=401, detail=str(e))
+    # Batch work always runs in the batch lane
+    client = Client(client.name, "batch", client.rate, client.burst)
+    
+    if body.batch_id is not None:
+        if not batch_store.exists(body.batch_id):
+            volume.reload()
+        if not batch_store.exists(body.batch_id):
+            raise HTTPException(status_code=404, detail=f"Batch not found: {body.batch_id}")
+        batch_id = body.batch_id
+        items = batch_store.load_items(batch_id)
+    else:
+        if not body.items:
+            raise HTTPException(status_code=400, detail="A batch needs items or a batch_id to resume")
+        if len(body.items) > MAX_BATCH_ITEMS:
+            raise HTTPException(status_code=400, detail=f"A batch can have at most {MAX_BATCH_ITEMS} items")
+        items = [item.model_dump() for item in body.items]
+        batch_id = batch_store.create(items)
+    
+    previous = batch_store.results(batch_id)
+    pending = [index for index in range(len(items)) if previous.get(index, {}).get("status") != "success"]
+    print(f"Batch {batch_id}: {len(items)} items, {len(pending)} to generate")
+    
+    return StreamingResponse(
+        stream_batch(batch_id, items, pending, client),
+        media_type="application/x-ndjson",
+    )
+
+async def stream_batch(batch_id, items, pending, client):
+    """
+    Run the pending items of a batch and yield NDJSON lines as they finish.
+    
+    Args:
+        batch_id: The id of the batch
+        items: All items of the batch
+        pending: The indexes of the items to generate
+        client: The Client the batch is charged to
+    """
+    yield json.dumps({
+        "batch_id": batch_id,
+        "total": len(items),
+        "pending": len(pending),
+        "skipped": len(items) - len(pending),
+        "estimated_seconds": estimate_batch_seconds([items[index] for index in pending]),
+        "queue_depth": admission.queue_depth,
+    }) + "\n"
+    
+    queue = asyncio.Queue()
+    for index in pending:
+        queue.put_nowait(index)
+    results = asyncio.Queue()
+    
+    with get_tracer().start_as_current_span("generate_batch") as batch_span:
+        trace_id = format_trace_id(batch_span)
+        batch_span.set_attributes({"batch.id": batch_id, "batch.pending": len(pending)})
+        
+        async def worker():
+            while True:
+                try:
+                    index = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                item = items[index]
+                params = {**item, "memory_profile": None}
+                cost = estimate_cost(item["width"], item["height"], item["num_inference_steps"])
+                try:
+                    # Batches wait for their rate limit and for GPU budget rather than failing
+                    while True:
+                        try:
+                            rate_limiter.consume(client, cost)
+                            break
+                        except RateLimited as e:
+                            await asyncio.sleep(e.retry_after)
+                    while True:
+                        try:
+                            image_id, _ = await run_generation(params, trace_id, client)
+                            break
+                        except AdmissionRejected as e:
+                            await asyncio.sleep(e.retry_after)
+                    record = {"index": index, "status": "success", "image_url": f"/images/{image_id}.png"}
+                except Exception as e:
+                    print(f"Batch {batch_id} item {index} failed: {str(e)}")
+                    record = {"index": index, "status": "error", "error": str(e)}
+                await results.put(record)
         
-    except Exception as e:
-        print(f"Error in generate_image endpoint: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+        workers = [asyncio.create_task(worker()) for _ in range(min(BATCH_CONCURRENCY, len(pending)))]
+        succeeded = failed = 0
+        try:
+            for finished in range(1, len(pending) + 1):
+                record = await results.get()
+                await asyncio.to_thread(batch_store.append, batch_id, record)
+                if record["status"] == "success":
+                    succeeded += 1
+                else:
+                    failed += 1
+                if finished % BATCH_COMMIT_INTERVAL == 0:
+                    await volume.commit.aio()
+                yield json.dumps(record) + "\n"
+        finally:
+            # Stop submitting work if the client went away; finished items are already logged
+            for task in workers:
+                task.cancel()
+            await volume.commit.aio()
+    
+    yield json.dumps({
+        "batch_id": batch_id,
+        "done": True,
+        "succeeded": succeeded,
+        "failed": failed,
+        # Items a resumed batch would generate again
+        "remaining": len(pending) - succeeded,
+    }) + "\n"
+
+@fastapi_app.get("/generate/batch/{batch_id}")
+async def get_batch(batch_id: str):
+    """
+    Get the progress of a batch.
+    
+    Args:
+        batch_id: The id of the batch
+    
+    Returns:
+        Item counts by state, the predicted seconds until the remaining items
+        are done and the current queue depth
+    """
+    if not batch_store.exists(batch_id):
+        volume.reload()
+    if not batch_store.exists(batch_id):
+        raise HTTPException(status_code=404, detail=f"Batch not found: {batch_id}")
+    status = batch_store.status(batch_id)
+    finished = batch_store.results(batch_id)
+    remaining = [item for index, item in enumerate(batch_store.load_items(batch_id)) if index not in finished]
+    status["estimated_seconds"] = estimate_batch_seconds(remaining)
+    status["queue_depth"] = admission.queue_depth
+    return status
+
+def require_admin(token: Optional[str]):
+    """
+    Check the admin token of a privileged request.
+    
+    Args:
+        token: The token sent by the client
+    
+    Raises:
+        HTTPException: If admin features are disabled or the token is wrong
+    """
+    if not ADMIN_TOKEN or token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+@fastapi_app.get("/admin/profiles/{request_id}")
+async def get_profile(request_id: str, x_admin_token: Optional[str] = Header(None)):
+    """
+    Download the profile captured for a request.
+    
+    Args:
+        request_id: The id of the profiled request (the image id)
+        x_admin_token: Admin token (X-Admin-Token header)
+    
+    Returns:
+        The Chrome trace (.json) or cProfile stats (.prof) file. Profiles
+        cover the whole GPU container while the request ran, including other
+        requests in flight, as the X-Profile-Scope header says
+    """
+    require_admin(x_admin_token)
+    profile_path = find_profile(PROFILES_PATH, request_id)
+    if profile_path is None:
+        # The profile may have been committed by the GPU container after this one mounted the volume
+        volume.reload()
+        profile_path = find_profile(PROFILES_PATH, request_id)
+    if profile_path is None:
+        raise HTTPException(status_code=404, detail=f"Profile not found: {request_id}")
+    
+    return FileResponse(
+        profile_path,
+        filename=os.path.basename(profile_path),
+        headers={"X-Profile-Scope": "container"},
+    )
+
+@fastapi_app.get("/estimate")
+async def get_estimate(
+    width: int = 1024,
+    height: int = 1024,
+    num_inference_steps: int = 30,
+    num_images: int = 1,
+    kind: str = "txt2img",
+    strength: Optional[float] = None,
+    hires_scale: float = 1.0,
+    hires_strength: Optional[float] = None,
+):
+    """
+    Predict how long a generation request with these parameters would take now.
+    
+    Args:
+        width: The width of the generated image
+        height: The height of the generated image
+        num_inference_steps: Number of denoising steps
+        num_images: Number of images generated from the prompt
+        kind: The kind of request: txt2img, img2img, inpaint or hires
+        strength: Fraction of the schedule img2img and inpainting requests
+            run; defaults to that of /img2img or /inpaint
+        hires_scale: The hires_scale of a hires request, above 1
+        hires_strength: The hires_strength of a hires request
+    
+    Returns:
+        The predicted seconds in total, waiting for admission and running,
+        the per-stage prediction, its basis and the current queue depth
+    """
+    if not 1 <= num_images <= MAX_IMAGES_PER_REQUEST:
+        raise HTTPException(status_code=400, detail=f"num_images must be between 1 and {MAX_IMAGES_PER_REQUEST}")
+    if kind not in REQUEST_KINDS:
+        raise HTTPException(status_code=400, detail=f"kind must be one of: {', '.join(REQUEST_KINDS)}")
+    
+    # Estimate the steps and passes the request would actually run
+    steps, hires = num_inference_steps, None
+    if kind in ("img2img", "inpaint"):
+        if strength is None:
+            strength = IMG2IMG_STRENGTH if kind == "img2img" else INPAINT_STRENGTH
+        if not 0 < strength <= 1:
+            raise HTTPException(status_code=400, detail="strength must be greater than 0 and at most 1")
+        steps = denoising_steps(num_inference_steps, strength)
+    elif kind == "hires":
+        if not 1 < hires_scale <= MAX_HIRES_SCALE:
+            raise HTTPException(status_code=400, detail=f"hires estimates need a hires_scale above 1 and at most {MAX_HIRES_SCALE}")
+        if hires_strength is not None and not 0 < hires_strength <= 1:
+            raise HTTPException(status_code=400, detail="hires_strength must be greater than 0 and at most 1")
+        hires = hires_plan(width, height, num_inference_steps, hires_scale, hires_strength)
+    return estimate_latency(width, height, steps, num_images, kind, hires)
+
+@fastapi_app.get("/ready")
+async def ready():
+    """
+    Report whether a GPU container with a loaded pipeline is up.
+    
+    Returns:
+        The number of warm containers, and the warm pool controller's latest
+        target and forecast; the status is 503 while no container is warm
+    """
+    count = await warm_containers.len.aio()
+    decision = await warm_pool_state.get.aio("decision")
+    return JSONResponse(
+        status_code=200 if count > 0 else 503,
+        content={
+            "ready": count > 0,
+            "warm_containers": count,
+            "warm_pool_enabled": WARM_POOL_ENABLED,
+            "warm_pool": decision,
+        },
+    )
+
+@fastapi_app.get("/metrics")
+async def metrics():
+    """
+    Expose the request and stage metrics in the Prometheus text format.
+    
+    Returns:
+        The current metric values
+    """
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 @fastapi_app.get("/images/{image_id}")
 async def get_image(image_id: str):
@@ -727,6 +2643,56 @@ async def get_image(image_id: str):
     
     return FileResponse(image_path)
 
+# Resizes the pool of warm GPU containers; scheduled when SD_WARM_POOL=1
+@app.function(
+    image=image,
+    volumes={VOLUME_PATH: volume},
+    schedule=modal.Period(seconds=WARM_POOL_INTERVAL) if WARM_POOL_ENABLED else None,
+)
+def control_warm_pool():
+    """
+    Forecast demand from the recorded arrivals and set the warm pool size.
+    
+    The forecaster state is kept in the warm pool Dict between runs, and the
+    arrivals are appended to a daily trace on the images volume that
+    simulate_warm_pool.py can replay.
+    
+    Returns:
+        The decision: the target pool size, the forecast rate and the number of new arrivals
+    """
+    from utils.warmpool import DemandForecaster, ForecastPolicy
+    
+    now = time.time()
+    arrivals = []
+    while True:
+        chunk = arrival_queue.get_many(1000, block=False)
+        if not chunk:
+            break
+        arrivals.extend(chunk)
+    
+    state = warm_pool_state.get("forecaster")
+    forecaster = DemandForecaster.from_dict(state) if state is not None else DemandForecaster()
+    target = ForecastPolicy(forecaster)(arrivals, now)
+    sd_model.keep_warm(target)
+    
+    decision = {
+        "target": target,
+        "rate_per_minute": forecaster.predict(now) * 60,
+        "arrivals": len(arrivals),
+        "updated_at": now,
+    }
+    warm_pool_state.put("forecaster", forecaster.to_dict())
+    warm_pool_state.put("decision", decision)
+    print(f"Warm pool: {len(arrivals)} arrivals, {decision['rate_per_minute']:.2f}/min forecast, keeping {target} warm")
+    
+    if arrivals:
+        os.makedirs(WARM_POOL_PATH, exist_ok=True)
+        trace_path = f"{WARM_POOL_PATH}/arrivals-{time.strftime('%Y%m%d', time.gmtime(now))}.txt"
+        with open(trace_path, "a") as f:
+            f.writelines(f"{arrival:.3f}\n" for arrival in sorted(arrivals))
+        volume.commit()
+    return decision
+
 # Mount the FastAPI app to Modal
 @app.function(
     image=image, 
@@ -734,12 +2700,16 @@ async def get_image(image_id: str):
         VOLUME_PATH: volume,
         MODEL_VOLUME_PATH: model_volume
     },
-    secrets=[hf_secret] if hf_secret is not None else []
+    secrets=[secret for secret in (hf_secret, admin_secret) if secret is not None]
 )
+# One web container serves many requests concurrently, so coalescing and
+# admission control see the traffic together
+@modal.concurrent(max_inputs=WEB_CONCURRENT_INPUTS)
 @modal.asgi_app()
 def serve_app():
     # Create directories before serving the app
     create_directories.remote()
+    restore_latency_model()
     return fastapi_app
 
 if __name__ == "__main__":
@@ -0,0 +1,797 @@
+#!/usr/bin/env python
+# benchmark.py - Benchmark suite for the Stable Diffusion application
+#
+# Usage: modal run benchmark.py --suite memory
+
+import base64
+import io
+import json
+import math
+import os
+import pickle
+import statistics
+import time
+import uuid
+
+import modal
+
+from app import (
+    app,
+    ensure_in_store,
+    hf_secret,
+    image,
+    load_sdxl_pipeline,
+    model_volume,
+    MODEL_VOLUME_PATH,
+    StableDiffusionModel,
+    TENSOR_STORE_PATH,
+    TextEncoder,
+    VOLUME_PATH,
+)
+from utils.memory import MEMORY_PROFILES
+from utils.onnx_backend import ONNX_ENABLED
+from utils.pipelining import PIPELINE_ENABLED
+from utils.text_encoding import REMOTE_TEXT_ENCODING
+
+BENCHMARK_PROMPT = "A lighthouse on a rocky coast at sunset, dramatic clouds, highly detailed digital painting"
+
+# Square resolutions exercised by the benchmarks
+BENCHMARK_SIZES = [768, 1024, 1536]
+
+
+def benchmark_output_path():
+    """
+    Get a fresh output path on the images volume for a benchmark image.
+
+    Returns:
+        The output path
+    """
+    return f"{VOLUME_PATH}/benchmarks/{uuid.uuid4()}.png"
+
+
+def warm_up(model, steps):
+    """
+    Run one small generation so the pipeline load isn't attributed to the first case.
+
+    Args:
+        model: The StableDiffusionModel handle
+        steps: Number of denoising steps
+    """
+    print("Warming up...")
+    model.generate_image.remote(
+        prompt=BENCHMARK_PROMPT,
+        output_path=benchmark_output_path(),
+        width=512,
+        height=512,
+        num_inference_steps=steps,
+    )
+
+
+def generation_seconds(result):
+    """
+    Get the time a generation took, excluding pipeline acquisition.
+
+    Args:
+        result: The GenerationResult returned by generate_image
+
+    Returns:
+        The generation time in seconds
+    """
+    timings = result.timings
+    return timings["total"] - timings["stages"].get("pipeline_acquisition", 0.0)
+
+
+def benchmark_memory(model, steps):
+    """
+    Measure wall time and peak GPU memory of each memory profile at each resolution.
+
+    Args:
+        model: The StableDiffusionModel handle
+        steps: Number of denoising steps
+
+    Returns:
+        A list of result rows
+    """
+    rows = []
+    for size in BENCHMARK_SIZES:
+        for profile in MEMORY_PROFILES:
+            print(f"Memory profile {profile} at {size}x{size}...")
+            row = {"profile": profile, "size": size}
+            try:
+                result = model.generate_image.remote(
+                    prompt=BENCHMARK_PROMPT,
+                    output_path=benchmark_output_path(),
+                    width=size,
+                    height=size,
+                    num_inference_steps=steps,
+                    memory_profile=profile,
+                )
+                row["seconds"] = generation_seconds(result)
+                row["peak_gb"] = result.memory["peak_bytes"] / 1024 ** 3
+            except Exception as e:
+                # Out-of-memory is an expected outcome for the faster profiles at large sizes
+                print(f"Failed: {str(e)}")
+                row["error"] = str(e)
+            rows.append(row)
+    return rows
+
+
+def benchmark_compile(model, steps):
+    """
+    Report compile time, cache usage and per-bucket speedups of compiled mode.
+
+    The measurements are taken by the container's warmup, so the suite must be
+    run with SD_COMPILE=1 set. Run it twice to see the persistent cache at work:
+    the second container start should report cache hits and little compile time.
+
+    Args:
+        model: The StableDiffusionModel handle
+        steps: Unused; the warmup uses SD_COMPILE_WARMUP_STEPS
+
+    Returns:
+        A list of result rows
+    """
+    report = model.get_compile_report.remote()
+    if report is None:
+        raise SystemExit("Compiled mode is off; run with SD_COMPILE=1")
+
+    print(f"Compile mode: {report['mode']}")
+    print(f"Total compile time: {report['compile_seconds']:.2f}s")
+    print(f"FX graph cache: {report['cache']['hits']} hits, {report['cache']['misses']} misses")
+    return report["buckets"]
+
+
+def benchmark_text_encoding(model, steps):
+    """
+    Measure end-to-end latency and peak GPU memory with and without remote text encoding.
+
+    Run the suite once with SD_REMOTE_TEXT_ENCODING=1 and once without to
+    compare. With remote encoding each prompt is sent twice, so the second
+    row shows the latency with the embeddings served from the encoder's cache.
+
+    Args:
+        model: The StableDiffusionModel handle
+        steps: Number of denoising steps
+
+    Returns:
+        A list of result rows
+    """
+    encoder = TextEncoder() if REMOTE_TEXT_ENCODING else None
+    prompts = [BENCHMARK_PROMPT, "A red fox in a snowy forest, watercolor"]
+    rows = []
+    for prompt in prompts:
+        for attempt in range(2 if REMOTE_TEXT_ENCODING else 1):
+            print(f"Prompt {prompt[:30]!r}, attempt {attempt + 1}...")
+            row = {"mode": "remote" if REMOTE_TEXT_ENCODING else "local", "prompt": prompt[:30]}
+            start = time.perf_counter()
+            embeddings = None
+            if encoder is not None:
+                encoded = encoder.encode.remote(prompt)
+                embeddings = encoded["embeddings"]
+                row["cached"] = encoded["cached"]
+                row["encode_seconds"] = time.perf_counter() - start
+                row["gpu_gb_saved"] = encoded["encoder_bytes"] / 1024 ** 3
+            result = model.generate_image.remote(
+                prompt=prompt,
+                output_path=benchmark_output_path(),
+                num_inference_steps=steps,
+                embeddings=embeddings,
+            )
+            row["gpu_prompt_encoding"] = result.timings["stages"]["prompt_encoding"]
+            row["end_to_end_seconds"] = time.perf_counter() - start
+            row["peak_gb"] = result.memory["peak_bytes"] / 1024 ** 3
+            rows.append(row)
+    return rows
+
+
+def benchmark_pipelining(model, steps, count=12):
+    """
+    Measure sustained throughput of one GPU container under back-to-back load.
+
+    All requests are submitted at once to a single container, so its input
+    queue never runs dry. Run the suite with SD_PIPELINE=1 (the default) and
+    SD_PIPELINE=0 to compare pipelined post-processing with running every
+    stage in sequence.
+
+    Args:
+        model: Unused; the suite uses its own single-container handle
+        steps: Number of denoising steps
+        count: Number of requests to submit
+
+    Returns:
+        A list with one result row
+    """
+    single = StableDiffusionModel.with_options(max_containers=1)()
+    warm_up(single, steps)
+
+    print(f"Submitting {count} requests...")
+    start = time.perf_counter()
+    calls = [
+        single.generate_image.spawn(
+            prompt=f"{BENCHMARK_PROMPT}, variation {i}",
+            output_path=benchmark_output_path(),
+            num_inference_steps=steps,
+            seed=i,
+        )
+        for i in range(count)
+    ]
+    results = [call.get() for call in calls]
+    seconds = time.perf_counter() - start
+
+    def mean_stage(name):
+        return sum(result.timings["stages"].get(name, 0.0) for result in results) / count
+
+    return [{
+        "pipelined": PIPELINE_ENABLED,
+        "requests": count,
+        "seconds": seconds,
+        "images_per_minute": count / seconds * 60,
+        "mean_latency": sum(result.timings["total"] for result in results) / count,
+        "mean_gpu_wait": mean_stage("gpu_wait"),
+        "mean_denoise": mean_stage("denoise"),
+        "mean_vae_decode": mean_stage("vae_decode"),
+        "mean_image_encode": mean_stage("image_encode"),
+    }]
+
+
+@app.function(image=image)
+def echo(payload):
+    """Return the payload unchanged, to time a round trip through Modal's RPC."""
+    return payload
+
+
+def legacy_result(result):
+    """
+    Convert a GenerationResult into the dictionary generate_image used to return.
+
+    Args:
+        result: The GenerationResult
+
+    Returns:
+        The same result with base64-encoded images in plain dictionaries
+    """
+    images = [
+        {"path": image.path, "base64_image": base64.b64encode(image.png).decode(), "seed": image.seed}
+        for image in result.images
+    ]
+    return {
+        "path": images[0]["path"],
+        "base64_image": images[0]["base64_image"],
+        "images": images,
+        "timings": result.timings,
+        "trace": result.trace,
+        "profile_path": result.profile_path,
+        "memory": result.memory,
+        "compile": result.compile,
+    }
+
+
+def benchmark_rpc_payload(model, steps, round_trips=20):
+    """
+    Compare the serialised size and RPC round-trip time of the old and new generation results.
+
+    One real 1024x1024 result is generated, converted to the old dictionary
+    with base64 images, and both forms are pickled and echoed through a
+    Modal function.
+
+    Args:
+        model: The StableDiffusionModel handle
+        steps: Number of denoising steps
+        round_trips: Number of echo calls timed per form
+
+    Returns:
+        A list of result rows
+    """
+    result = model.generate_image.remote(
+        prompt=BENCHMARK_PROMPT,
+        output_path=benchmark_output_path(),
+        num_inference_steps=steps,
+    )
+    echo.remote(None)
+
+    rows = []
+    for name, payload in [("dict_base64", legacy_result(result)), ("typed_bytes", result)]:
+        print(f"Timing {name}...")
+        times = []
+        for _ in range(round_trips):
+            start = time.perf_counter()
+            echo.remote(payload)
+            times.append(time.perf_counter() - start)
+        rows.append({
+            "payload": name,
+            "pickled_bytes": len(pickle.dumps(payload)),
+            "median_round_trip": statistics.median(times),
+            "min_round_trip": min(times),
+        })
+    return rows
+
+
+def psnr(png, reference_png):
+    """
+    Compare two PNG images by their peak signal-to-noise ratio.
+
+    Args:
+        png: The PNG bytes of the image to score
+        reference_png: The PNG bytes of the reference image
+
+    Returns:
+        The PSNR in dB, or infinity for identical images
+    """
+    from PIL import Image, ImageChops, ImageStat
+
+    image = Image.open(io.BytesIO(png)).convert("RGB")
+    reference = Image.open(io.BytesIO(reference_png)).convert("RGB")
+    mse = statistics.mean(rms ** 2 for rms in ImageStat.Stat(ImageChops.difference(image, reference)).rms)
+    return math.inf if mse == 0 else 20 * math.log10(255 / math.sqrt(mse))
+
+
+def benchmark_step_cache(model, steps, intervals=(1, 2, 3, 5)):
+    """
+    Measure the denoise time, UNet work and image quality of each step cache interval.
+
+    Every interval generates the same image from the same seed; quality is
+    the PSNR against the image generated without step caching.
+
+    Args:
+        model: The StableDiffusionModel handle
+        steps: Number of denoising steps
+        intervals: The cache intervals to compare
+
+    Returns:
+        A list of result rows
+    """
+    rows = []
+    reference = None
+    baseline = None
+    for interval in intervals:
+        print(f"Cache interval {interval}...")
+        result = model.generate_image.remote(
+            prompt=BENCHMARK_PROMPT,
+            output_path=benchmark_output_path(),
+            num_inference_steps=steps,
+            seed=42,
+            cache_interval=interval,
+        )
+        png = result.images[0].png
+        denoise = result.timings["stages"]["denoise"]
+        if reference is None:
+            reference, baseline = png, denoise
+        rows.append({
+            "cache_interval": interval,
+            "denoise_seconds": denoise,
+            "speedup": baseline / denoise,
+            "full_calls": result.unet["full_calls"],
+            "block_calls": result.unet["block_calls"],
+            "blocks_skipped": result.unet["blocks_skipped"],
+            "psnr_db": psnr(png, reference),
+        })
+    return rows
+
+
+def benchmark_guidance(model, steps, cutoffs=(1.0, 0.75, 0.5, 0.25)):
+    """
+    Measure the denoise time, UNet work and image quality of each guidance cutoff.
+
+    Every cutoff generates the same image from the same seed; quality is the
+    PSNR against the image guided on every step. A last row runs with
+    guidance off altogether (guidance_scale 1), which skips the
+    unconditional pass on every step.
+
+    Args:
+        model: The StableDiffusionModel handle
+        steps: Number of denoising steps
+        cutoffs: The guidance cutoffs to compare
+
+    Returns:
+        A list of result rows
+    """
+    rows = []
+    reference = None
+    baseline = None
+    for guidance_scale, cutoff in [(7.5, cutoff) for cutoff in cutoffs] + [(1.0, 1.0)]:
+        print(f"Guidance scale {guidance_scale}, cutoff {cutoff}...")
+        result = model.generate_image.remote(
+            prompt=BENCHMARK_PROMPT,
+            output_path=benchmark_output_path(),
+            num_inference_steps=steps,
+            guidance_scale=guidance_scale,
+            seed=42,
+            guidance_cutoff=cutoff,
+        )
+        png = result.images[0].png
+        denoise = result.timings["stages"]["denoise"]
+        if reference is None:
+            reference, baseline = png, denoise
+        rows.append({
+            "guidance_scale": guidance_scale,
+            "guidance_cutoff": cutoff,
+            "denoise_seconds": denoise,
+            "speedup": baseline / denoise,
+            "unet_calls": result.unet["calls"],
+            "guided_calls": result.unet["guided_calls"],
+            "tflops": result.unet["flops"] / 1e12 if result.unet["flops"] is not None else None,
+            "psnr_db": psnr(png, reference),
+        })
+    return rows
+
+
+def benchmark_hires(model, steps, sizes=(1536, 2048), scales=(1.5, 2.0)):
+    """
+    Compare hires fix generation against generating directly at the target size.
+
+    Every case generates the same image from the same seed. Wall time is
+    measured around the remote call; generation time excludes pipeline
+    acquisition, and the denoising time covers both hires passes.
+
+    Args:
+        model: The StableDiffusionModel handle
+        steps: Number of denoising steps
+        sizes: The square target sizes
+        scales: The hires scales to compare at each size
+
+    Returns:
+        A list of result rows
+    """
+    rows = []
+    for size in sizes:
+        baseline = None
+        for scale in (1.0,) + tuple(scales):
+            print(f"{size}x{size} with hires scale {scale}...")
+            row = {"size": size, "hires_scale": scale}
+            try:
+                start = time.perf_counter()
+                result = model.generate_image.remote(
+                    prompt=BENCHMARK_PROMPT,
+                    output_path=benchmark_output_path(),
+                    width=size,
+                    height=size,
+                    num_inference_steps=steps,
+                    seed=42,
+                    hires_scale=scale,
+                )
+                row["wall_seconds"] = time.perf_counter() - start
+            except Exception as e:
+                # Direct generation at the largest sizes may run out of memory
+                print(f"Failed: {str(e)}")
+                row["error"] = str(e)
+                rows.append(row)
+                continue
+            stages = result.timings["stages"]
+            row["base_size"] = result.hires["base"][0] if result.hires else size
+            row["seconds"] = generation_seconds(result)
+            row["denoise_seconds"] = stages["denoise"] + stages.get("hires_refine", 0.0)
+            row["tflops"] = result.unet["flops"] / 1e12 if result.unet.get("flops") is not None else None
+            row["peak_gb"] = result.memory["peak_bytes"] / 1024 ** 3
+            if scale == 1.0:
+                baseline = row["wall_seconds"]
+            row["speedup"] = baseline / row["wall_seconds"] if baseline else None
+            rows.append(row)
+    return rows
+
+
+def benchmark_tiled(model, steps, sizes=(1024, 2048, 3072)):
+    """
+    Compare tiled generation against generating the whole canvas at once.
+
+    Peak memory of a tiled generation should stay flat as the size grows,
+    while generating at once grows with the pixels until it runs out of
+    memory.
+
+    Args:
+        model: The StableDiffusionModel handle
+        steps: Number of denoising steps
+        sizes: The square sizes to generate
+
+    Returns:
+        A list of result rows
+    """
+    rows = []
+    for size in sizes:
+        for tiled in (False, True):
+            print(f"{size}x{size} {'tiled' if tiled else 'at once'}...")
+            row = {"size": size, "tiled": tiled}
+            try:
+                start = time.perf_counter()
+                result = model.generate_image.remote(
+                    prompt=BENCHMARK_PROMPT,
+                    output_path=benchmark_output_path(),
+                    width=size,
+                    height=size,
+                    num_inference_steps=steps,
+                    seed=42,
+                    tiled=tiled,
+                )
+                row["wall_seconds"] = time.perf_counter() - start
+            except Exception as e:
+                # Generating the largest sizes at once is expected to run out of memory
+                print(f"Failed: {str(e)}")
+                row["error"] = str(e)
+                rows.append(row)
+                continue
+            stages = result.timings["stages"]
+            row["profile"] = result.memory["profile"]
+            row["tiles"] = result.tiles["tiles"] // steps if result.tiles else None
+            row["seconds"] = generation_seconds(result)
+            row["denoise_seconds"] = stages["denoise"]
+            row["decode_seconds"] = stages.get("vae_decode")
+            row["megapixels_per_second"] = size * size / 1_000_000 / row["seconds"]
+            row["peak_gb"] = result.memory["peak_bytes"] / 1024 ** 3
+            rows.append(row)
+    return rows
+
+
+def benchmark_onnx(model, steps, sizes=(768, 1024), runs=3):
+    """
+    Compare the per-stage latency of the ONNX Runtime backend with PyTorch.
+
+    Each backend runs in its own containers, selected with SD_BACKEND. Run
+    the suite with SD_BACKEND=onnx, so the generation image includes ONNX
+    Runtime; the torch containers override it. The ONNX containers export the checkpoint in SD_ONNX_PRECISION first unless
+    an export is cached; run `modal run app.py::export_onnx` beforehand to
+    keep the export out of the warmup. The first generation at each size is
+    discarded and the rest averaged.
+
+    Args:
+        model: Unused; the suite uses a handle per backend
+        steps: Number of denoising steps
+        sizes: The square sizes to generate
+        runs: Number of generations averaged at each size
+
+    Returns:
+        A list of result rows
+    """
+    if not ONNX_ENABLED:
+        raise SystemExit("The generation image only includes ONNX Runtime with the ONNX backend; run with SD_BACKEND=onnx")
+
+    stages = ("prompt_encoding", "denoise", "vae_decode")
+    baselines = {}
+    rows = []
+    for backend in ("torch", "onnx"):
+        secrets = [modal.Secret.from_dict({"SD_BACKEND": backend})]
+        if hf_secret is not None:
+            secrets.append(hf_secret)
+        handle = StableDiffusionModel.with_options(secrets=secrets)()
+        warm_up(handle, steps)
+        for size in sizes:
+            print(f"{backend} at {size}x{size}...")
+            results = [
+                handle.generate_image.remote(
+                    prompt=BENCHMARK_PROMPT,
+                    output_path=benchmark_output_path(),
+                    width=size,
+                    height=size,
+                    num_inference_steps=steps,
+                    seed=42,
+                )
+                for _ in range(runs + 1)
+            ][1:]
+            row = {"backend": results[0].backend, "size": size}
+            for stage in stages:
+                row[stage] = statistics.mean(result.timings["stages"][stage] for result in results)
+            row["seconds"] = statistics.mean(generation_seconds(result) for result in results)
+            if backend == "torch":
+                baselines[size] = row
+            else:
+                for stage in stages + ("seconds",):
+                    row[f"{stage}_speedup"] = baselines[size][stage] / row[stage]
+            rows.append(row)
+    return rows
+
+
+def benchmark_quantization(model, steps, size=1024, runs=3):
+    """
+    Compare weight memory, peak GPU memory and latency of the quantisation modes.
+
+    Each mode runs in its own containers, selected with SD_QUANTIZATION, on
+    the A10G and on the smaller T4. The first start of a mode quantises and
+    caches the weights; later starts read them from the models volume. The
+    first generation of each case is discarded and the rest averaged.
+    int8-dynamic only runs on CPU-only deployments (SD_GPU=cpu), so it isn't
+    part of the suite.
+
+    Args:
+        model: Unused; the suite uses a handle per GPU and mode
+        steps: Number of denoising steps
+        size: The square size to generate
+        runs: Number of generations averaged per case
+
+    Returns:
+        A list of result rows
+    """
+    stages = ("prompt_encoding", "denoise", "vae_decode")
+    baselines = {}
+    rows = []
+    for gpu in ("A10G", "T4"):
+        for mode in ("none", "int8-weight", "int4-weight"):
+            print(f"{mode} on {gpu}...")
+            secrets = [modal.Secret.from_dict({"SD_QUANTIZATION": mode})]
+            if hf_secret is not None:
+                secrets.append(hf_secret)
+            handle = StableDiffusionModel.with_options(gpu=gpu, secrets=secrets)()
+            row = {"gpu": gpu, "quantization": mode}
+            try:
+                warm_up(handle, steps)
+                results = [
+                    handle.generate_image.remote(
+                        prompt=BENCHMARK_PROMPT,
+                        output_path=benchmark_output_path(),
+                        width=size,
+                        height=size,
+                        num_inference_steps=steps,
+                        seed=42,
+                    )
+                    for _ in range(runs + 1)
+                ][1:]
+            except Exception as e:
+                # Full-precision SDXL may not fit the smaller GPU at all
+                print(f"Failed: {str(e)}")
+                row["error"] = str(e)
+                rows.append(row)
+                continue
+            report = results[0].quantization
+            if report is not None:
+                row["weight_gb"] = report["bytes"] / 1024 ** 3
+                row["quantized_weight_gb"] = report["quantized_bytes"] / 1024 ** 3
+                row["cached"] = report["cached"]
+                row["quantize_seconds"] = report["seconds"]
+            row["profile"] = results[0].memory["profile"]
+            row["peak_gb"] = max(result.memory["peak_bytes"] for result in results) / 1024 ** 3
+            for stage in stages:
+                row[stage] = statistics.mean(result.timings["stages"][stage] for result in results)
+            row["seconds"] = statistics.mean(generation_seconds(result) for result in results)
+            if mode == "none":
+                baselines[gpu] = row
+            elif gpu in baselines:
+                row["peak_saving_gb"] = baselines[gpu]["peak_gb"] - row["peak_gb"]
+                row["slowdown"] = row["seconds"] / baselines[gpu]["seconds"]
+            rows.append(row)
+    return rows
+
+
+@app.function(
+    image=image,
+    gpu="A10G",
+    memory=32768,
+    timeout=3600,
+    volumes={MODEL_VOLUME_PATH: model_volume},
+    secrets=[hf_secret] if hf_secret is not None else [],
+)
+def measure_store_loads():
+    """
+    Time loading each checkpoint on the models volume onto the GPU, from the file and from the tensor store.
+
+    Checkpoints missing from the store are ingested first. Store loads run
+    in checkpoint order with the previous pipeline still resident, the way
+    a model switch would, so components identical to its reuse its mapped
+    tensors rather than reading them again; each pipeline still moves its
+    own copy to the GPU.
+
+    Returns:
+        Per checkpoint the seconds of both loads and the components shared,
+        and the store's deduplication report
+    """
+    import torch
+    from utils.tensor_store import TensorStore
+
+    if "HF_TOKEN" in os.environ and os.environ["HF_TOKEN"]:
+        os.environ["HUGGING_FACE_HUB_TOKEN"] = os.environ["HF_TOKEN"]
+
+    store = TensorStore(TENSOR_STORE_PATH)
+    paths = [
+        os.path.join(MODEL_VOLUME_PATH, filename)
+        for filename in sorted(os.listdir(MODEL_VOLUME_PATH))
+        if filename.endswith(".safetensors")
+    ]
+    names = [ensure_in_store(store, path) for path in paths]
+
+    loads = []
+    for name, path in zip(names, paths):
+        start = time.perf_counter()
+        pipe = load_sdxl_pipeline(path, torch.float16, use_store=False).to("cuda")
+        torch.cuda.synchronize()
+        loads.append({"model": name, "single_file_seconds": time.perf_counter() - start})
+        del pipe
+        torch.cuda.empty_cache()
+
+    previous = None
+    for load in loads:
+        start = time.perf_counter()
+        pipe, report = store.load_pipeline(load["model"], torch.float16)
+        pipe.to("cuda")
+        torch.cuda.synchronize()
+        load["store_seconds"] = time.perf_counter() - start
+        load["shared"] = [component for component, entry in report["components"].items() if entry["shared"]]
+        load["shared_bytes"] = report["shared_bytes"]
+        previous = pipe
+    del previous
+    return loads, store.stats()
+
+
+def benchmark_tensor_store(model, steps):
+    """
+    Report the deduplication of the tensor store and the load time it saves.
+
+    Args:
+        model: Unused; the loads run in their own container
+        steps: Unused
+
+    Returns:
+        A list of result rows, one per checkpoint and one for the whole store
+    """
+    loads, stats = measure_store_loads.remote()
+    rows = []
+    for load in loads:
+        model_stats = stats["models"][load["model"]]
+        rows.append({
+            "model": load["model"],
+            "gb": model_stats["bytes"] / 1024 ** 3,
+            "unique_gb": model_stats["unique_bytes"] / 1024 ** 3,
+            "single_file_seconds": load["single_file_seconds"],
+            "store_seconds": load["store_seconds"],
+            "speedup": load["single_file_seconds"] / load["store_seconds"],
+            "shared": ",".join(load["shared"]),
+            "shared_gb": load["shared_bytes"] / 1024 ** 3,
+        })
+    rows.append({
+        "model": "(store)",
+        "gb": stats["logical_bytes"] / 1024 ** 3,
+        "unique_gb": stats["stored_bytes"] / 1024 ** 3,
+        "dedup_ratio": stats["dedup_ratio"],
+    })
+    return rows
+
+
+SUITES = {
+    "memory": benchmark_memory,
+    "compile": benchmark_compile,
+    "text_encoding": benchmark_text_encoding,
+    "pipelining": benchmark_pipelining,
+    "rpc_payload": benchmark_rpc_payload,
+    "step_cache": benchmark_step_cache,
+    "guidance": benchmark_guidance,
+    "hires": benchmark_hires,
+    "tiled": benchmark_tiled,
+    "onnx": benchmark_onnx,
+    "quantization": benchmark_quantization,
+    "tensor_store": benchmark_tensor_store,
+}
+
+
+def print_rows(rows):
+    """
+    Print benchmark rows as an aligned table.
+
+    Args:
+        rows: A list of result rows
+    """
+    columns = []
+    for row in rows:
+        for key in row:
+            if key not in columns:
+                columns.append(key)
+
+    def format_value(value):
+        if isinstance(value, float):
+            return f"{value:.3f}"
+        return "" if value is None else str(value)
+
+    table = [columns] + [[format_value(row.get(column)) for column in columns] for row in rows]
+    widths = [max(len(line[i]) for line in table) for i in range(len(columns))]
+    for line in table:
+        print("  ".join(value.ljust(width) for value, width in zip(line, widths)))
+
+
+@app.local_entrypoint()
+def main(suite: str = "memory", steps: int = 20):
+    if suite not in SUITES:
+        raise SystemExit(f"Unknown suite: {suite}. Available: {', '.join(SUITES)}")
+
+    model = StableDiffusionModel()
+    warm_up(model, steps)
+    rows = SUITES[suite](model, steps)
+
+    print_rows(rows)
+    output_file = f"benchmark_{suite}.json"
+    with open(output_file, "w") as f:
+        json.dump(rows, f, indent=2)
+    print(f"Results written to {output_file}")
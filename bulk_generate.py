@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+# bulk_generate.py - Generate images for a file of prompts with bounded concurrency
+#
+# Usage:
+#   python bulk_generate.py prompts.jsonl --url https://<workspace>--stable-diffusion-app-serve-app.modal.run
+#   python bulk_generate.py prompts.csv --direct --concurrency 16
+#
+# Each input item is a JSON object (JSONL) or row (CSV) with a "prompt" and,
+# optionally, an "id" and any of the generation parameters in ITEM_FIELDS.
+# Images are written to the output directory as they finish, together with a
+# manifest.jsonl of per-item results. Rerunning the same command resumes the
+# job: items that already succeeded according to the manifest are skipped.
+
+import argparse
+import asyncio
+import base64
+import csv
+import json
+import os
+import re
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.helpers import ensure_directory, numbered_output_paths
+
+# Name of the deployed Modal app (see deploy.py)
+APP_NAME = "stable-diffusion-app"
+
+# Directory on the images volume that direct submissions are written to
+REMOTE_OUTPUT_DIR = "/images/bulk"
+
+def parse_bool(value):
+    """Parse a CSV flag such as "true", "1" or "yes"."""
+    return value.strip().lower() in ("1", "true", "yes")
+
+
+# Generation parameters an item may set, with the type used to parse CSV values
+ITEM_FIELDS = {
+    "prompt": str,
+    "negative_prompt": str,
+    "width": int,
+    "height": int,
+    "num_inference_steps": int,
+    "guidance_scale": float,
+    "memory_profile": str,
+    "num_images": int,
+    "seed": int,
+    "cache_interval": int,
+    "guidance_cutoff": float,
+    "hires_scale": float,
+    "hires_strength": float,
+    "tiled": parse_bool,
+}
+
+# Seconds to wait before retrying a failed item, doubled on every attempt
+RETRY_BACKOFF = 5
+
+# Seconds an HTTP request may take; generations queue behind admission control
+HTTP_TIMEOUT = 900
+
+
+class RetryableError(Exception):
+    """Raised when an item failed in a way that is worth retrying."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def read_items(input_path, input_format=None):
+    """
+    Read the items of a prompt file.
+
+    Args:
+        input_path: Path of a JSONL or CSV file
+        input_format: "jsonl" or "csv"; detected from the extension when None
+
+    Returns:
+        A list of (key, params) tuples. The key is the item's "id", or its
+        position in the file when it has none.
+
+    Raises:
+        ValueError: If the format is unknown, an item has no prompt, or a key repeats
+    """
+    if input_format is None:
+        input_format = "csv" if input_path.lower().endswith(".csv") else "jsonl"
+
+    with open(input_path, newline="") as f:
+        if input_format == "jsonl":
+            rows = [json.loads(line) for line in f if line.strip()]
+        elif input_format == "csv":
+            rows = list(csv.DictReader(f))
+        else:
+            raise ValueError(f"Unknown input format: {input_format}")
+
+    items = []
+    seen = set()
+    for position, row in enumerate(rows):
+        key = str(row.get("id") or position)
+        if key in seen:
+            raise ValueError(f"Duplicate item id: {key}")
+        seen.add(key)
+
+        params = {}
+        for name, parse in ITEM_FIELDS.items():
+            value = row.get(name)
+            # Empty CSV cells mean "use the default"
+            if value is None or value == "":
+                continue
+            params[name] = parse(value) if isinstance(value, str) else value
+        if not params.get("prompt"):
+            raise ValueError(f"Item {key} has no prompt")
+        items.append((key, params))
+    return items
+
+
+def load_manifest(manifest_path):
+    """
+    Load the latest record of every item in a manifest.
+
+    Args:
+        manifest_path: Path of the manifest.jsonl file
+
+    Returns:
+        A dictionary mapping item keys to their latest record
+    """
+    records = {}
+    if not os.path.exists(manifest_path):
+        return records
+    with open(manifest_path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A record cut short by an interruption; the item will be redone
+                continue
+            records[record["id"]] = record
+    return records
+
+
+def image_filename(key):
+    """
+    Get the file name of an item's (first) image.
+
+    Args:
+        key: The item key
+
+    Returns:
+        A file name safe to use on any filesystem
+    """
+    return re.sub(r"[^A-Za-z0-9._-]", "_", key) + ".png"
+
+
+def write_images(images, key, output_dir):
+    """
+    Save the images generated for an item.
+
+    Args:
+        images: A list of (PNG bytes, seed) tuples
+        key: The item key
+        output_dir: The directory to save the images in
+
+    Returns:
+        A list of dictionaries with the local "path" and "seed" of each image
+    """
+    paths = numbered_output_paths(os.path.join(output_dir, image_filename(key)), len(images))
+    written = []
+    for (png, seed), path in zip(images, paths):
+        with open(path, "wb") as f:
+            f.write(png)
+        written.append({"path": path, "seed": seed})
+    return written
+
+
+class HttpBackend:
+    """
+    Submit items to the /generate endpoint of the deployed web app.
+
+    Args:
+        url: Base URL of the web app
+        api_key: Optional API key sent as X-API-Key
+        concurrency: Number of requests kept in flight
+    """
+
+    def __init__(self, url, api_key=None, concurrency=1):
+        self.url = url.rstrip("/")
+        self.api_key = api_key
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    def _post(self, params):
+        query = urllib.parse.urlencode({name: value for name, value in params.items() if value is not None})
+        request = urllib.request.Request(f"{self.url}/generate?{query}", method="POST")
+        if self.api_key:
+            request.add_header("X-API-Key", self.api_key)
+        try:
+            with urllib.request.urlopen(request, timeout=HTTP_TIMEOUT) as response:
+                return json.load(response)
+        except urllib.error.HTTPError as e:
+            detail = e.read().decode(errors="replace")
+            if e.code == 429:
+                raise RetryableError(f"HTTP 429: {detail}", retry_after=int(e.headers.get("Retry-After", 0)) or None)
+            if e.code >= 500:
+                raise RetryableError(f"HTTP {e.code}: {detail}")
+            raise RuntimeError(f"HTTP {e.code}: {detail}")
+        except (urllib.error.URLError, TimeoutError, ConnectionError) as e:
+            raise RetryableError(str(e))
+
+    def _generate(self, key, params, output_dir):
+        result = self._post(params)
+        images = [(base64.b64decode(image["base64_image"]), image["seed"]) for image in result["images"]]
+        return write_images(images, key, output_dir)
+
+    async def generate(self, key, params, output_dir):
+        """
+        Generate the images of an item and save them.
+
+        Args:
+            key: The item key
+            params: The generation parameters
+            output_dir: The directory to save the images in
+
+        Returns:
+            A list of dictionaries with the local "path" and "seed" of each image
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._generate, key, params, output_dir)
+
+
+class DirectBackend:
+    """
+    Submit items straight to StableDiffusionModel of the deployed app.
+
+    This bypasses the web app, and with it admission control and rate
+    limiting, so the concurrency alone decides how many GPU containers are used.
+    """
+
+    def __init__(self):
+        import modal
+
+        self.model = modal.Cls.from_name(APP_NAME, "StableDiffusionModel")()
+        self.run_id = time.strftime("%Y%m%d-%H%M%S")
+
+    async def generate(self, key, params, output_dir):
+        """
+        Generate the images of an item and save them.
+
+        Args:
+            key: The item key
+            params: The generation parameters
+            output_dir: The directory to save the images in
+
+        Returns:
+            A list of dictionaries with the local "path" and "seed" of each image
+        """
+        try:
+            result = await self.model.generate_image.remote.aio(
+                **params,
+                output_path=f"{REMOTE_OUTPUT_DIR}/{self.run_id}/{image_filename(key)}",
+            )
+        except Exception as e:
+            raise RetryableError(str(e))
+        images = [(image.png, image.seed) for image in result.images]
+        return await asyncio.to_thread(write_images, images, key, output_dir)
+
+
+async def run_items(backend, items, output_dir, manifest_path, concurrency, retries):
+    """
+    Generate the given items with bounded concurrency, recording each in the manifest.
+
+    Args:
+        backend: An HttpBackend or DirectBackend
+        items: The (key, params) tuples to generate
+        output_dir: The directory to save images in
+        manifest_path: Path of the manifest.jsonl file to append to
+        concurrency: Number of items kept in flight
+        retries: Number of times a retryable failure is retried
+
+    Returns:
+        A tuple of the number of succeeded and failed items
+    """
+    queue = asyncio.Queue()
+    for item in items:
+        queue.put_nowait(item)
+    counts = {"success": 0, "error": 0}
+    start = time.monotonic()
+
+    async def worker(manifest):
+        while True:
+            try:
+                key, params = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            item_start = time.monotonic()
+            record = {"id": key, "params": params}
+            for attempt in range(retries + 1):
+                try:
+                    images = await backend.generate(key, params, output_dir)
+                    record.update(status="success", images=images)
+                    break
+                except RetryableError as e:
+                    if attempt == retries:
+                        record.update(status="error", error=str(e))
+                        break
+                    delay = e.retry_after or RETRY_BACKOFF * 2 ** attempt
+                    print(f"Item {key} failed ({e}), retrying in {delay}s")
+                    await asyncio.sleep(delay)
+                except Exception as e:
+                    record.update(status="error", error=str(e))
+                    break
+            record["seconds"] = round(time.monotonic() - item_start, 3)
+
+            # Write the record as soon as the item finishes so an interrupted run can resume
+            manifest.write(json.dumps(record) + "\n")
+            manifest.flush()
+            counts[record["status"]] += 1
+            if record["status"] == "error":
+                print(f"Item {key} failed: {record['error']}")
+
+            finished = counts["success"] + counts["error"]
+            if finished % 10 == 0 or finished == len(items):
+                elapsed = time.monotonic() - start
+                rate = finished / elapsed
+                remaining = (len(items) - finished) / rate if rate else 0
+                print(
+                    f"{finished}/{len(items)} done ({counts['error']} failed), "
+                    f"{rate * 60:.1f} items/min, about {remaining / 60:.0f} min left"
+                )
+
+    with open(manifest_path, "a") as manifest:
+        await asyncio.gather(*(worker(manifest) for _ in range(min(concurrency, len(items)))))
+    return counts["success"], counts["error"]
+
+
+def main():
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description="Generate images for a JSONL or CSV file of prompts")
+    parser.add_argument("input", type=str, help="JSONL or CSV file of items, each with a prompt")
+    parser.add_argument("--format", type=str, choices=["jsonl", "csv"], default=None, help="Input format (default: from the file extension)")
+    parser.add_argument("--output-dir", type=str, default="bulk_output", help="Directory to write images and the manifest to")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--url", type=str, help="Base URL of the deployed web app")
+    target.add_argument("--direct", action="store_true", help="Call StableDiffusionModel of the deployed app directly")
+    parser.add_argument("--api-key", type=str, default=os.environ.get("SD_API_KEY"), help="API key for the web app (default: $SD_API_KEY)")
+    parser.add_argument("--concurrency", type=int, default=32, help="Number of items kept in flight")
+    parser.add_argument("--retries", type=int, default=3, help="Retries of an item after a transient failure")
+    args = parser.parse_args()
+
+    ensure_directory(args.output_dir)
+    manifest_path = os.path.join(args.output_dir, "manifest.jsonl")
+
+    items = read_items(args.input, args.format)
+    finished = load_manifest(manifest_path)
+    pending = [(key, params) for key, params in items if finished.get(key, {}).get("status") != "success"]
+    print(f"{len(items)} items, {len(items) - len(pending)} already done, {len(pending)} to generate")
+    if not pending:
+        return
+
+    if args.direct:
+        backend = DirectBackend()
+    else:
+        backend = HttpBackend(args.url, api_key=args.api_key, concurrency=args.concurrency)
+
+    succeeded, failed = asyncio.run(
+        run_items(backend, pending, args.output_dir, manifest_path, args.concurrency, args.retries)
+    )
+    print(f"Finished: {succeeded} succeeded, {failed} failed. Manifest: {manifest_path}")
+    if failed:
+        print("Rerun the same command to retry the failed items.")
+
+
+if __name__ == "__main__":
+    main()
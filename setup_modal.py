@@ -26,7 +26,7 @@ def main():
     
     print("\nModal environment setup complete!")
     print("\nNext steps:")
-    print("1. Run 'python test_model.py' to test the Stable Diffusion model")
+    print("1. Run 'python bulk_generate.py prompts.jsonl --direct' to generate images for a file of prompts")
     print("2. Run 'python run_app.py' to start the web application")
 
 if __name__ == "__main__":
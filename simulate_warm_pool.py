@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# simulate_warm_pool.py - Compare warm pool policies on a recorded arrival trace
+#
+# Usage:
+#   modal volume get stable-diffusion-images warm_pool/arrivals-20250101.txt .
+#   python simulate_warm_pool.py arrivals-20250101.txt arrivals-20250102.txt
+#
+# A trace has one arrival timestamp (seconds since the epoch) per line, as
+# written by the control_warm_pool function of the deployed app. Each policy
+# is replayed against the trace, and the cold-start rate it leads to is
+# reported next to the GPU time it pays for while containers sit idle.
+
+import argparse
+
+from utils.warmpool import (
+    COLD_START_SECONDS,
+    GPU_COST_PER_HOUR,
+    SCALEDOWN_WINDOW,
+    WARM_POOL_INTERVAL,
+    WARM_POOL_SERVICE_SECONDS,
+    FixedPolicy,
+    ForecastPolicy,
+    simulate_warm_pool,
+)
+
+
+def read_trace(paths):
+    """
+    Read the arrival timestamps of one or more trace files.
+
+    Args:
+        paths: Paths of trace files with one timestamp per line
+
+    Returns:
+        The sorted arrival timestamps
+    """
+    arrivals = []
+    for path in paths:
+        with open(path) as f:
+            arrivals.extend(float(line) for line in f if line.strip())
+    return sorted(arrivals)
+
+
+def main():
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description="Replay an arrival trace against warm pool policies")
+    parser.add_argument("traces", nargs="+", help="Trace files with one arrival timestamp per line")
+    parser.add_argument("--fixed", type=int, nargs="*", default=[0, 1, 2], help="Fixed pool sizes to compare against")
+    parser.add_argument("--service-seconds", type=float, default=WARM_POOL_SERVICE_SECONDS, help="Seconds a container is busy with one request")
+    parser.add_argument("--cold-start-seconds", type=float, default=COLD_START_SECONDS, help="Seconds from starting a container to a loaded pipeline")
+    parser.add_argument("--scaledown-window", type=float, default=SCALEDOWN_WINDOW, help="Idle seconds before a container not kept warm stops")
+    parser.add_argument("--interval", type=float, default=WARM_POOL_INTERVAL, help="Seconds between controller runs")
+    parser.add_argument("--gpu-cost-per-hour", type=float, default=GPU_COST_PER_HOUR, help="Price of a GPU container per hour")
+    args = parser.parse_args()
+
+    arrivals = read_trace(args.traces)
+    hours = (arrivals[-1] - arrivals[0]) / 3600 if arrivals else 0
+    print(f"{len(arrivals)} arrivals over {hours:.1f} hours")
+
+    policies = [FixedPolicy(size) for size in args.fixed]
+    policies.append(ForecastPolicy(lookahead=args.cold_start_seconds, service_seconds=args.service_seconds))
+
+    print(f"{'policy':<12} {'cold starts':>12} {'cold rate':>10} {'cold wait':>10} {'queue wait':>11} {'idle GPU h':>11} {'idle cost':>10}")
+    for policy in policies:
+        result = simulate_warm_pool(
+            arrivals,
+            policy,
+            service_seconds=args.service_seconds,
+            cold_start_seconds=args.cold_start_seconds,
+            scaledown_window=args.scaledown_window,
+            interval=args.interval,
+            gpu_cost_per_hour=args.gpu_cost_per_hour,
+        )
+        print(
+            f"{result['policy']:<12} {result['cold_starts']:>12} {result['cold_start_rate']:>9.2%} "
+            f"{result['mean_cold_wait']:>9.1f}s {result['mean_queue_wait']:>10.2f}s "
+            f"{result['unused_gpu_hours']:>11.1f} {result['unused_gpu_cost']:>9.2f}$"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+
+from utils.admission import AdmissionController, AdmissionRejected, RequestTooExpensive
+
+
+def test_admits_requests_within_the_budget():
+    async def scenario():
+        controller = AdmissionController(max_request_cost=100, max_inflight_cost=100)
+        await controller.acquire(60)
+        await controller.acquire(40)
+        return controller.inflight_cost
+
+    assert asyncio.run(scenario()) == 100
+
+
+def test_rejects_requests_over_the_per_request_limit():
+    controller = AdmissionController(max_request_cost=50, max_tiled_request_cost=200, max_inflight_cost=100)
+
+    with pytest.raises(RequestTooExpensive):
+        asyncio.run(controller.acquire(60))
+    # Tiled requests have their own limit, capped by the in-flight budget
+    assert controller.request_limit(tiled=True) == 100
+
+
+def test_interactive_request_that_fits_skips_a_waiting_batch_request():
+    async def scenario():
+        controller = AdmissionController(max_request_cost=100, max_inflight_cost=100)
+        await controller.acquire(60, "alice")
+        batch = asyncio.create_task(controller.acquire(80, "nightly", "batch"))
+        await asyncio.sleep(0)
+        assert controller.queue_depth == 1
+
+        # Fits the free budget and outranks the batch head, so it runs now
+        await asyncio.wait_for(controller.acquire(30, "bob"), timeout=1)
+        assert controller.inflight_cost == 90
+        assert not batch.done()
+
+        controller.release(60)
+        controller.release(30)
+        await asyncio.wait_for(batch, timeout=1)
+        return controller.inflight_cost
+
+    assert asyncio.run(scenario()) == 80
+
+
+def test_rejects_when_the_lane_queue_is_full():
+    async def scenario():
+        controller = AdmissionController(max_request_cost=100, max_inflight_cost=100, max_queue=1, max_batch_queue=1)
+        await controller.acquire(100)
+        waiting = asyncio.create_task(controller.acquire(50, "alice"))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected):
+            await controller.acquire(50, "bob")
+        # Batch waiters have their own queue
+        batch = asyncio.create_task(controller.acquire(50, "nightly", "batch"))
+        await asyncio.sleep(0)
+        assert controller.queue_depth == 2
+        for task in (waiting, batch):
+            task.cancel()
+        await asyncio.gather(waiting, batch, return_exceptions=True)
+        return controller.queue_depth
+
+    assert asyncio.run(scenario()) == 0
@@ -0,0 +1,135 @@
+import asyncio
+
+import pytest
+
+from utils.coalesce import SingleFlight, normalize_prompt, request_key
+
+PARAMS = {
+    "prompt": "a lighthouse at dusk",
+    "negative_prompt": None,
+    "width": 1024,
+    "height": 1024,
+    "num_inference_steps": 30,
+    "guidance_scale": 7.5,
+    "seed": 42,
+}
+
+
+def test_normalize_prompt_collapses_whitespace():
+    assert normalize_prompt("  a   lighthouse\n at\tdusk ") == "a lighthouse at dusk"
+    assert normalize_prompt(None) is None
+
+
+def test_request_key_ignores_whitespace_order_and_integral_floats():
+    variant = {
+        "seed": 42,
+        "guidance_scale": 7.5,
+        "num_inference_steps": 30.0,
+        "height": 1024,
+        "width": 1024,
+        "negative_prompt": None,
+        "prompt": "a  lighthouse at\ndusk",
+    }
+    assert request_key(variant) == request_key(PARAMS)
+
+
+def test_request_key_differs_by_seed_and_prompt():
+    assert request_key({**PARAMS, "seed": 43}) != request_key(PARAMS)
+    assert request_key({**PARAMS, "prompt": "a lighthouse at dawn"}) != request_key(PARAMS)
+
+
+def test_request_key_hashes_image_bytes():
+    key = request_key({**PARAMS, "init_image": b"\x89PNG one"})
+    assert key == request_key({**PARAMS, "init_image": b"\x89PNG one"})
+    assert key != request_key({**PARAMS, "init_image": b"\x89PNG two"})
+
+
+class CountingBackend:
+    """Fake generation backend that holds every call until released."""
+
+    def __init__(self):
+        self.calls = 0
+        self.release = asyncio.Event()
+
+    async def generate(self, seed):
+        self.calls += 1
+        await self.release.wait()
+        return f"image-{seed}"
+
+
+def test_identical_requests_share_one_backend_call():
+    async def scenario():
+        flights = SingleFlight()
+        backend = CountingBackend()
+        key = request_key(PARAMS)
+        callers = [asyncio.create_task(flights.do(key, lambda: backend.generate(42))) for _ in range(5)]
+        await asyncio.sleep(0)
+        assert flights.in_flight() == 1
+        backend.release.set()
+        results = await asyncio.gather(*callers)
+        return backend.calls, results, flights.in_flight()
+
+    calls, results, in_flight = asyncio.run(scenario())
+    assert calls == 1
+    assert [result for result, _ in results] == ["image-42"] * 5
+    assert sorted(shared for _, shared in results) == [False, True, True, True, True]
+    assert in_flight == 0
+
+
+def test_different_seeds_run_separately():
+    async def scenario():
+        flights = SingleFlight()
+        backend = CountingBackend()
+        callers = [
+            asyncio.create_task(flights.do(request_key({**PARAMS, "seed": seed}), lambda seed=seed: backend.generate(seed)))
+            for seed in (1, 2)
+        ]
+        await asyncio.sleep(0)
+        backend.release.set()
+        results = await asyncio.gather(*callers)
+        return backend.calls, results
+
+    calls, results = asyncio.run(scenario())
+    assert calls == 2
+    assert results == [("image-1", False), ("image-2", False)]
+
+
+def test_cancelling_one_waiter_leaves_the_call_running_for_the_others():
+    async def scenario():
+        flights = SingleFlight()
+        backend = CountingBackend()
+        key = request_key(PARAMS)
+        first = asyncio.create_task(flights.do(key, lambda: backend.generate(42)))
+        second = asyncio.create_task(flights.do(key, lambda: backend.generate(42)))
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        backend.release.set()
+        result = await second
+        return backend.calls, result
+
+    calls, result = asyncio.run(scenario())
+    assert calls == 1
+    assert result == ("image-42", True)
+
+
+def test_exceptions_are_shared_and_the_key_is_forgotten():
+    async def scenario():
+        flights = SingleFlight()
+        release = asyncio.Event()
+
+        async def failing():
+            await release.wait()
+            raise RuntimeError("out of memory")
+
+        callers = [asyncio.create_task(flights.do("key", failing)) for _ in range(2)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*callers, return_exceptions=True)
+        await asyncio.sleep(0)
+        return results, flights.in_flight()
+
+    results, in_flight = asyncio.run(scenario())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert in_flight == 0
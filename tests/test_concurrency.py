@@ -0,0 +1,167 @@
+import threading
+import time
+
+from utils.concurrency import GpuLane
+
+TIMEOUT = 5
+
+
+class FakePipeline:
+    """Fake GPU pipeline that records how many requests use it at once."""
+
+    def __init__(self):
+        self.active = 0
+        self.max_active = 0
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, hold=None):
+        with self._lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            self.calls += 1
+        if hold is not None:
+            assert hold.wait(TIMEOUT), "CPU stage of another request didn't run alongside"
+        else:
+            time.sleep(0.005)
+        with self._lock:
+            self.active -= 1
+
+
+def start(target, name=None):
+    thread = threading.Thread(target=target, name=name, daemon=True)
+    thread.start()
+    return thread
+
+
+def wait_for_line(lane, length):
+    deadline = time.monotonic() + TIMEOUT
+    while len(lane._line) < length:
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def interrupt_waits(lane, thread_name, exception, armed=None):
+    """
+    Make the lane's waits raise in the named thread, as an interrupted input would.
+
+    Without ``armed`` the wait raises at once; otherwise it raises on the
+    first wake-up after ``armed`` is set.
+    """
+    wait = lane._condition.wait
+
+    def interrupted_wait(timeout=None):
+        if threading.current_thread().name != thread_name:
+            return wait(timeout)
+        if armed is None:
+            raise exception
+        result = wait(timeout)
+        if armed.is_set():
+            raise exception
+        return result
+
+    lane._condition.wait = interrupted_wait
+
+
+def test_gpu_stages_take_turns_while_cpu_stages_overlap():
+    lane = GpuLane()
+    pipe = FakePipeline()
+    decoded = threading.Event()
+
+    def holder():
+        with lane:
+            # Keeps the GPU until another request has finished its CPU stage
+            pipe(hold=decoded)
+
+    def request():
+        # e.g. decoding the input image before queueing for the GPU
+        decoded.set()
+        with lane:
+            pipe()
+
+    threads = [start(holder)]
+    wait_for_line(lane, 1)
+    threads += [start(request) for _ in range(4)]
+    for thread in threads:
+        thread.join(TIMEOUT)
+
+    assert not any(thread.is_alive() for thread in threads)
+    assert pipe.calls == 5
+    assert pipe.max_active == 1
+
+
+def test_waiters_are_served_in_arrival_order():
+    lane = GpuLane()
+    order = []
+
+    def request(index):
+        with lane:
+            order.append(index)
+
+    assert lane.acquire() == 0
+    threads = []
+    for index in range(5):
+        threads.append(start(lambda index=index: request(index)))
+        wait_for_line(lane, index + 2)
+    lane.release()
+    for thread in threads:
+        thread.join(TIMEOUT)
+
+    assert order == [0, 1, 2, 3, 4]
+
+
+def test_interrupted_waiter_leaves_the_line():
+    lane = GpuLane()
+    interrupt_waits(lane, "interrupted", KeyboardInterrupt)
+    lane.acquire()
+
+    failures = []
+
+    def interrupted():
+        try:
+            lane.acquire()
+        except KeyboardInterrupt:
+            failures.append("interrupted")
+
+    start(interrupted, name="interrupted").join(TIMEOUT)
+    assert failures == ["interrupted"]
+    assert len(lane._line) == 1
+
+    later = start(lambda: lane.release() if lane.acquire() == 1 else None)
+    lane.release()
+    later.join(TIMEOUT)
+    assert not later.is_alive()
+    assert not lane._line
+
+
+def test_waiter_failing_as_the_lane_is_handed_to_it_passes_it_on():
+    lane = GpuLane()
+    released = threading.Event()
+    interrupt_waits(lane, "failing", RuntimeError("cancelled"), armed=released)
+    lane.acquire()
+
+    failures = []
+
+    def failing():
+        try:
+            lane.acquire()
+        except RuntimeError:
+            failures.append("failing")
+
+    waiting = start(failing, name="failing")
+    wait_for_line(lane, 2)
+
+    acquired = threading.Event()
+
+    def later():
+        with lane:
+            acquired.set()
+
+    start(later)
+    wait_for_line(lane, 3)
+    released.set()
+    lane.release()
+
+    assert acquired.wait(TIMEOUT)
+    waiting.join(TIMEOUT)
+    assert failures == ["failing"]
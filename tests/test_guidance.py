@@ -0,0 +1,78 @@
+import torch
+
+from utils.guidance import CUTOFF_TENSOR_INPUTS, count_unet_calls, guidance_cutoff_callback
+
+
+def run(pipe, cutoff, steps=4):
+    batches = []
+    hook = pipe.unet.register_forward_pre_hook(lambda module, args, kwargs: batches.append(args[0].shape[0]), with_kwargs=True)
+    callback, tensor_inputs = guidance_cutoff_callback(cutoff)
+    try:
+        with count_unet_calls(pipe.unet, num_images=1, measure_flops=False) as counter:
+            latents = pipe(
+                "a red lighthouse",
+                num_inference_steps=steps,
+                guidance_scale=5.0,
+                width=16,
+                height=16,
+                generator=torch.Generator().manual_seed(0),
+                output_type="latent",
+                callback_on_step_end=callback,
+                callback_on_step_end_tensor_inputs=tensor_inputs,
+            ).images
+    finally:
+        hook.remove()
+    return batches, counter.stats(), latents
+
+
+def test_cutoff_halves_the_batch_after_the_cutoff(tiny_pipeline):
+    batches, stats, latents = run(tiny_pipeline, cutoff=0.5)
+
+    assert batches == [2, 2, 1, 1]
+    assert stats["calls"] == 4
+    assert stats["guided_calls"] == 2
+    assert stats["samples"] == 6
+    assert latents.shape[0] == 1
+
+
+def test_full_guidance_keeps_the_batch(tiny_pipeline):
+    batches, stats, _ = run(tiny_pipeline, cutoff=1.0)
+
+    assert batches == [2, 2, 2, 2]
+    assert stats["guided_calls"] == 4
+
+
+def test_cutoff_runs_at_least_one_guided_step(tiny_pipeline):
+    batches, _, _ = run(tiny_pipeline, cutoff=0.1)
+
+    assert batches == [2, 1, 1, 1]
+
+
+def test_cutoff_callback_chains_the_given_callback():
+    seen = []
+
+    def timer(pipe, step, timestep, callback_kwargs):
+        seen.append(step)
+        return callback_kwargs
+
+    callback, tensor_inputs = guidance_cutoff_callback(1.0, timer)
+    assert callback is timer
+    assert tensor_inputs == ["latents"]
+
+    callback, tensor_inputs = guidance_cutoff_callback(0.5, timer, guided_inputs=("mask",))
+    assert tensor_inputs == CUTOFF_TENSOR_INPUTS + ["mask"]
+
+    class Pipe:
+        num_timesteps = 4
+        do_classifier_free_guidance = True
+        _guidance_scale = 5.0
+
+    tensors = {name: torch.zeros(2, 3) for name in CUTOFF_TENSOR_INPUTS + ["mask"]}
+    tensors["latents"] = torch.zeros(1, 3)
+    pipe = Pipe()
+    callback(pipe, 0, 999, dict(tensors))
+    halved = callback(pipe, 1, 500, dict(tensors))
+
+    assert seen == [0, 1]
+    assert pipe._guidance_scale == 0.0
+    assert all(halved[name].shape[0] == 1 for name in ("prompt_embeds", "add_text_embeds", "add_time_ids", "mask"))
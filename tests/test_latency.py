@@ -0,0 +1,74 @@
+import pytest
+
+from utils.hires import hires_plan
+from utils.latency import LatencyModel, request_drivers, request_kind
+
+TXT2IMG_STAGES = {"denoise": 6.0, "vae_decode": 0.5, "volume_write": 0.1, "image_encode": 0.2}
+IMG2IMG_STAGES = {"image_decode": 0.3, "denoise": 3.0, "vae_decode": 0.5, "volume_write": 0.1, "image_encode": 0.2}
+HIRES_STAGES = {"denoise": 3.0, "hires_refine": 6.0, "vae_decode": 0.5, "volume_write": 0.1, "image_encode": 0.2}
+
+
+def trained_model():
+    model = LatencyModel(exact_min_samples=100)
+    for steps in (20, 30, 40):
+        scale = steps / 30
+        stages = {name: seconds * scale if name == "denoise" else seconds for name, seconds in TXT2IMG_STAGES.items()}
+        model.observe("sdxl", 1024, 1024, steps, stages, sum(stages.values()) + 0.5)
+    model.observe("sdxl", 1024, 1024, 15, IMG2IMG_STAGES, sum(IMG2IMG_STAGES.values()) + 0.5, kind="img2img")
+    hires = hires_plan(2048, 2048, 30, 2.0, 0.5)
+    model.observe("sdxl", 2048, 2048, 30, HIRES_STAGES, sum(HIRES_STAGES.values()) + 0.5, kind="hires", hires=hires)
+    return model
+
+
+def test_request_kind():
+    assert request_kind({"width": 1024}) == "txt2img"
+    assert request_kind({"hires_scale": 1.0}) == "txt2img"
+    assert request_kind({"hires_scale": 2.0}) == "hires"
+    assert request_kind({"init_image": b"png", "mask_image": None}) == "img2img"
+    assert request_kind({"init_image": b"png", "mask_image": b"png"}) == "inpaint"
+
+
+def test_prediction_sums_only_the_stages_of_its_kind():
+    model = trained_model()
+
+    prediction = model.predict(1024, 1024, 30)
+
+    assert prediction["basis"] == "fitted"
+    assert set(prediction["stages"]) == set(TXT2IMG_STAGES)
+    assert prediction["seconds"] == pytest.approx(sum(TXT2IMG_STAGES.values()) + 0.5, rel=0.05)
+
+    img2img = model.predict(1024, 1024, 15, kind="img2img")
+    assert set(img2img["stages"]) == set(IMG2IMG_STAGES)
+    hires = hires_plan(2048, 2048, 30, 2.0, 0.5)
+    assert "hires_refine" in model.predict(2048, 2048, 30, kind="hires", hires=hires)["stages"]
+
+
+def test_hires_passes_are_fitted_on_their_own_work():
+    hires = hires_plan(2048, 2048, 30, 2.0, 0.5)
+    drivers = request_drivers(2048, 2048, 30, hires=hires)
+    # The base pass denoises at 1024x1024, the refinement 15 steps at full size
+    assert drivers["work"] == pytest.approx(1.048576 * 30)
+    assert drivers["refine_work"] == pytest.approx(4.194304 * 15)
+
+    model = trained_model()
+    stronger = model.predict(2048, 2048, 30, kind="hires", hires=hires_plan(2048, 2048, 30, 2.0, 1.0))
+    assert stronger["stages"]["hires_refine"] == pytest.approx(2 * HIRES_STAGES["hires_refine"])
+    assert stronger["stages"]["denoise"] == pytest.approx(HIRES_STAGES["denoise"])
+    smaller = model.predict(1024, 1024, 30, kind="hires", hires=hires_plan(1024, 1024, 30, 2.0, 0.5))
+    assert smaller["stages"]["hires_refine"] == pytest.approx(HIRES_STAGES["hires_refine"] / 4)
+    assert smaller["stages"]["denoise"] == pytest.approx(HIRES_STAGES["denoise"] / 4)
+
+
+def test_unobserved_kind_falls_back_to_the_prior():
+    assert trained_model().predict(1024, 1024, 30, kind="inpaint")["basis"] == "prior"
+
+
+def test_state_round_trips_and_old_state_is_discarded():
+    model = trained_model()
+    state = model.to_dict()
+
+    restored = LatencyModel.from_dict(state)
+    assert restored.predict(1024, 1024, 30) == model.predict(1024, 1024, 30)
+
+    old = {key: value for key, value in state.items() if key != "version"}
+    assert LatencyModel.from_dict(old).observations == 0
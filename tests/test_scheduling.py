@@ -0,0 +1,125 @@
+import pytest
+
+from utils.scheduling import Client, ExceedsBurst, FairQueue, RateLimited, RateLimiter, TokenBucket
+
+
+class FakeClock:
+    """Monotonic clock advanced by hand."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def drain(queue):
+    order = []
+    while (head := queue.pop()) is not None:
+        order.append(head[1])
+    return order
+
+
+def test_fair_queue_shares_cost_between_clients():
+    queue = FairQueue(quantum=10)
+    # alice queues many cheap requests first, bob a few expensive ones
+    for index in range(6):
+        queue.push(f"alice-{index}", "alice", "interactive", 10)
+    for index in range(3):
+        queue.push(f"bob-{index}", "bob", "interactive", 20)
+
+    order = drain(queue)
+
+    assert order == ["alice-0", "alice-1", "bob-0", "alice-2", "alice-3", "bob-1", "alice-4", "alice-5", "bob-2"]
+
+
+def test_fair_queue_serves_interactive_before_batch():
+    queue = FairQueue(quantum=10)
+    queue.push("batch-0", "nightly", "batch", 5)
+    queue.push("batch-1", "nightly", "batch", 5)
+    queue.push("alice-0", "alice", "interactive", 30)
+    queue.push("bob-0", "bob", "interactive", 5)
+
+    assert queue.lane_size("interactive") == 2
+    assert queue.lane_size("batch") == 2
+    assert drain(queue)[2:] == ["batch-0", "batch-1"]
+
+    # Interactive work arriving while batch work waits still goes first
+    queue.push("batch-2", "nightly", "batch", 5)
+    queue.push("alice-1", "alice", "interactive", 5)
+    assert drain(queue) == ["alice-1", "batch-2"]
+
+
+def test_fair_queue_push_after_peek_can_outrank_the_peeked_request():
+    queue = FairQueue(quantum=10)
+    queue.push("batch-0", "nightly", "batch", 30)
+    assert queue.peek()[1] == "batch-0"
+
+    queue.push("alice-0", "alice", "interactive", 30)
+    assert queue.peek()[1] == "alice-0"
+
+    # A request in the same lane doesn't take the peeked client's turn
+    queue.push("bob-0", "bob", "interactive", 5)
+    assert drain(queue) == ["alice-0", "bob-0", "batch-0"]
+
+
+def test_fair_queue_remove():
+    queue = FairQueue(quantum=10)
+    for name in ("a", "b", "c"):
+        queue.push(name, "alice", "interactive", 5)
+    assert queue.peek()[1] == "a"
+
+    queue.remove("a")
+    queue.remove("c")
+
+    assert len(queue) == 1
+    assert drain(queue) == ["b"]
+    assert len(queue) == 0
+
+
+def test_token_bucket_refills_at_its_rate():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2, burst=10, clock=clock)
+    bucket.consume(10)
+
+    with pytest.raises(RateLimited) as rejected:
+        bucket.consume(4)
+    assert rejected.value.retry_after == 2
+
+    clock.advance(1)
+    with pytest.raises(RateLimited):
+        bucket.consume(4)
+    clock.advance(1)
+    bucket.consume(4)
+
+
+def test_token_bucket_never_exceeds_its_burst():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2, burst=10, clock=clock)
+    clock.advance(3600)
+    bucket.consume(10)
+    with pytest.raises(RateLimited):
+        bucket.consume(1)
+
+
+def test_token_bucket_rejects_cost_over_burst_even_when_full():
+    bucket = TokenBucket(rate=2, burst=10, clock=FakeClock())
+    with pytest.raises(ExceedsBurst):
+        bucket.consume(11)
+    # The rejected request took nothing
+    bucket.consume(10)
+
+
+def test_rate_limiter_keeps_a_bucket_per_client():
+    clock = FakeClock()
+    limiter = RateLimiter(clock=clock)
+    alice = Client("alice", rate=1, burst=5)
+    bob = Client("bob", rate=1, burst=5)
+
+    limiter.consume(alice, 5)
+    with pytest.raises(RateLimited):
+        limiter.consume(alice, 1)
+    limiter.consume(bob, 5)
@@ -0,0 +1,95 @@
+import torch
+
+from utils.step_cache import StepCache, step_cache
+
+
+def unet_inputs(unet, batch=1, size=8):
+    generator = torch.Generator().manual_seed(batch * 100 + size)
+    sample = torch.randn(batch, 4, size, size, generator=generator)
+    kwargs = {
+        "encoder_hidden_states": torch.randn(batch, 7, unet.config.cross_attention_dim, generator=generator),
+        "added_cond_kwargs": {
+            "text_embeds": torch.randn(batch, 32, generator=generator),
+            "time_ids": torch.randn(batch, 6, generator=generator),
+        },
+    }
+    return sample, kwargs
+
+
+@torch.no_grad()
+def test_deep_blocks_run_only_every_interval(tiny_unet):
+    sample, kwargs = unet_inputs(tiny_unet)
+
+    with step_cache(tiny_unet, interval=3) as cache:
+        reused = []
+        for step in range(7):
+            tiny_unet(sample, 999 - step, **kwargs)
+            reused.append(cache.reusing)
+        stats = cache.stats()
+
+    # Calls 0, 3 and 6 run the whole UNet; deep blocks are the second down
+    # block, the mid block and the first up block
+    assert reused == [False, True, True, False, True, True, False]
+    assert stats["calls"] == 7
+    assert stats["full_calls"] == 3
+    assert stats["blocks_skipped"] == 4 * 3
+    assert stats["block_calls"] == 7 * 5 - 4 * 3
+
+
+@torch.no_grad()
+def test_full_calls_match_the_plain_unet(tiny_unet):
+    sample, kwargs = unet_inputs(tiny_unet)
+    expected = [tiny_unet(sample, t, **kwargs).sample for t in (999, 900, 800)]
+
+    with step_cache(tiny_unet, interval=2):
+        outputs = [tiny_unet(sample, t, **kwargs).sample for t in (999, 900, 800)]
+
+    torch.testing.assert_close(outputs[0], expected[0])
+    torch.testing.assert_close(outputs[2], expected[2])
+    # The reused call only recomputes the shallow blocks
+    assert not torch.allclose(outputs[1], expected[1])
+
+
+@torch.no_grad()
+def test_shape_change_forces_a_full_call(tiny_unet):
+    guided_sample, guided_kwargs = unet_inputs(tiny_unet, batch=2)
+    sample, kwargs = unet_inputs(tiny_unet, batch=1)
+
+    with step_cache(tiny_unet, interval=4) as cache:
+        tiny_unet(guided_sample, 999, **guided_kwargs)
+        tiny_unet(guided_sample, 900, **guided_kwargs)
+        assert cache.reusing
+        # e.g. classifier-free guidance stopping: the batch halves
+        tiny_unet(sample, 800, **kwargs)
+        assert not cache.reusing
+        tiny_unet(sample, 700, **kwargs)
+        assert cache.reusing
+        stats = cache.stats()
+
+    assert stats["full_calls"] == 2
+
+
+@torch.no_grad()
+def test_interval_one_never_reuses(tiny_unet):
+    sample, kwargs = unet_inputs(tiny_unet)
+    with step_cache(tiny_unet, interval=1) as cache:
+        for step in range(3):
+            tiny_unet(sample, 999 - step, **kwargs)
+        assert cache.stats()["full_calls"] == 3
+        assert cache.stats()["blocks_skipped"] == 0
+
+
+@torch.no_grad()
+def test_detach_restores_the_blocks(tiny_unet):
+    sample, kwargs = unet_inputs(tiny_unet)
+    expected = tiny_unet(sample, 500, **kwargs).sample
+
+    cache = StepCache(tiny_unet, interval=2)
+    cache.attach()
+    tiny_unet(sample, 999, **kwargs)
+    cache.detach()
+
+    blocks = list(tiny_unet.down_blocks) + [tiny_unet.mid_block] + list(tiny_unet.up_blocks)
+    assert all("forward" not in block.__dict__ for block in blocks)
+    torch.testing.assert_close(tiny_unet(sample, 500, **kwargs).sample, expected)
+    assert cache.stats()["calls"] == 1
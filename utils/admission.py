@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# admission.py - Cost-based admission control and backpressure for generation requests
+
+import asyncio
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+
+from utils.scheduling import FairQueue
+
+# Relative cost of one step of each sampler; samplers that evaluate the UNet
+# twice per step (e.g. Heun) cost twice as much
+SAMPLER_FACTORS = {
+    "default": 1.0,
+    "euler": 1.0,
+    "euler_a": 1.0,
+    "dpmpp_2m": 1.0,
+    "ddim": 1.0,
+    "heun": 2.0,
+}
+
+# Largest cost a single request may have, in megapixel-steps
+# (1024x1024 at 150 steps is about 157)
+MAX_REQUEST_COST = float(os.environ.get("SD_MAX_REQUEST_COST", "160"))
+
+# Largest cost of a single tiled request. Tiling bounds a request's GPU
+# memory by the tile size, so only its running time needs a limit; overlapping
+# tiles are charged in full (3072x3072 at 30 steps is about 503 with the
+# default tiles)
+MAX_TILED_REQUEST_COST = float(os.environ.get("SD_MAX_TILED_REQUEST_COST", "600"))
+
+# Total cost allowed to run at once, in megapixel-steps
+# (about 20 requests at 1024x1024 and 30 steps)
+MAX_INFLIGHT_COST = float(os.environ.get("SD_MAX_INFLIGHT_COST", "640"))
+
+# Number of interactive requests allowed to wait for budget before new ones are rejected
+MAX_QUEUE = int(os.environ.get("SD_MAX_QUEUE", "32"))
+
+# Number of batch requests allowed to wait for budget. Batch waiters have their
+# own limit so a large batch never fills the interactive queue
+MAX_BATCH_QUEUE = int(os.environ.get("SD_MAX_BATCH_QUEUE", "32"))
+
+# Initial estimate of how many megapixel-steps are completed per second,
+# refined from observed request durations
+INITIAL_THROUGHPUT = float(os.environ.get("SD_ADMISSION_THROUGHPUT", "20"))
+
+
+def estimate_cost(width, height, num_inference_steps, sampler="default", num_images=1):
+    """
+    Estimate the GPU cost of a generation request.
+
+    Args:
+        width: The width of the generated image
+        height: The height of the generated image
+        num_inference_steps: Number of denoising steps
+        sampler: The sampler used for denoising
+        num_images: Number of images generated by the request
+
+    Returns:
+        The cost in megapixel-steps
+    """
+    factor = SAMPLER_FACTORS.get(sampler, 1.0)
+    return width * height / 1_000_000 * num_inference_steps * factor * num_images
+
+
+class RequestTooExpensive(Exception):
+    """Raised when a single request exceeds the per-request cost budget."""
+
+    def __init__(self, cost, limit):
+        super().__init__(f"Request cost {cost:.1f} exceeds the per-request limit of {limit:.1f} megapixel-steps")
+        self.cost = cost
+        self.limit = limit
+
+
+class AdmissionRejected(Exception):
+    """Raised when the service is saturated and a request can't be queued."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Server is at capacity, retry after {retry_after} seconds")
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Admit requests against an in-flight cost budget with a bounded wait queue.
+
+    Requests that fit the remaining budget run immediately. Others wait, up to
+    ``max_queue`` interactive and ``max_batch_queue`` batch requests, and are
+    admitted in the order chosen by the fair queue (priority lanes, then
+    deficit round robin across clients); beyond that they are rejected with an
+    estimate of when capacity will be available.
+
+    Args:
+        max_request_cost: Largest cost of a single request
+        max_tiled_request_cost: Largest cost of a single tiled request
+        max_inflight_cost: Total cost allowed to run at once
+        max_queue: Number of interactive requests allowed to wait for budget
+        max_batch_queue: Number of batch requests allowed to wait for budget
+        throughput: Initial estimate of cost units completed per second
+        clock: Monotonic clock, replaceable for testing
+        queue: The queue waiting requests are held in; a FairQueue by default
+    """
+
+    def __init__(
+        self,
+        max_request_cost=MAX_REQUEST_COST,
+        max_tiled_request_cost=MAX_TILED_REQUEST_COST,
+        max_inflight_cost=MAX_INFLIGHT_COST,
+        max_queue=MAX_QUEUE,
+        max_batch_queue=MAX_BATCH_QUEUE,
+        throughput=INITIAL_THROUGHPUT,
+        clock=time.monotonic,
+        queue=None,
+    ):
+        self.max_request_cost = max_request_cost
+        self.max_tiled_request_cost = max_tiled_request_cost
+        self.max_inflight_cost = max_inflight_cost
+        self.max_queue = max_queue
+        self.max_batch_queue = max_batch_queue
+        self.throughput = throughput
+        self.clock = clock
+        self.inflight_cost = 0.0
+        self._waiters = queue if queue is not None else FairQueue()
+
+    @property
+    def queue_depth(self):
+        """The number of requests waiting for budget."""
+        return len(self._waiters)
+
+    @property
+    def queued_cost(self):
+        """The total cost of the requests waiting for budget."""
+        return sum(cost for cost, _ in self._waiters)
+
+    def expected_wait(self, cost):
+        """
+        Estimate how long a request of the given cost would wait for admission.
+
+        Args:
+            cost: The cost of the request
+
+        Returns:
+            Seconds until the queued and in-flight work has drained enough,
+            or 0 if the request would be admitted at once
+        """
+        if not self._waiters and self._fits(cost):
+            return 0.0
+        backlog = self.inflight_cost + self.queued_cost + cost - self.max_inflight_cost
+        return max(backlog, 0.0) / self.throughput
+
+    def retry_after(self, cost):
+        """
+        Estimate how long until a request of the given cost could be admitted.
+
+        Args:
+            cost: The cost of the request
+
+        Returns:
+            Whole seconds until the queued and in-flight work has drained enough
+        """
+        return max(1, math.ceil(self.expected_wait(cost)))
+
+    def _fits(self, cost):
+        return self.inflight_cost + cost <= self.max_inflight_cost
+
+    def queue_limit(self, lane):
+        """
+        Get the number of requests allowed to wait in a lane.
+
+        Args:
+            lane: The priority lane
+
+        Returns:
+            The lane's queue limit
+        """
+        return self.max_batch_queue if lane == "batch" else self.max_queue
+
+    def request_limit(self, tiled=False):
+        """
+        Get the largest cost a single request may have.
+
+        A request costing more than the in-flight budget could never be
+        admitted, so no limit exceeds it.
+
+        Args:
+            tiled: Whether the request is a tiled generation
+
+        Returns:
+            The limit in cost units
+        """
+        limit = self.max_tiled_request_cost if tiled else self.max_request_cost
+        return min(limit, self.max_inflight_cost)
+
+    async def acquire(self, cost, client="default", lane="interactive", tiled=False):
+        """
+        Wait until a request can run and reserve its cost.
+
+        Args:
+            cost: The cost of the request
+            client: The name of the client making the request
+            lane: The priority lane of the request
+            tiled: Whether the request is a tiled generation, which has its
+                own per-request limit
+
+        Raises:
+            RequestTooExpensive: If the request exceeds the per-request budget
+            AdmissionRejected: If the budget is used up and the lane's queue is full
+        """
+        limit = self.request_limit(tiled)
+        if cost > limit:
+            raise RequestTooExpensive(cost, limit)
+
+        if not self._waiters and self._fits(cost):
+            self.inflight_cost += cost
+            return
+
+        if self._waiters.lane_size(lane) >= self.queue_limit(lane):
+            raise AdmissionRejected(self.retry_after(cost))
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.push(waiter, client, lane, cost)
+        # The new request may fit the free budget and come first, e.g. an
+        # interactive request behind a batch request that doesn't fit
+        self._wake()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Budget was already reserved for us; hand it back
+                self.release(cost)
+            else:
+                self._waiters.remove(waiter)
+                self._wake()
+            raise
+
+    def release(self, cost, duration=None):
+        """
+        Return the cost of a finished request to the budget and admit waiters.
+
+        Args:
+            cost: The cost of the finished request
+            duration: Optional time the request took, used to refine the
+                throughput estimate behind Retry-After
+        """
+        if duration:
+            # Exponentially weighted estimate; the work running alongside this
+            # request was progressing at the same time, so count all of it
+            observed = max(self.inflight_cost, cost) / duration
+            self.throughput = 0.8 * self.throughput + 0.2 * observed
+        self.inflight_cost = max(self.inflight_cost - cost, 0.0)
+        self._wake()
+
+    def _wake(self):
+        # Admit waiters in the fair queue's order while they fit; stopping at the
+        # first one that doesn't keep large requests from being starved by small ones
+        while True:
+            head = self._waiters.peek()
+            if head is None or not self._fits(head[0]):
+                break
+            cost, waiter = self._waiters.pop()
+            if waiter.done():
+                continue
+            self.inflight_cost += cost
+            waiter.set_result(None)
+
+    @asynccontextmanager
+    async def admit(self, cost, client="default", lane="interactive", tiled=False):
+        """
+        Hold budget for the duration of the enclosed block.
+
+        Args:
+            cost: The cost of the request
+            client: The name of the client making the request
+            lane: The priority lane of the request
+            tiled: Whether the request is a tiled generation
+        """
+        await self.acquire(cost, client, lane, tiled)
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.release(cost, duration=self.clock() - start)
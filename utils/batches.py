@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# batches.py - Persistent state of batch generation jobs, so interrupted batches can resume
+
+import json
+import os
+import uuid
+
+
+class BatchStore:
+    """
+    Store batch items and per-item results under a directory.
+
+    Each batch has two files: ``<batch_id>.json`` with the submitted items and
+    ``<batch_id>.jsonl`` with one record appended per finished item. The
+    results log doubles as the resume cursor: items with a successful record
+    are skipped when the batch is resubmitted.
+
+    Args:
+        root: The directory to keep batch files in
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _items_path(self, batch_id):
+        return os.path.join(self.root, f"{batch_id}.json")
+
+    def _results_path(self, batch_id):
+        return os.path.join(self.root, f"{batch_id}.jsonl")
+
+    def create(self, items):
+        """
+        Create a new batch.
+
+        Args:
+            items: A list of generation parameter dictionaries
+
+        Returns:
+            The id of the new batch
+        """
+        os.makedirs(self.root, exist_ok=True)
+        batch_id = str(uuid.uuid4())
+        with open(self._items_path(batch_id), "w") as f:
+            json.dump(items, f)
+        return batch_id
+
+    def exists(self, batch_id):
+        """
+        Check whether a batch exists.
+
+        Args:
+            batch_id: The id of the batch
+
+        Returns:
+            True if the batch exists; False for ids that aren't valid batch ids
+        """
+        try:
+            uuid.UUID(batch_id)
+        except ValueError:
+            return False
+        return os.path.exists(self._items_path(batch_id))
+
+    def load_items(self, batch_id):
+        """
+        Load the items of a batch.
+
+        Args:
+            batch_id: The id of the batch
+
+        Returns:
+            The list of generation parameter dictionaries
+        """
+        with open(self._items_path(batch_id)) as f:
+            return json.load(f)
+
+    def results(self, batch_id):
+        """
+        Load the latest result record of every finished item.
+
+        Args:
+            batch_id: The id of the batch
+
+        Returns:
+            A dictionary mapping item index to its latest record
+        """
+        records = {}
+        path = self._results_path(batch_id)
+        if not os.path.exists(path):
+            return records
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A record cut short by an interruption; the item will be redone
+                    continue
+                records[record["index"]] = record
+        return records
+
+    def append(self, batch_id, record):
+        """
+        Append the result record of a finished item.
+
+        Args:
+            batch_id: The id of the batch
+            record: The record, including the item's "index"
+        """
+        with open(self._results_path(batch_id), "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def status(self, batch_id):
+        """
+        Summarise the progress of a batch.
+
+        Args:
+            batch_id: The id of the batch
+
+        Returns:
+            A dictionary of item counts by state
+        """
+        total = len(self.load_items(batch_id))
+        records = self.results(batch_id).values()
+        succeeded = sum(1 for record in records if record["status"] == "success")
+        failed = sum(1 for record in records if record["status"] == "error")
+        return {
+            "batch_id": batch_id,
+            "total": total,
+            "succeeded": succeeded,
+            "failed": failed,
+            "pending": total - succeeded - failed,
+        }
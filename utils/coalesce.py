@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# coalesce.py - Single-flight coalescing of identical in-flight requests
+
+import asyncio
+import hashlib
+import json
+
+
+def normalize_prompt(prompt):
+    """
+    Normalise a prompt for request coalescing.
+
+    Only whitespace is normalised, which the CLIP tokenizers ignore anyway, so
+    prompts that normalise to the same string produce the same embeddings.
+
+    Args:
+        prompt: The prompt to normalise
+
+    Returns:
+        The normalised prompt, or None if no prompt was given
+    """
+    if prompt is None:
+        return None
+    return " ".join(prompt.split())
+
+
+def request_key(params):
+    """
+    Build the coalescing key of a generation request.
+
+    Args:
+        params: The full set of generation parameters, including the seed;
+            input images are keyed by their digest
+
+    Returns:
+        A hex digest identifying the normalised parameter set
+    """
+    normalized = {}
+    for name, value in params.items():
+        if name in ("prompt", "negative_prompt"):
+            value = normalize_prompt(value)
+        elif isinstance(value, float) and value.is_integer():
+            value = int(value)
+        elif isinstance(value, bytes):
+            value = hashlib.sha256(value).hexdigest()
+        normalized[name] = value
+    encoded = json.dumps(normalized, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+class SingleFlight:
+    """
+    Run a coroutine at most once at a time per key.
+
+    Callers that arrive while a call for the same key is in flight wait for
+    that call and share its result (or exception) instead of starting another.
+    """
+
+    def __init__(self):
+        self._in_flight = {}
+
+    def in_flight(self):
+        """
+        Get the number of distinct calls currently running.
+
+        Returns:
+            The number of in-flight keys
+        """
+        return len(self._in_flight)
+
+    async def do(self, key, fn):
+        """
+        Run ``fn`` for ``key``, or join the call already in flight for it.
+
+        Args:
+            key: The coalescing key
+            fn: A zero-argument callable returning a coroutine
+
+        Returns:
+            A tuple of the result and whether it was shared from another caller's call
+        """
+        task = self._in_flight.get(key)
+        shared = task is not None
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+
+        # Shield the shared task so one waiter disconnecting doesn't cancel it for the others
+        return await asyncio.shield(task), shared
+
+    def _forget(self, key, task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# compile.py - torch.compile support: resolution buckets and a persistent compile cache
+
+import os
+import time
+
+# Whether the deployment runs the UNet under torch.compile; only the torch
+# backend can be compiled
+COMPILE_ENABLED = os.environ.get("SD_COMPILE", "") == "1" and os.environ.get("SD_BACKEND", "torch") == "torch"
+
+# torch.compile mode used for the UNet
+COMPILE_MODE = os.environ.get("SD_COMPILE_MODE", "max-autotune-no-cudagraphs")
+
+# Denoising steps per warmup generation
+COMPILE_WARMUP_STEPS = int(os.environ.get("SD_COMPILE_WARMUP_STEPS", "4"))
+
+# Memory profile pinned in compiled mode. Switching profiles (offload hooks,
+# attention processors, memory format) would invalidate the compiled graphs.
+COMPILE_MEMORY_PROFILE = "balanced"
+
+# The SDXL training resolutions. In compiled mode every request is snapped to
+# one of these, so the UNet only ever sees this fixed set of shapes.
+RESOLUTION_BUCKETS = [
+    (1024, 1024),
+    (1152, 896),
+    (896, 1152),
+    (1216, 832),
+    (832, 1216),
+    (1344, 768),
+    (768, 1344),
+]
+
+
+def snap_to_bucket(width, height, buckets=RESOLUTION_BUCKETS):
+    """
+    Snap a requested size to the closest resolution bucket.
+
+    Buckets are compared by aspect ratio first and pixel count second.
+
+    Args:
+        width: The requested width
+        height: The requested height
+        buckets: The available (width, height) buckets
+
+    Returns:
+        The (width, height) of the selected bucket
+    """
+    aspect = width / height
+    area = width * height
+    return min(
+        buckets,
+        key=lambda bucket: (
+            round(abs(bucket[0] / bucket[1] - aspect), 2),
+            abs(bucket[0] * bucket[1] - area),
+        ),
+    )
+
+
+def configure_compile_cache(cache_dir):
+    """
+    Point the Inductor and Triton caches at a persistent directory.
+
+    Must be called before the first compilation. With the cache on the
+    models volume, new containers reuse the kernels and graphs compiled by
+    earlier ones instead of compiling from scratch.
+
+    Args:
+        cache_dir: The directory to keep the compile caches in
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.join(cache_dir, "inductor")
+    os.environ["TRITON_CACHE_DIR"] = os.path.join(cache_dir, "triton")
+    os.environ["TORCHINDUCTOR_FX_GRAPH_CACHE"] = "1"
+
+    import torch._inductor.config
+
+    torch._inductor.config.fx_graph_cache = True
+
+
+def compile_unet(pipe, mode=COMPILE_MODE):
+    """
+    Compile the pipeline's UNet in place.
+
+    Shapes are kept static (``dynamic=False``) so each resolution bucket gets
+    its own specialised graph.
+
+    Args:
+        pipe: The loaded pipeline
+        mode: The torch.compile mode
+    """
+    import torch
+
+    pipe.unet = torch.compile(pipe.unet, mode=mode, fullgraph=True, dynamic=False)
+
+
+def cache_counters():
+    """
+    Get the Inductor FX graph cache hit and miss counts of this process.
+
+    Returns:
+        A dictionary with "hits" and "misses"
+    """
+    from torch._dynamo.utils import counters
+
+    return {
+        "hits": counters["inductor"]["fxgraph_cache_hit"],
+        "misses": counters["inductor"]["fxgraph_cache_miss"],
+    }
+
+
+def warm_up_buckets(pipe, generate, buckets=RESOLUTION_BUCKETS):
+    """
+    Compile the UNet and warm up every resolution bucket.
+
+    Each bucket is timed three times: eagerly before compilation, on the
+    first compiled call (which includes compilation, or loading it from the
+    cache) and on a second compiled call.
+
+    Args:
+        pipe: The loaded pipeline, with its memory profile already applied
+        generate: Callable taking (width, height) that runs one short generation
+        buckets: The (width, height) buckets to warm up
+
+    Returns:
+        A compile report with per-bucket timings, speedups and cache counters
+    """
+    def timed(width, height):
+        start = time.perf_counter()
+        generate(width, height)
+        return time.perf_counter() - start
+
+    eager_seconds = {bucket: timed(*bucket) for bucket in buckets}
+
+    compile_unet(pipe)
+    report = {"mode": COMPILE_MODE, "buckets": []}
+    for bucket in buckets:
+        first_seconds = timed(*bucket)
+        steady_seconds = timed(*bucket)
+        entry = {
+            "width": bucket[0],
+            "height": bucket[1],
+            "eager_seconds": eager_seconds[bucket],
+            "compile_seconds": first_seconds - steady_seconds,
+            "compiled_seconds": steady_seconds,
+            "speedup": eager_seconds[bucket] / steady_seconds,
+        }
+        print(f"Warmed up bucket {bucket[0]}x{bucket[1]}: {entry}")
+        report["buckets"].append(entry)
+
+    report["cache"] = cache_counters()
+    report["compile_seconds"] = sum(entry["compile_seconds"] for entry in report["buckets"])
+    return report
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# concurrency.py - Scheduling the stages of concurrent requests inside a GPU container
+
+import os
+import threading
+from collections import deque
+
+from utils.pipelining import PIPELINE_MAX_INPUTS
+
+# Inputs a GPU container accepts at once. Only one of them uses the GPU at a
+# time; the others fetch embeddings, wait their turn, or save and encode their
+# images. Never fewer than pipelining needs.
+GPU_CONCURRENT_INPUTS = max(int(os.environ.get("SD_GPU_CONCURRENT_INPUTS", "4")), PIPELINE_MAX_INPUTS)
+
+
+class GpuLane:
+    """
+    Give the GPU stages of concurrent requests the shared pipeline one at a time.
+
+    Unlike a plain lock, waiters are served in the order they arrived, so a
+    request can't be overtaken again and again by later ones. A waiter that
+    fails or is interrupted while waiting leaves the line, so it never holds
+    up the requests behind it. Use it as a context manager, or call acquire
+    and release.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        # The holder of the lane first, then the waiters in arrival order
+        self._line = deque()
+
+    def acquire(self):
+        """
+        Wait for the lane.
+
+        Returns:
+            The number of requests that were ahead of this one
+        """
+        with self._condition:
+            ticket = object()
+            ahead = len(self._line)
+            self._line.append(ticket)
+            try:
+                self._condition.wait_for(lambda: self._line[0] is ticket)
+            except BaseException:
+                # Give up our place; if the lane had just been handed to us, pass it on
+                self._line.remove(ticket)
+                self._condition.notify_all()
+                raise
+        return ahead
+
+    def release(self):
+        """Hand the lane to the next waiting request."""
+        with self._condition:
+            self._line.popleft()
+            self._condition.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
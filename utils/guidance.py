@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# guidance.py - Classifier-free guidance cutoff and per-request UNet call and FLOP counts
+
+import threading
+from contextlib import contextmanager
+
+# Tensors the guidance cutoff needs from the SDXL pipeline's step callback
+CUTOFF_TENSOR_INPUTS = ["latents", "prompt_embeds", "add_text_embeds", "add_time_ids"]
+
+# FLOPs of one UNet evaluation per latent, measured on the first call of each
+# kind for each latent size and reused by later requests in the container
+_flops_per_sample = {}
+_flops_lock = threading.Lock()
+
+
+def guidance_cutoff_callback(cutoff, callback=None, guided_inputs=()):
+    """
+    Build a step callback that stops classifier-free guidance after a fraction of the steps.
+
+    Late steps refine detail and gain little from guidance, so from the
+    cutoff on the pipeline drops the unconditional half of the batch and
+    runs the UNet on the conditional latents only.
+
+    Args:
+        cutoff: Fraction of the steps to run with guidance; 1 keeps it throughout
+        callback: Optional callback_on_step_end to run first, e.g. a StageTimer's
+        guided_inputs: Names of other step tensors the pipeline doubles for
+            guidance, such as the inpainting mask
+
+    Returns:
+        A tuple of the callback_on_step_end and the
+        callback_on_step_end_tensor_inputs to pass to the pipeline
+    """
+    if cutoff >= 1:
+        return callback, ["latents"]
+
+    names = ["prompt_embeds", "add_text_embeds", "add_time_ids"] + list(guided_inputs)
+
+    def on_step_end(pipe, step, timestep, callback_kwargs):
+        if callback is not None:
+            callback_kwargs = callback(pipe, step, timestep, callback_kwargs)
+        # The callback runs after a step, so cut after the last guided one
+        if step == max(1, int(pipe.num_timesteps * cutoff)) - 1 and pipe.do_classifier_free_guidance:
+            # The batch is [unconditional, conditional]; keep the second half
+            for name in names:
+                if callback_kwargs[name] is not None:
+                    callback_kwargs[name] = callback_kwargs[name].chunk(2)[-1]
+            pipe._guidance_scale = 0.0
+        return callback_kwargs
+
+    return on_step_end, CUTOFF_TENSOR_INPUTS + list(guided_inputs)
+
+
+class UNetCounter:
+    """
+    Count the UNet calls of a request, the latents they evaluated and their FLOPs.
+
+    FLOPs are measured with torch's FlopCounterMode the first time a kind of
+    call is seen for a latent size, and scaled by the batch size after that.
+
+    Args:
+        unet: The pipeline's UNet2DConditionModel
+        num_images: Number of images the request generates; calls with a
+            larger batch are guided ones
+        kind: Optional callable naming the kind of the current call, for
+            calls whose cost differs with the same input (e.g. step caching)
+        measure_flops: Whether to measure FLOPs; compiled UNets can't run
+            under FlopCounterMode, so only their calls are counted
+    """
+
+    def __init__(self, unet, num_images=1, kind=None, measure_flops=True):
+        self.unet = unet
+        self.num_images = num_images
+        self.kind = kind
+        self.measure_flops = measure_flops
+        self.calls = 0
+        self.guided_calls = 0
+        self.samples = 0
+        self.flops = 0
+        self._hooks = []
+        self._measuring = None
+
+    def attach(self):
+        """Start counting the UNet's calls."""
+        self._hooks = [
+            self.unet.register_forward_pre_hook(self._before_unet, with_kwargs=True),
+            self.unet.register_forward_hook(self._after_unet),
+        ]
+
+    def detach(self):
+        """Stop counting, abandoning a measurement cut short by an error."""
+        for hook in self._hooks:
+            hook.remove()
+        self._hooks = []
+        if self._measuring is not None:
+            self._measuring[0].__exit__(None, None, None)
+            self._measuring = None
+
+    def _before_unet(self, module, args, kwargs):
+        from torch.utils.flop_counter import FlopCounterMode
+
+        sample = args[0] if args else kwargs["sample"]
+        batch = sample.shape[0]
+        self.calls += 1
+        self.samples += batch
+        if batch > self.num_images:
+            self.guided_calls += 1
+        if not self.measure_flops:
+            return
+
+        key = (tuple(sample.shape[1:]), self.kind() if self.kind is not None else "full")
+        with _flops_lock:
+            per_sample = _flops_per_sample.get(key)
+        if per_sample is not None:
+            self.flops += per_sample * batch
+            return
+        counter = FlopCounterMode(display=False)
+        counter.__enter__()
+        self._measuring = (counter, key, batch)
+
+    def _after_unet(self, module, args, output):
+        if self._measuring is None:
+            return
+        counter, key, batch = self._measuring
+        self._measuring = None
+        counter.__exit__(None, None, None)
+        flops = counter.get_total_flops()
+        with _flops_lock:
+            _flops_per_sample[key] = flops / batch
+        self.flops += flops
+
+    def stats(self):
+        """
+        Get the counts of the calls made while attached.
+
+        Returns:
+            A dictionary with the UNet calls, how many of them were guided,
+            the latents evaluated and the FLOPs (None when not measured)
+        """
+        return {
+            "calls": self.calls,
+            "guided_calls": self.guided_calls,
+            "samples": self.samples,
+            "flops": self.flops if self.measure_flops else None,
+        }
+
+
+@contextmanager
+def count_unet_calls(unet, num_images=1, kind=None, measure_flops=True):
+    """
+    Count the UNet calls made within the enclosed block.
+
+    Args:
+        unet: The pipeline's UNet2DConditionModel
+        num_images: Number of images the request generates
+        kind: Optional callable naming the kind of the current call
+        measure_flops: Whether to measure FLOPs as well as counting calls
+
+    Yields:
+        The attached UNetCounter
+    """
+    counter = UNetCounter(unet, num_images, kind, measure_flops)
+    counter.attach()
+    try:
+        yield counter
+    finally:
+        counter.detach()
@@ -6,6 +6,7 @@ import base64
 from io import BytesIO
 from PIL import Image
 import time
+import random
 import logging
 
 # Set up logging
@@ -100,4 +101,44 @@ def generate_filename(prompt):
     """
     timestamp = get_timestamp()
     cleaned_prompt = clean_prompt(prompt)
-    return f"{timestamp}_{cleaned_prompt}.png" 
\ No newline at end of file
+    return f"{timestamp}_{cleaned_prompt}.png"
+
+def resolve_seeds(num_images, seeds=None, seed=None):
+    """
+    Work out one seed per image of a request.
+    
+    Args:
+        num_images: The number of images to generate
+        seeds: Optional explicit list with one seed per image
+        seed: Optional base seed; image i uses seed + i
+    
+    Returns:
+        A list of num_images seeds; random ones if neither seeds nor seed is given
+    
+    Raises:
+        ValueError: If the number of seeds doesn't match num_images
+    """
+    if seeds is not None:
+        if len(seeds) != num_images:
+            raise ValueError(f"Expected {num_images} seeds, got {len(seeds)}")
+        return list(seeds)
+    if seed is not None:
+        return [seed + i for i in range(num_images)]
+    return [random.randint(0, 2 ** 32 - 1) for _ in range(num_images)]
+
+def numbered_output_paths(output_path, count):
+    """
+    Derive the output paths of the images of a multi-image request.
+    
+    The first image keeps output_path; image i is saved next to it with an
+    _i suffix, e.g. /images/abc.png, /images/abc_1.png, /images/abc_2.png.
+    
+    Args:
+        output_path: The path of the first image
+        count: The number of images
+    
+    Returns:
+        A list of count output paths
+    """
+    stem, extension = os.path.splitext(output_path)
+    return [output_path] + [f"{stem}_{i}{extension}" for i in range(1, count)]
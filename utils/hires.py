@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# hires.py - Two-pass "hires fix" generation: denoise small, upscale the latents, refine at full size
+
+import os
+
+# Largest hires_scale accepted; beyond this the base image is too small for
+# the refinement pass to recover the composition
+MAX_HIRES_SCALE = 4.0
+
+# Fraction of the noise schedule the refinement pass re-runs by default;
+# lower keeps more of the base image, higher adds more detail at full size
+HIRES_STRENGTH = float(os.environ.get("SD_HIRES_STRENGTH", "0.5"))
+
+# Base pass sizes are rounded to a multiple of this, so the latents divide
+# evenly through the UNet's downsampling blocks
+HIRES_SIZE_MULTIPLE = 64
+
+
+def hires_base_size(width, height, scale):
+    """
+    Get the size the base pass of a hires generation denoises at.
+
+    Args:
+        width: The width of the requested image
+        height: The height of the requested image
+        scale: Factor the base pass is smaller than the requested image by
+
+    Returns:
+        A tuple of the base width and height
+    """
+    return tuple(
+        max(HIRES_SIZE_MULTIPLE, round(size / scale / HIRES_SIZE_MULTIPLE) * HIRES_SIZE_MULTIPLE)
+        for size in (width, height)
+    )
+
+
+def hires_plan(width, height, num_inference_steps, scale, strength=None):
+    """
+    Get the two passes of a hires generation.
+
+    Args:
+        width: The width of the requested image
+        height: The height of the requested image
+        num_inference_steps: Number of denoising steps of the base pass
+        scale: Factor the base pass is smaller than the requested image by
+        strength: Fraction of the schedule the refinement re-runs; defaults
+            to HIRES_STRENGTH
+
+    Returns:
+        A dictionary with the "base" size, "scale", "strength" and "refine_steps"
+    """
+    from utils.images import denoising_steps
+
+    strength = HIRES_STRENGTH if strength is None else strength
+    return {
+        "base": list(hires_base_size(width, height, scale)),
+        "scale": scale,
+        "strength": strength,
+        "refine_steps": denoising_steps(num_inference_steps, strength),
+    }
+
+
+def upscale_latents(latents, width, height, vae_scale_factor=8):
+    """
+    Resize denoised latents to the latent size of an image.
+
+    Args:
+        latents: The latents of the base pass, as returned with output_type="latent"
+        width: The width of the image the latents should decode to
+        height: The height of the image the latents should decode to
+        vae_scale_factor: Pixels per latent along each side (8 for SDXL)
+
+    Returns:
+        The upscaled latents
+    """
+    import torch.nn.functional as F
+
+    size = (height // vae_scale_factor, width // vae_scale_factor)
+    return F.interpolate(latents, size=size, mode="bicubic", align_corners=False)
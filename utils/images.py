@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# images.py - Reading and preparing the input images of img2img and inpainting requests
+
+import io
+import os
+
+from PIL import Image
+
+# Largest upload accepted for an input image or mask
+MAX_UPLOAD_BYTES = int(os.environ.get("SD_MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+
+# Largest input image accepted, in pixels; checked from the image header
+# before anything is decoded
+MAX_INPUT_PIXELS = int(os.environ.get("SD_MAX_INPUT_PIXELS", str(4096 * 4096)))
+
+# Input images larger than this are generated at a smaller size with the same
+# aspect ratio when the request doesn't give one
+EDIT_DEFAULT_PIXELS = 1024 * 1024
+
+# Fraction of the noise schedule re-run when a request doesn't give a
+# strength; inpainting regenerates the masked area from pure noise
+IMG2IMG_STRENGTH = float(os.environ.get("SD_IMG2IMG_STRENGTH", "0.75"))
+INPAINT_STRENGTH = 1.0
+
+# Bytes read from an upload at a time
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Bytes a multipart request body may hold beyond its files, for the form
+# framing and headers
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+
+class InvalidImage(ValueError):
+    """Raised when an uploaded file can't be used as an input image."""
+
+
+async def read_upload(upload, max_bytes=MAX_UPLOAD_BYTES):
+    """
+    Read an uploaded file in chunks, rejecting it once it is larger than max_bytes.
+
+    The form has already been parsed and spooled by the time the endpoint
+    runs, so this only bounds what is copied into memory; request bodies
+    too large for their files are rejected before parsing (see
+    max_request_bytes).
+
+    Args:
+        upload: The FastAPI UploadFile
+        max_bytes: Largest size accepted
+
+    Returns:
+        The contents of the file
+
+    Raises:
+        InvalidImage: If the file is empty or larger than max_bytes
+    """
+    chunks = []
+    size = 0
+    while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+        size += len(chunk)
+        if size > max_bytes:
+            raise InvalidImage(f"{upload.filename or 'Upload'} is larger than {max_bytes} bytes")
+        chunks.append(chunk)
+    if not size:
+        raise InvalidImage(f"{upload.filename or 'Upload'} is empty")
+    return b"".join(chunks)
+
+
+def max_request_bytes(files, max_bytes=MAX_UPLOAD_BYTES):
+    """
+    Get the largest request body accepted for a multipart upload.
+
+    Args:
+        files: Number of files the request uploads
+        max_bytes: Largest size accepted for each file
+
+    Returns:
+        The limit in bytes
+    """
+    return files * max_bytes + MULTIPART_OVERHEAD_BYTES
+
+
+def decode_image(data, mode="RGB", max_pixels=MAX_INPUT_PIXELS):
+    """
+    Decode an encoded image (PNG, JPEG, WebP, ...).
+
+    Args:
+        data: The encoded image
+        mode: The PIL mode to convert to; "L" for masks
+        max_pixels: Largest image accepted, in pixels
+
+    Returns:
+        The decoded PIL image
+
+    Raises:
+        InvalidImage: If the data isn't a readable image or is too large
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+    except Exception as e:
+        raise InvalidImage(f"Not a readable image: {str(e)}")
+    if image.width * image.height > max_pixels:
+        raise InvalidImage(f"Image is {image.width}x{image.height}, larger than {max_pixels} pixels")
+    try:
+        return image.convert(mode)
+    except Exception as e:
+        raise InvalidImage(f"Could not decode image: {str(e)}")
+
+
+def edit_size(width, height, max_pixels=EDIT_DEFAULT_PIXELS, multiple=8):
+    """
+    Get the size to generate at for an input image when the request doesn't give one.
+
+    Args:
+        width: The width of the input image
+        height: The height of the input image
+        max_pixels: Largest size to generate at, in pixels
+        multiple: The pipeline needs sizes divisible by this
+
+    Returns:
+        A tuple of the width and height, with the input's aspect ratio
+    """
+    scale = min(1.0, (max_pixels / (width * height)) ** 0.5)
+    return tuple(max(multiple, int(size * scale) // multiple * multiple) for size in (width, height))
+
+
+def prepare_input_image(data, width, height, mode="RGB"):
+    """
+    Decode an input image and resize it to the size it is generated at.
+
+    Args:
+        data: The encoded image
+        width: The width to generate at
+        height: The height to generate at
+        mode: The PIL mode to convert to; "L" for masks
+
+    Returns:
+        The PIL image
+    """
+    image = decode_image(data, mode)
+    if image.size != (width, height):
+        image = image.resize((width, height), Image.LANCZOS)
+    return image
+
+
+def denoising_steps(num_inference_steps, strength):
+    """
+    Get the number of steps run when only part of the schedule is denoised.
+
+    Mirrors how the img2img and inpainting pipelines truncate their schedule
+    by strength, so partial denoising is charged for the steps it runs.
+
+    Args:
+        num_inference_steps: Number of denoising steps of a full schedule
+        strength: Fraction of the schedule that is re-run
+
+    Returns:
+        The number of steps run
+    """
+    return min(int(num_inference_steps * strength), num_inference_steps)
@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# latency.py - Latency model fitted from recorded stage timings, used for ETAs
+
+import os
+
+from utils.admission import SAMPLER_FACTORS
+
+# Seconds per megapixel-step assumed before any request has been observed
+# (SDXL on an A10G runs about three 1024x1024 steps per second)
+PRIOR_STEP_SECONDS = float(os.environ.get("SD_LATENCY_PRIOR_STEP_SECONDS", "0.33"))
+
+# Seconds outside the denoising loop assumed before any request has been observed
+PRIOR_OVERHEAD_SECONDS = float(os.environ.get("SD_LATENCY_PRIOR_OVERHEAD_SECONDS", "3"))
+
+# Requests of one exact shape observed before their own average is trusted
+# over the model fitted across shapes
+EXACT_MIN_SAMPLES = int(os.environ.get("SD_LATENCY_EXACT_MIN_SAMPLES", "5"))
+
+# Factor older observations are weighted down by on every new one, so the
+# model follows changes such as a new checkpoint or compiled mode
+LATENCY_DECAY = 0.98
+
+# What each stage's duration grows with: the denoising work (megapixel-steps),
+# the refinement work of hires generations (megapixel-steps at full size),
+# the pixels produced (megapixels), or nothing. Stages not listed are
+# treated as constant.
+STAGE_DRIVERS = {
+    "denoise": "work",
+    "hires_refine": "refine_work",
+    "vae_decode": "pixels",
+    "volume_write": "pixels",
+    "image_encode": "pixels",
+    "image_decode": "pixels",
+}
+
+# Stages that measure contention rather than the request itself; they are
+# folded into the overhead instead of being fitted
+LOAD_STAGES = ("gpu_wait",)
+
+# Kinds of request, which run different stages (e.g. only img2img and
+# inpainting decode an input image, only hires generations refine) and so
+# are fitted separately
+REQUEST_KINDS = ("txt2img", "img2img", "inpaint", "hires")
+
+# Version of the saved model state; state saved by an older version is discarded
+LATENCY_STATE_VERSION = 3
+
+
+def request_kind(params):
+    """
+    Get the kind of a generation request.
+
+    Args:
+        params: The generation parameters accepted by StableDiffusionModel.generate_image
+
+    Returns:
+        One of REQUEST_KINDS
+    """
+    if params.get("mask_image") is not None:
+        return "inpaint"
+    if params.get("init_image") is not None:
+        return "img2img"
+    if params.get("hires_scale", 1.0) > 1:
+        return "hires"
+    return "txt2img"
+
+
+def request_drivers(width, height, num_inference_steps, num_images=1, sampler="default", hires=None):
+    """
+    Get the quantities the stage durations of a request grow with.
+
+    Args:
+        width: The width of the generated image
+        height: The height of the generated image
+        num_inference_steps: Number of denoising steps
+        num_images: Number of images generated by the request
+        sampler: The sampler used for denoising
+        hires: The passes of a hires generation, from hires_plan; its base
+            pass denoises at the base size, its refinement at full size
+
+    Returns:
+        A dictionary with the "work", "refine_work", "pixels" and "constant" drivers
+    """
+    factor = SAMPLER_FACTORS.get(sampler, 1.0)
+    pixels = width * height / 1_000_000 * num_images
+    base_pixels, refine_work = pixels, 0.0
+    if hires is not None:
+        base_width, base_height = hires["base"]
+        base_pixels = base_width * base_height / 1_000_000 * num_images
+        refine_work = pixels * hires["refine_steps"] * factor
+    return {
+        "work": base_pixels * num_inference_steps * factor,
+        "refine_work": refine_work,
+        "pixels": pixels,
+        "constant": 1.0,
+    }
+
+
+class RunningFit:
+    """
+    Least-squares line through exponentially decayed (x, y) observations.
+
+    With a single value of x observed there is no slope to fit, so
+    predictions scale the mean in proportion to x instead.
+
+    Args:
+        decay: Factor the weight of older observations is multiplied by on
+            every new observation
+    """
+
+    def __init__(self, decay=LATENCY_DECAY):
+        self.decay = decay
+        self.sums = [0.0] * 5  # weight, x, y, x*x, x*y
+
+    def observe(self, x, y):
+        """
+        Add an observation.
+
+        Args:
+            x: The driver value of the request
+            y: The observed duration in seconds
+        """
+        self.sums = [total * self.decay + value for total, value in zip(self.sums, (1.0, x, y, x * x, x * y))]
+
+    def predict(self, x):
+        """
+        Predict the duration for a driver value.
+
+        Args:
+            x: The driver value of the request
+
+        Returns:
+            The predicted duration in seconds, or None without observations
+        """
+        weight, sx, sy, sxx, sxy = self.sums
+        if weight <= 0:
+            return None
+        mean_x, mean_y = sx / weight, sy / weight
+        variance = sxx / weight - mean_x * mean_x
+        if variance <= 1e-6 * max(mean_x * mean_x, 1e-12):
+            return mean_y * x / mean_x if mean_x > 0 else mean_y
+        slope = (sxy / weight - mean_x * mean_y) / variance
+        return max(0.0, mean_y + slope * (x - mean_x))
+
+
+class LatencyModel:
+    """
+    Predict how long a generation takes once admitted, from the timings of earlier ones.
+
+    Each stage is fitted against what its duration grows with (see
+    STAGE_DRIVERS), per model, sampler and request kind, and a prediction
+    sums only the stages fitted for its kind. Whatever the stages don't
+    account for (RPC, container queueing, waiting for the GPU) is tracked as
+    a running average overhead. Once a request shape has been seen
+    EXACT_MIN_SAMPLES times, its own running average is used instead.
+
+    Args:
+        decay: Factor older observations are weighted down by
+        exact_min_samples: Observations of a shape before its own average is used
+    """
+
+    def __init__(self, decay=LATENCY_DECAY, exact_min_samples=EXACT_MIN_SAMPLES):
+        self.decay = decay
+        self.exact_min_samples = exact_min_samples
+        self.model_id = None
+        self.observations = 0
+        self.overhead = None
+        self._fits = {}
+        self._exact = {}
+
+    @staticmethod
+    def _shape_key(model_id, width, height, num_inference_steps, num_images, sampler, kind, hires):
+        key = f"{model_id}|{sampler}|{kind}|{width}x{height}|{num_inference_steps}|{num_images}"
+        if hires is not None:
+            key += f"|{hires['base'][0]}x{hires['base'][1]}|{hires['refine_steps']}"
+        return key
+
+    def observe(
+        self,
+        model_id,
+        width,
+        height,
+        num_inference_steps,
+        stages,
+        seconds,
+        num_images=1,
+        sampler="default",
+        kind="txt2img",
+        hires=None,
+    ):
+        """
+        Fold the timings of a finished request into the model.
+
+        Args:
+            model_id: The checkpoint the request ran on
+            width: The width of the generated image
+            height: The height of the generated image
+            num_inference_steps: Number of denoising steps
+            stages: The per-stage durations reported for the request
+            seconds: The time from admission to the result
+            num_images: Number of images generated by the request
+            sampler: The sampler used for denoising
+            kind: The kind of request, one of REQUEST_KINDS
+            hires: The passes of a hires generation, as reported in its result
+        """
+        drivers = request_drivers(width, height, num_inference_steps, num_images, sampler, hires)
+        fitted = 0.0
+        for stage, duration in stages.items():
+            if stage in LOAD_STAGES:
+                continue
+            key = f"{model_id}|{sampler}|{kind}|{stage}"
+            fit = self._fits.setdefault(key, RunningFit(self.decay))
+            fit.observe(drivers[STAGE_DRIVERS.get(stage, "constant")], duration)
+            fitted += duration
+
+        # Plain means while there are few observations, decayed averages after
+        self.observations += 1
+        overhead = max(seconds - fitted, 0.0)
+        weight = max(1 / self.observations, 1 - self.decay)
+        self.overhead = overhead if self.overhead is None else self.overhead + weight * (overhead - self.overhead)
+
+        key = self._shape_key(model_id, width, height, num_inference_steps, num_images, sampler, kind, hires)
+        exact = self._exact.setdefault(key, {"seconds": seconds, "samples": 0})
+        exact["samples"] += 1
+        exact["seconds"] += max(1 / exact["samples"], 1 - self.decay) * (seconds - exact["seconds"])
+
+        self.model_id = model_id
+
+    def predict(
+        self,
+        width,
+        height,
+        num_inference_steps,
+        num_images=1,
+        sampler="default",
+        model_id=None,
+        kind="txt2img",
+        hires=None,
+    ):
+        """
+        Predict how long a request takes from admission to result.
+
+        Args:
+            width: The width of the generated image
+            height: The height of the generated image
+            num_inference_steps: Number of denoising steps
+            num_images: Number of images generated by the request
+            sampler: The sampler used for denoising
+            model_id: The checkpoint; defaults to the most recently observed one
+            kind: The kind of request, one of REQUEST_KINDS
+            hires: The passes of a hires generation, from hires_plan
+
+        Returns:
+            A dictionary with the predicted "seconds", the per-stage "stages"
+            (when fitted), the "basis" of the prediction ("exact", "fitted"
+            or "prior") and the number of "samples" behind it
+        """
+        model_id = model_id or self.model_id
+        drivers = request_drivers(width, height, num_inference_steps, num_images, sampler, hires)
+
+        exact = self._exact.get(
+            self._shape_key(model_id, width, height, num_inference_steps, num_images, sampler, kind, hires)
+        )
+        if exact is not None and exact["samples"] >= self.exact_min_samples:
+            return {"seconds": exact["seconds"], "stages": None, "basis": "exact", "samples": exact["samples"]}
+
+        prefix = f"{model_id}|{sampler}|{kind}|"
+        stages = {}
+        for key, fit in self._fits.items():
+            if key.startswith(prefix):
+                stage = key[len(prefix):]
+                stages[stage] = fit.predict(drivers[STAGE_DRIVERS.get(stage, "constant")])
+        if stages:
+            seconds = sum(stages.values()) + (self.overhead or 0.0)
+            return {"seconds": seconds, "stages": stages, "basis": "fitted", "samples": self.observations}
+
+        seconds = (drivers["work"] + drivers["refine_work"]) * PRIOR_STEP_SECONDS + PRIOR_OVERHEAD_SECONDS
+        return {"seconds": seconds, "stages": None, "basis": "prior", "samples": 0}
+
+    def to_dict(self):
+        """
+        Get the state of the model, for sharing between web containers.
+
+        Returns:
+            A JSON-serialisable dictionary
+        """
+        return {
+            "version": LATENCY_STATE_VERSION,
+            "decay": self.decay,
+            "exact_min_samples": self.exact_min_samples,
+            "model_id": self.model_id,
+            "observations": self.observations,
+            "overhead": self.overhead,
+            "fits": {key: fit.sums for key, fit in self._fits.items()},
+            "exact": self._exact,
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        """
+        Restore a model saved with to_dict.
+
+        State saved by an older version of the model, whose fits aren't
+        comparable, gives a fresh model.
+
+        Args:
+            state: The saved state
+
+        Returns:
+            The LatencyModel
+        """
+        if state.get("version") != LATENCY_STATE_VERSION:
+            return cls(state["decay"], state["exact_min_samples"])
+        model = cls(state["decay"], state["exact_min_samples"])
+        model.model_id = state["model_id"]
+        model.observations = state["observations"]
+        model.overhead = state["overhead"]
+        for key, sums in state["fits"].items():
+            fit = RunningFit(model.decay)
+            fit.sums = list(sums)
+            model._fits[key] = fit
+        model._exact = {key: dict(exact) for key, exact in state["exact"].items()}
+        return model
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# memory.py - Memory-optimisation profiles for the SDXL pipeline
+
+import os
+
+# Memory profile used when a request doesn't ask for one: a profile name or "auto"
+DEFAULT_MEMORY_PROFILE = os.environ.get("SD_MEMORY_PROFILE", "auto")
+
+# Profiles ordered from fastest to leanest. resident_gb is the weight memory kept
+# on the GPU and gb_per_megapixel the peak activation memory per output megapixel;
+# both are rough fp16 SDXL estimates used for automatic selection (the benchmark
+# suite measures the real peaks).
+MEMORY_PROFILES = {
+    "fast": {
+        "vae_slicing": False,
+        "vae_tiling": False,
+        "attention_slicing": False,
+        "sdpa": True,
+        "channels_last": True,
+        "offload": None,
+        "resident_gb": 7.0,
+        "gb_per_megapixel": 10.0,
+    },
+    "balanced": {
+        "vae_slicing": True,
+        "vae_tiling": True,
+        "attention_slicing": False,
+        "sdpa": True,
+        "channels_last": True,
+        "offload": None,
+        "resident_gb": 7.0,
+        "gb_per_megapixel": 3.0,
+    },
+    "low_vram": {
+        "vae_slicing": True,
+        "vae_tiling": True,
+        "attention_slicing": True,
+        "sdpa": False,
+        "channels_last": False,
+        "offload": "model",
+        "resident_gb": 5.2,
+        "gb_per_megapixel": 2.0,
+    },
+    "minimal": {
+        "vae_slicing": True,
+        "vae_tiling": True,
+        "attention_slicing": True,
+        "sdpa": False,
+        "channels_last": False,
+        "offload": "sequential",
+        "resident_gb": 0.5,
+        "gb_per_megapixel": 2.0,
+    },
+}
+
+# Fraction of total GPU memory automatic selection is allowed to plan for
+MEMORY_HEADROOM = 0.9
+
+# Part of resident_gb taken by the two fp16 text encoders, which aren't loaded
+# on the GPU when prompts are encoded by the CPU workers
+TEXT_ENCODERS_GB = 1.6
+
+
+def estimate_peak_gb(profile_name, width, height, num_images=1, text_encoders=True, weight_savings_gb=0.0):
+    """
+    Estimate the peak GPU memory of a generation with a memory profile.
+
+    Args:
+        profile_name: The name of the memory profile
+        width: The width of the generated image
+        height: The height of the generated image
+        num_images: The number of images generated in one batch
+        text_encoders: Whether the text encoders are loaded on the GPU
+        weight_savings_gb: Weight memory saved by quantisation
+
+    Returns:
+        The estimated peak memory in GB
+    """
+    profile = MEMORY_PROFILES[profile_name]
+    megapixels = width * height * num_images / 1_000_000
+    resident_gb = profile["resident_gb"]
+    if not text_encoders and profile["offload"] is None:
+        # Offloading profiles already keep the text encoders off the GPU
+        resident_gb -= TEXT_ENCODERS_GB
+    if profile["offload"] is None:
+        resident_gb -= weight_savings_gb
+    return resident_gb + profile["gb_per_megapixel"] * megapixels
+
+
+def select_memory_profile(width, height, total_memory_bytes, num_images=1, text_encoders=True, weight_savings_gb=0.0):
+    """
+    Pick the fastest memory profile expected to fit on the GPU.
+
+    Args:
+        width: The width of the generated image
+        height: The height of the generated image
+        total_memory_bytes: Total memory of the GPU in bytes
+        num_images: The number of images generated in one batch
+        text_encoders: Whether the text encoders are loaded on the GPU
+        weight_savings_gb: Weight memory saved by quantisation
+
+    Returns:
+        The name of the selected profile; the leanest profile if none fits
+    """
+    budget_gb = total_memory_bytes * MEMORY_HEADROOM / 1024 ** 3
+    for name in MEMORY_PROFILES:
+        if estimate_peak_gb(name, width, height, num_images, text_encoders, weight_savings_gb) <= budget_gb:
+            return name
+    return list(MEMORY_PROFILES)[-1]
+
+
+def resolve_memory_profile(
+    requested, width, height, total_memory_bytes, num_images=1, text_encoders=True, weight_savings_gb=0.0
+):
+    """
+    Resolve the memory profile for a request.
+
+    Args:
+        requested: The profile requested by the caller, "auto" or None for the
+            deployment default (SD_MEMORY_PROFILE)
+        width: The width of the generated image
+        height: The height of the generated image
+        total_memory_bytes: Total memory of the GPU in bytes
+        num_images: The number of images generated in one batch
+        text_encoders: Whether the text encoders are loaded on the GPU
+        weight_savings_gb: Weight memory saved by quantisation
+
+    Returns:
+        The name of the memory profile to use
+
+    Raises:
+        ValueError: If the profile name is unknown
+    """
+    name = requested or DEFAULT_MEMORY_PROFILE
+    if name == "auto":
+        return select_memory_profile(width, height, total_memory_bytes, num_images, text_encoders, weight_savings_gb)
+    if name not in MEMORY_PROFILES:
+        raise ValueError(f"Unknown memory profile: {name}")
+    return name
+
+
+def apply_memory_profile(pipe, profile_name, device="cuda"):
+    """
+    Configure a loaded pipeline for a memory profile.
+
+    Profiles can be switched between requests on the same resident pipeline;
+    applying the profile that is already active is a no-op.
+
+    Args:
+        pipe: The loaded StableDiffusionXLPipeline
+        profile_name: The name of the memory profile
+        device: The device to run on when the profile doesn't offload
+    """
+    if getattr(pipe, "_memory_profile", None) == profile_name:
+        return
+
+    import torch
+    from diffusers.models.attention_processor import AttnProcessor2_0
+
+    profile = MEMORY_PROFILES[profile_name]
+    print(f"Applying memory profile: {profile_name}")
+
+    # Placement: offloading installs accelerate hooks, which have to be removed
+    # before the pipeline can live on the GPU again
+    if profile["offload"] == "model":
+        pipe.remove_all_hooks()
+        pipe.enable_model_cpu_offload()
+    elif profile["offload"] == "sequential":
+        pipe.remove_all_hooks()
+        pipe.enable_sequential_cpu_offload()
+    else:
+        if getattr(pipe, "_memory_profile", None) is not None:
+            pipe.remove_all_hooks()
+        pipe.to(device)
+
+    if profile["vae_slicing"]:
+        pipe.vae.enable_slicing()
+    else:
+        pipe.vae.disable_slicing()
+
+    if profile["vae_tiling"]:
+        pipe.vae.enable_tiling()
+    else:
+        pipe.vae.disable_tiling()
+
+    if profile["attention_slicing"]:
+        pipe.enable_attention_slicing()
+    else:
+        pipe.disable_attention_slicing()
+        if profile["sdpa"]:
+            pipe.unet.set_attn_processor(AttnProcessor2_0())
+
+    memory_format = torch.channels_last if profile["channels_last"] else torch.contiguous_format
+    pipe.unet.to(memory_format=memory_format)
+
+    pipe._memory_profile = profile_name
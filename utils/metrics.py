@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# metrics.py - Stage timers and Prometheus metrics for the Stable Diffusion application
+
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# Buckets (in seconds) shared by the stage histograms. Generation stages range
+# from a few milliseconds (image encode) to a few minutes (cold pipeline load).
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+# Buckets (in seconds) for a single denoising step
+STEP_BUCKETS = (0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.5, 1.0, 2.5)
+
+STAGE_SECONDS = Histogram(
+    "sd_stage_seconds",
+    "Time spent in each stage of an image generation request",
+    ["stage"],
+    buckets=STAGE_BUCKETS,
+)
+DENOISE_STEP_SECONDS = Histogram(
+    "sd_denoise_step_seconds",
+    "Time spent in a single denoising step",
+    buckets=STEP_BUCKETS,
+)
+REQUEST_SECONDS = Histogram(
+    "sd_request_seconds",
+    "End-to-end latency of a generation request as seen by the web tier",
+    buckets=STAGE_BUCKETS,
+)
+REQUESTS_TOTAL = Counter(
+    "sd_requests_total",
+    "Generation requests handled by the web tier",
+    ["status"],
+)
+COALESCED_REQUESTS_TOTAL = Counter(
+    "sd_coalesced_requests_total",
+    "Generation requests served by joining an identical request already in flight",
+)
+ADMISSION_REJECTIONS_TOTAL = Counter(
+    "sd_admission_rejections_total",
+    "Generation requests rejected by admission control",
+    ["reason"],
+)
+INFLIGHT_COST = Gauge(
+    "sd_inflight_cost",
+    "Estimated cost (megapixel-steps) of the generation requests currently admitted",
+)
+QUEUE_DEPTH = Gauge(
+    "sd_queue_depth",
+    "Generation requests waiting for admission",
+)
+DENOISE_STEPS_TOTAL = Counter(
+    "sd_denoise_steps_total",
+    "Denoising steps executed",
+)
+ETA_ERROR_SECONDS = Histogram(
+    "sd_eta_error_seconds",
+    "Absolute difference between the predicted and actual latency of a generation request",
+    buckets=STAGE_BUCKETS,
+)
+ETA_RATIO = Histogram(
+    "sd_eta_ratio",
+    "Actual latency of a generation request divided by its predicted latency",
+    buckets=(0.25, 0.5, 0.67, 0.8, 0.9, 1.0, 1.1, 1.25, 1.5, 2.0, 4.0),
+)
+
+
+class StageTimer:
+    """
+    Record the wall time of the named stages of a single generation request.
+
+    Args:
+        sync: Optional callable invoked before each clock reading, e.g.
+            ``torch.cuda.synchronize`` so queued GPU work is attributed to
+            the stage that launched it
+    """
+
+    def __init__(self, sync=None):
+        self.sync = sync
+        self.stages = {}
+        self.steps = []
+        self.spans = []
+        self._start = time.perf_counter()
+        self._last_step = None
+
+    def _now(self, sync=True):
+        if sync and self.sync is not None:
+            self.sync()
+        return time.perf_counter()
+
+    @contextmanager
+    def stage(self, name, sync=True):
+        """
+        Time the enclosed block and record it under ``name``.
+
+        Args:
+            name: The name of the stage
+            sync: Whether to call ``sync`` around the stage; CPU-only stages
+                skip it so they don't wait for GPU work they didn't launch
+        """
+        start = self._now(sync)
+        start_ns = time.time_ns()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + self._now(sync) - start
+            self.add_span(name, start_ns, time.time_ns())
+
+    def add_span(self, name, start_ns, end_ns, **attributes):
+        """
+        Record a span with wall-clock start and end times.
+
+        Stages timed with ``stage`` are recorded automatically; this is for
+        phases measured some other way, such as the time spent queueing.
+
+        Args:
+            name: The name of the span
+            start_ns: Start time in nanoseconds since the epoch
+            end_ns: End time in nanoseconds since the epoch
+            **attributes: Extra attributes to attach to the span
+        """
+        self.spans.append({"name": name, "start_ns": start_ns, "end_ns": end_ns, "attributes": attributes})
+
+    def start_steps(self):
+        """Mark the start of the denoising loop so the first step can be timed."""
+        self._last_step = self._now()
+
+    def step_callback(self, pipe, step, timestep, callback_kwargs):
+        """
+        Record the duration of a denoising step.
+
+        Matches the ``callback_on_step_end`` signature of diffusers pipelines.
+        """
+        now = self._now()
+        if self._last_step is not None:
+            self.steps.append(now - self._last_step)
+        self._last_step = now
+        return callback_kwargs
+
+    def as_dict(self):
+        """
+        Get the recorded timings.
+
+        Returns:
+            A dictionary of stage durations, per-step durations and the total
+            time since the timer was created, all in seconds
+        """
+        return {
+            "stages": dict(self.stages),
+            "steps": list(self.steps),
+            "total": time.perf_counter() - self._start,
+        }
+
+
+def observe_timings(timings, rpc_seconds=None):
+    """
+    Aggregate the timings returned by ``generate_image`` into the Prometheus metrics.
+
+    Args:
+        timings: The timings dictionary produced by ``StageTimer.as_dict``
+        rpc_seconds: Optional round-trip time of the remote call measured by the
+            web tier; the difference from the model-side total is recorded as
+            the ``rpc_overhead`` stage
+
+    Returns:
+        The RPC overhead in seconds, or None if it could not be computed
+    """
+    for stage, seconds in timings.get("stages", {}).items():
+        STAGE_SECONDS.labels(stage=stage).observe(seconds)
+    for seconds in timings.get("steps", []):
+        DENOISE_STEP_SECONDS.observe(seconds)
+    DENOISE_STEPS_TOTAL.inc(len(timings.get("steps", [])))
+
+    overhead = None
+    if rpc_seconds is not None and "total" in timings:
+        overhead = max(rpc_seconds - timings["total"], 0.0)
+        STAGE_SECONDS.labels(stage="rpc_overhead").observe(overhead)
+    return overhead
+
+
+def observe_prediction(predicted_seconds, actual_seconds):
+    """
+    Record how far a latency prediction was off.
+
+    Args:
+        predicted_seconds: The latency predicted when the request arrived
+        actual_seconds: The latency the request actually had
+    """
+    ETA_ERROR_SECONDS.observe(abs(actual_seconds - predicted_seconds))
+    if predicted_seconds > 0:
+        ETA_RATIO.observe(actual_seconds / predicted_seconds)
@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+# onnx_backend.py - ONNX Runtime backend: exporting the SDXL components to ONNX, cached by checkpoint hash
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+# Runtime the UNet, VAE and text encoders run on: "torch" or "onnx"
+BACKEND = os.environ.get("SD_BACKEND", "torch")
+ONNX_ENABLED = BACKEND == "onnx"
+
+# Precision of the exported graphs. "fp16" needs a GPU to export and run;
+# "int8" dynamically quantizes the linear layers of the text encoders and
+# UNet, which suits CPUs. The VAE is always kept in fp32, since SDXL's VAE
+# overflows in fp16
+ONNX_PRECISION = os.environ.get("SD_ONNX_PRECISION", "fp16")
+ONNX_PRECISIONS = ("fp32", "fp16", "int8")
+
+# ONNX opset the components are exported with
+ONNX_OPSET = 17
+
+# Exported components, with the pipeline component each one is exported from
+ONNX_COMPONENTS = {
+    "text_encoder": "text_encoder",
+    "text_encoder_2": "text_encoder_2",
+    "unet": "unet",
+    "vae_encoder": "vae",
+    "vae_decoder": "vae",
+}
+
+# Components dynamic quantization is applied to in "int8" precision
+QUANTIZED_COMPONENTS = ("text_encoder", "text_encoder_2", "unet")
+
+# The exported UNet only takes latents whose sides divide by this many
+# pixels, since the traced graph always upsamples by exactly 2
+ONNX_SIZE_MULTIPLE = 32
+
+# Bytes read at a time when hashing a checkpoint
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def checkpoint_hash(path, cache_path=None):
+    """
+    Get the SHA-256 of a checkpoint file.
+
+    Hashing a multi-GB checkpoint takes a while, so hashes are remembered in
+    a JSON file keyed by path, and reused while the file's size and
+    modification time are unchanged.
+
+    Args:
+        path: Path of the checkpoint
+        cache_path: Optional path of the JSON file hashes are remembered in
+
+    Returns:
+        The hex digest
+    """
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    cache = {}
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cache = json.load(f)
+        entry = cache.get(key)
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            return entry["sha256"]
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    sha256 = digest.hexdigest()
+
+    if cache_path is not None:
+        cache[key] = {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": sha256}
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, "w") as f:
+            json.dump(cache, f, indent=2)
+    return sha256
+
+
+def model_hash(checkpoint_path, model_id, cache_dir):
+    """
+    Get the hash the exports of a model are cached under.
+
+    Args:
+        checkpoint_path: Path of the local checkpoint, or None for a Hugging Face model
+        model_id: The Hugging Face model id, used when there is no local checkpoint
+        cache_dir: The directory exports are cached in
+
+    Returns:
+        The hex digest of the checkpoint, or of the model id
+    """
+    if checkpoint_path is None:
+        return hashlib.sha256(model_id.encode()).hexdigest()
+    return checkpoint_hash(checkpoint_path, os.path.join(cache_dir, "hashes.json"))
+
+
+def export_path(cache_dir, model_digest, precision=ONNX_PRECISION):
+    """
+    Get the directory the export of a model in a precision is cached in.
+
+    Args:
+        cache_dir: The directory exports are cached in
+        model_digest: The hash returned by model_hash
+        precision: The precision of the export
+
+    Returns:
+        The path of the export directory
+    """
+    return os.path.join(cache_dir, f"{model_digest[:16]}-{precision}")
+
+
+def onnx_size(width, height):
+    """
+    Round an image size down to one the exported UNet can denoise.
+
+    Args:
+        width: The requested width
+        height: The requested height
+
+    Returns:
+        A tuple of the width and height, rounded down to ONNX_SIZE_MULTIPLE
+    """
+    return tuple(max(ONNX_SIZE_MULTIPLE, size // ONNX_SIZE_MULTIPLE * ONNX_SIZE_MULTIPLE) for size in (width, height))
+
+
+def export_pipeline(pipe, output_dir, precision=ONNX_PRECISION, model_digest=None):
+    """
+    Export the components of a loaded SDXL pipeline to ONNX.
+
+    Each component is written to its own directory as model.onnx, with its
+    weights in model.onnx.data (the UNet is larger than the 2 GB protobuf
+    limit). The configs, tokenizers and scheduler are saved alongside, so
+    the export loads without the original checkpoint. The export is written
+    next to output_dir and moved into place once complete, so a failed
+    export is never picked up.
+
+    The pipeline's components are cast to the export precision in place.
+
+    Args:
+        pipe: The loaded StableDiffusionXLPipeline, with its text encoders
+        output_dir: The directory to write the export to
+        precision: "fp32", "fp16" or "int8"
+        model_digest: Optional hash of the checkpoint, recorded in the manifest
+
+    Returns:
+        The export's manifest, with the time each component took to export
+
+    Raises:
+        ValueError: If the precision is unknown, or fp16 is requested without a GPU
+    """
+    import torch
+    from utils.onnx_modules import TextEncoderExport, UNetExport, VaeDecoderExport, VaeEncoderExport
+
+    if precision not in ONNX_PRECISIONS:
+        raise ValueError(f"Unknown ONNX precision: {precision}. Available: {', '.join(ONNX_PRECISIONS)}")
+    if precision == "fp16" and not torch.cuda.is_available():
+        raise ValueError("Exporting in fp16 needs a GPU")
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    dtype = torch.float16 if precision == "fp16" else torch.float32
+    pipe.remove_all_hooks()
+    pipe.to(device)
+    for name in ("text_encoder", "text_encoder_2", "unet"):
+        getattr(pipe, name).to(dtype=dtype)
+    pipe.vae.to(dtype=torch.float32)
+    pipe.vae.disable_tiling()
+    pipe.vae.disable_slicing()
+
+    wrappers = {
+        "text_encoder": TextEncoderExport(pipe.text_encoder),
+        "text_encoder_2": TextEncoderExport(pipe.text_encoder_2),
+        "unet": UNetExport(pipe.unet),
+        "vae_encoder": VaeEncoderExport(pipe.vae),
+        "vae_decoder": VaeDecoderExport(pipe.vae),
+    }
+
+    partial_dir = f"{output_dir}.partial"
+    shutil.rmtree(partial_dir, ignore_errors=True)
+    os.makedirs(partial_dir)
+    seconds = {}
+    for name, wrapper in wrappers.items():
+        print(f"Exporting {name} to ONNX ({precision})...")
+        start = time.perf_counter()
+        component_dir = os.path.join(partial_dir, name)
+        export_component(wrapper, wrapper.example_inputs(pipe.tokenizer), component_dir, quantize=(
+            precision == "int8" and name in QUANTIZED_COMPONENTS
+        ))
+        seconds[name] = time.perf_counter() - start
+        print(f"Exported {name} in {seconds[name]:.1f}s")
+
+    pipe.tokenizer.save_pretrained(os.path.join(partial_dir, "tokenizer"))
+    pipe.tokenizer_2.save_pretrained(os.path.join(partial_dir, "tokenizer_2"))
+    pipe.scheduler.save_pretrained(os.path.join(partial_dir, "scheduler"))
+
+    manifest = {
+        "model_hash": model_digest,
+        "precision": precision,
+        "opset": ONNX_OPSET,
+        "exported_at": time.time(),
+        "export_seconds": seconds,
+        "bytes": {name: directory_bytes(os.path.join(partial_dir, name)) for name in wrappers},
+        "tokenizer_class": type(pipe.tokenizer).__name__,
+        "tokenizer_2_class": type(pipe.tokenizer_2).__name__,
+        "pipeline_config": {"force_zeros_for_empty_prompt": pipe.config.force_zeros_for_empty_prompt},
+        "configs": {
+            "text_encoder": pipe.text_encoder.config.to_dict(),
+            "text_encoder_2": pipe.text_encoder_2.config.to_dict(),
+            "unet": json.loads(pipe.unet.to_json_string()),
+            "vae": json.loads(pipe.vae.to_json_string()),
+        },
+        "add_embedding_dim": pipe.unet.add_embedding.linear_1.in_features,
+    }
+    with open(os.path.join(partial_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2, default=str)
+
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.rename(partial_dir, output_dir)
+    return manifest
+
+
+def export_component(wrapper, example_inputs, component_dir, quantize=False):
+    """
+    Export one component to component_dir/model.onnx.
+
+    Args:
+        wrapper: The export wrapper from utils.onnx_modules
+        example_inputs: The inputs to trace the component with
+        component_dir: The directory to write the component to
+        quantize: Whether to dynamically quantize its linear layers to int8
+    """
+    import onnx
+    import torch
+
+    # The exporter writes one external data file per tensor for models over
+    # 2 GB, so export to a scratch directory and consolidate the weights
+    trace_dir = os.path.join(component_dir, "trace")
+    os.makedirs(trace_dir)
+    trace_path = os.path.join(trace_dir, "model.onnx")
+    with torch.no_grad():
+        torch.onnx.export(
+            wrapper,
+            example_inputs,
+            trace_path,
+            input_names=wrapper.input_names,
+            output_names=wrapper.output_names,
+            dynamic_axes=wrapper.dynamic_axes,
+            opset_version=ONNX_OPSET,
+            do_constant_folding=True,
+            dynamo=False,
+        )
+
+    model_path = os.path.join(component_dir, "model.onnx")
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        # Only the linear layers: int8 convolutions are slow or missing on
+        # most execution providers
+        quantize_dynamic(
+            trace_path,
+            model_path,
+            op_types_to_quantize=["MatMul", "Gemm"],
+            weight_type=QuantType.QInt8,
+            use_external_data_format=True,
+        )
+    else:
+        onnx.save_model(
+            onnx.load(trace_path),
+            model_path,
+            save_as_external_data=True,
+            all_tensors_to_one_file=True,
+            location="model.onnx.data",
+        )
+    shutil.rmtree(trace_dir)
+
+
+def directory_bytes(path):
+    """Get the total size of the files in a directory."""
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    )
+
+
+def onnx_providers():
+    """
+    Get the ONNX Runtime execution providers to run on, best first.
+
+    Returns:
+        CUDAExecutionProvider when onnxruntime-gpu can use a GPU, then CPUExecutionProvider
+    """
+    import onnxruntime as ort
+
+    available = ort.get_available_providers()
+    return [provider for provider in ("CUDAExecutionProvider", "CPUExecutionProvider") if provider in available]
+
+
+def load_onnx_pipeline(path, text_encoders=True, providers=None):
+    """
+    Load an exported SDXL pipeline that runs on ONNX Runtime.
+
+    The pipeline is a regular StableDiffusionXLPipeline whose components are
+    ONNX Runtime sessions, so callbacks, schedulers and from_pipe work as
+    with the torch backend. The components' tensors live on the device the
+    sessions run on, so on a GPU the latents never leave it.
+
+    Args:
+        path: The export directory written by export_pipeline
+        text_encoders: Whether to load the text encoders and tokenizers
+        providers: Optional execution providers; defaults to onnx_providers()
+
+    Returns:
+        The StableDiffusionXLPipeline
+    """
+    import diffusers
+    import onnxruntime as ort
+    import transformers
+    from diffusers import StableDiffusionXLPipeline
+    from utils.onnx_modules import OrtModule, OrtTextEncoder, OrtUNet, OrtVae
+
+    with open(os.path.join(path, "manifest.json")) as f:
+        manifest = json.load(f)
+    providers = providers or onnx_providers()
+    print(f"Loading ONNX {manifest['precision']} pipeline from {path} on {providers[0]}")
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+    def session(name):
+        return ort.InferenceSession(os.path.join(path, name, "model.onnx"), options, providers=providers)
+
+    configs = manifest["configs"]
+    vae_scale_factor = 2 ** (len(configs["vae"]["block_out_channels"]) - 1)
+    components = {
+        "unet": OrtUNet(session("unet"), configs["unet"], manifest["add_embedding_dim"]),
+        "vae": OrtVae(
+            OrtModule(session("vae_encoder"), configs["vae"], spatial_scale=1 / vae_scale_factor),
+            OrtModule(session("vae_decoder"), configs["vae"], spatial_scale=vae_scale_factor),
+            configs["vae"],
+        ),
+        "text_encoder": None,
+        "text_encoder_2": None,
+        "tokenizer": None,
+        "tokenizer_2": None,
+    }
+    if text_encoders:
+        components.update(
+            text_encoder=OrtTextEncoder(session("text_encoder"), configs["text_encoder"]),
+            text_encoder_2=OrtTextEncoder(session("text_encoder_2"), configs["text_encoder_2"]),
+            tokenizer=getattr(transformers, manifest["tokenizer_class"]).from_pretrained(os.path.join(path, "tokenizer")),
+            tokenizer_2=getattr(transformers, manifest["tokenizer_2_class"]).from_pretrained(os.path.join(path, "tokenizer_2")),
+        )
+
+    scheduler_dir = os.path.join(path, "scheduler")
+    with open(os.path.join(scheduler_dir, "scheduler_config.json")) as f:
+        scheduler_class = getattr(diffusers, json.load(f)["_class_name"])
+    return StableDiffusionXLPipeline(
+        **components,
+        scheduler=scheduler_class.from_pretrained(scheduler_dir),
+        add_watermarker=False,
+        **manifest["pipeline_config"],
+    )
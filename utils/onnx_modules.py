@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+# onnx_modules.py - Wrappers exporting the SDXL components to ONNX, and running the exported graphs as pipeline components
+
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+from diffusers.configuration_utils import FrozenDict
+from diffusers.models.autoencoders.autoencoder_kl import AutoencoderKLOutput
+from diffusers.models.autoencoders.vae import DecoderOutput, DiagonalGaussianDistribution
+from diffusers.models.unets.unet_2d_condition import UNet2DConditionOutput
+
+# numpy and torch types of the ONNX tensor types the exported graphs use
+ONNX_NUMPY_TYPES = {
+    "tensor(float16)": np.float16,
+    "tensor(float)": np.float32,
+    "tensor(int64)": np.int64,
+    "tensor(int32)": np.int32,
+}
+ONNX_TORCH_TYPES = {
+    "tensor(float16)": torch.float16,
+    "tensor(float)": torch.float32,
+    "tensor(int64)": torch.int64,
+    "tensor(int32)": torch.int32,
+}
+
+# Symbolic dimensions of the exported graphs that are spatial, and so scale
+# between the inputs and outputs of the VAE
+SPATIAL_DIMS = ("height", "width")
+
+
+class TextEncoderExport(torch.nn.Module):
+    """
+    A CLIP text encoder with plain tensor outputs, for export.
+
+    Outputs the encoder's first output (the pooled text embeddings of
+    CLIPTextModelWithProjection, the last hidden state of CLIPTextModel) and
+    the penultimate hidden state SDXL conditions on.
+    """
+
+    input_names = ["input_ids"]
+    output_names = ["output", "penultimate_hidden_state"]
+    dynamic_axes = {"input_ids": {0: "batch"}, "output": {0: "batch"}, "penultimate_hidden_state": {0: "batch"}}
+
+    def __init__(self, encoder):
+        super().__init__()
+        self.encoder = encoder
+
+    def forward(self, input_ids):
+        output = self.encoder(input_ids, output_hidden_states=True)
+        return output[0], output.hidden_states[-2]
+
+    def example_inputs(self, tokenizer):
+        device = next(self.encoder.parameters()).device
+        return (torch.zeros((1, tokenizer.model_max_length), dtype=torch.int64, device=device),)
+
+
+class UNetExport(torch.nn.Module):
+    """The SDXL UNet with its added conditioning as separate inputs, for export."""
+
+    input_names = ["sample", "timestep", "encoder_hidden_states", "text_embeds", "time_ids"]
+    output_names = ["out_sample"]
+    dynamic_axes = {
+        "sample": {0: "batch", 2: "height", 3: "width"},
+        "timestep": {0: "batch"},
+        "encoder_hidden_states": {0: "batch", 1: "sequence"},
+        "text_embeds": {0: "batch"},
+        "time_ids": {0: "batch"},
+        "out_sample": {0: "batch", 2: "height", 3: "width"},
+    }
+
+    def __init__(self, unet):
+        super().__init__()
+        self.unet = unet
+
+    def forward(self, sample, timestep, encoder_hidden_states, text_embeds, time_ids):
+        return self.unet(
+            sample,
+            timestep,
+            encoder_hidden_states,
+            added_cond_kwargs={"text_embeds": text_embeds, "time_ids": time_ids},
+            return_dict=False,
+        )[0]
+
+    def example_inputs(self, tokenizer):
+        config = self.unet.config
+        parameter = next(self.unet.parameters())
+        text_embeds_dim = config.projection_class_embeddings_input_dim - 6 * config.addition_time_embed_dim
+        return (
+            torch.randn((2, config.in_channels, 64, 64), dtype=parameter.dtype, device=parameter.device),
+            torch.full((2,), 999.0, dtype=torch.float32, device=parameter.device),
+            torch.randn((2, tokenizer.model_max_length, config.cross_attention_dim), dtype=parameter.dtype, device=parameter.device),
+            torch.randn((2, text_embeds_dim), dtype=parameter.dtype, device=parameter.device),
+            torch.tensor([[512.0, 512.0, 0.0, 0.0, 512.0, 512.0]] * 2, dtype=parameter.dtype, device=parameter.device),
+        )
+
+
+class VaeEncoderExport(torch.nn.Module):
+    """The VAE encoder up to the moments of the latent distribution, for export."""
+
+    input_names = ["sample"]
+    output_names = ["moments"]
+    dynamic_axes = {"sample": {0: "batch", 2: "height", 3: "width"}, "moments": {0: "batch", 2: "height", 3: "width"}}
+
+    def __init__(self, vae):
+        super().__init__()
+        self.vae = vae
+
+    def forward(self, sample):
+        moments = self.vae.encoder(sample)
+        if self.vae.quant_conv is not None:
+            moments = self.vae.quant_conv(moments)
+        return moments
+
+    def example_inputs(self, tokenizer):
+        parameter = next(self.vae.parameters())
+        return (torch.randn((1, self.vae.config.in_channels, 256, 256), dtype=parameter.dtype, device=parameter.device),)
+
+
+class VaeDecoderExport(torch.nn.Module):
+    """The VAE decoder from scaled latents to images, for export."""
+
+    input_names = ["latent_sample"]
+    output_names = ["sample"]
+    dynamic_axes = {"latent_sample": {0: "batch", 2: "height", 3: "width"}, "sample": {0: "batch", 2: "height", 3: "width"}}
+
+    def __init__(self, vae):
+        super().__init__()
+        self.vae = vae
+
+    def forward(self, latent_sample):
+        if self.vae.post_quant_conv is not None:
+            latent_sample = self.vae.post_quant_conv(latent_sample)
+        return self.vae.decoder(latent_sample)
+
+    def example_inputs(self, tokenizer):
+        parameter = next(self.vae.parameters())
+        channels = self.vae.config.latent_channels
+        return (torch.randn((1, channels, 32, 32), dtype=parameter.dtype, device=parameter.device),)
+
+
+class OrtModule(torch.nn.Module):
+    """
+    An ONNX Runtime session standing in for a torch component of a diffusers pipeline.
+
+    It has no parameters; dtype and device describe the tensors it takes and
+    returns, so the pipeline prepares its inputs the way it would for the
+    torch component. Inputs and outputs are bound to torch tensors on the
+    session's device with IO binding, so on a GPU they never go through host
+    memory. Inputs are cast to the types of the graph's inputs.
+
+    Args:
+        session: The onnxruntime InferenceSession of the component
+        config: The config of the exported torch component
+        spatial_scale: Size of the outputs' spatial dimensions relative to
+            the inputs', e.g. 8 for the VAE decoder
+    """
+
+    def __init__(self, session, config, spatial_scale=1):
+        super().__init__()
+        self.session = session
+        self.config = FrozenDict(config)
+        self.spatial_scale = spatial_scale
+        self.inputs = {node.name: node for node in session.get_inputs()}
+        self.outputs = session.get_outputs()
+        self.input_types = {name: ONNX_NUMPY_TYPES[node.type] for name, node in self.inputs.items()}
+        self.output_types = [ONNX_NUMPY_TYPES[node.type] for node in self.outputs]
+
+        if session.get_providers()[0] == "CUDAExecutionProvider":
+            options = session.get_provider_options()["CUDAExecutionProvider"]
+            self._device = torch.device("cuda", int(options.get("device_id", 0)))
+        else:
+            self._device = torch.device("cpu")
+
+    @property
+    def dtype(self):
+        # The type of the first floating-point input, or output for the text
+        # encoders, whose only input is the token ids
+        for numpy_type in list(self.input_types.values()) + self.output_types:
+            if numpy_type in (np.float16, np.float32):
+                return torch.float16 if numpy_type == np.float16 else torch.float32
+        return torch.float32
+
+    @property
+    def device(self):
+        return self._device
+
+    def output_shapes(self, inputs):
+        """
+        Get the shapes of the graph's outputs for the given inputs.
+
+        The symbolic dimensions of the outputs take the sizes the inputs'
+        dimensions of the same name have, scaled by spatial_scale for the
+        spatial ones.
+
+        Args:
+            inputs: The graph's inputs as tensors, by name
+
+        Returns:
+            A list of output shapes
+        """
+        sizes = {}
+        for name, value in inputs.items():
+            for dim, size in zip(self.inputs[name].shape, value.shape):
+                if isinstance(dim, str):
+                    sizes[dim] = size
+        shapes = []
+        for node in self.outputs:
+            shape = []
+            for dim in node.shape:
+                if isinstance(dim, str):
+                    dim = sizes[dim] * self.spatial_scale if dim in SPATIAL_DIMS else sizes[dim]
+                shape.append(int(dim))
+            shapes.append(tuple(shape))
+        return shapes
+
+    def run(self, **inputs):
+        """
+        Run the session.
+
+        Args:
+            **inputs: The graph's inputs as tensors, by name
+
+        Returns:
+            The graph's outputs as tensors on the session's device
+        """
+        device = self._device
+        device_type, device_id = device.type, device.index or 0
+        # Keep the cast inputs alive until the run is done; the binding only has their pointers
+        inputs = {
+            name: value.detach().to(device=device, dtype=ONNX_TORCH_TYPES[self.inputs[name].type]).contiguous()
+            for name, value in inputs.items()
+        }
+        outputs = [
+            torch.empty(shape, dtype=ONNX_TORCH_TYPES[node.type], device=device)
+            for node, shape in zip(self.outputs, self.output_shapes(inputs))
+        ]
+
+        binding = self.session.io_binding()
+        for name, value in inputs.items():
+            binding.bind_input(
+                name, device_type, device_id, self.input_types[name], tuple(value.shape), value.data_ptr()
+            )
+        for node, numpy_type, value in zip(self.outputs, self.output_types, outputs):
+            binding.bind_output(node.name, device_type, device_id, numpy_type, tuple(value.shape), value.data_ptr())
+
+        if device_type == "cuda":
+            # ONNX Runtime runs on its own stream, so the inputs have to be ready
+            torch.cuda.current_stream(device).synchronize()
+        self.session.run_with_iobinding(binding)
+        binding.synchronize_outputs()
+        return outputs
+
+
+class OrtTextEncoderOutput(tuple):
+    """
+    The outputs of an exported text encoder, shaped like the transformers output SDXL reads.
+
+    Indexing gives the encoder's first output; hidden_states[-2] gives the
+    penultimate hidden state, the only one exported.
+    """
+
+    @property
+    def hidden_states(self):
+        return (self[1], None)
+
+
+class OrtTextEncoder(OrtModule):
+    """A CLIP text encoder running on ONNX Runtime."""
+
+    def forward(self, input_ids, *args, **kwargs):
+        output, hidden_state = self.run(input_ids=input_ids)
+        return OrtTextEncoderOutput((output.to(input_ids.device), hidden_state.to(input_ids.device)))
+
+
+class OrtUNet(OrtModule):
+    """
+    The SDXL UNet running on ONNX Runtime.
+
+    Args:
+        session: The onnxruntime InferenceSession of the UNet
+        config: The config of the exported UNet
+        add_embedding_dim: Input size of the UNet's added conditioning
+            embedding, which the pipelines check their conditioning against
+    """
+
+    def __init__(self, session, config, add_embedding_dim):
+        super().__init__(session, config)
+        # The pipelines read unet.add_embedding.linear_1.in_features
+        self.add_embedding = SimpleNamespace(linear_1=SimpleNamespace(in_features=add_embedding_dim))
+
+    def forward(self, sample, timestep, encoder_hidden_states, *args, added_cond_kwargs=None, return_dict=True, **kwargs):
+        if not torch.is_tensor(timestep):
+            timestep = torch.tensor(timestep)
+        (prediction,) = self.run(
+            sample=sample,
+            timestep=timestep.float().reshape(-1).expand(sample.shape[0]),
+            encoder_hidden_states=encoder_hidden_states,
+            text_embeds=added_cond_kwargs["text_embeds"],
+            time_ids=added_cond_kwargs["time_ids"],
+        )
+        prediction = prediction.to(device=sample.device, dtype=sample.dtype)
+        if not return_dict:
+            return (prediction,)
+        return UNet2DConditionOutput(sample=prediction)
+
+
+class OrtVae(torch.nn.Module):
+    """
+    The SDXL VAE running on ONNX Runtime, as an encoder and a decoder session.
+
+    Args:
+        encoder: The OrtModule of the encoder, or None when it wasn't exported
+        decoder: The OrtModule of the decoder
+        config: The config of the exported AutoencoderKL
+    """
+
+    def __init__(self, encoder, decoder, config):
+        super().__init__()
+        self.encoder = encoder
+        self.decoder = decoder
+        self.config = FrozenDict(config)
+
+    @property
+    def dtype(self):
+        return self.decoder.dtype
+
+    @property
+    def device(self):
+        return self.decoder.device
+
+    def encode(self, x, return_dict=True):
+        (moments,) = self.encoder.run(sample=x)
+        latent_dist = DiagonalGaussianDistribution(moments.to(device=x.device, dtype=x.dtype))
+        if not return_dict:
+            return (latent_dist,)
+        return AutoencoderKLOutput(latent_dist=latent_dist)
+
+    def decode(self, z, return_dict=True, generator=None):
+        (sample,) = self.decoder.run(latent_sample=z)
+        sample = sample.to(device=z.device, dtype=z.dtype)
+        if not return_dict:
+            return (sample,)
+        return DecoderOutput(sample=sample)
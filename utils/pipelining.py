@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# pipelining.py - Overlap the post-processing of one generation with the denoising of the next
+
+import os
+import queue
+import threading
+from concurrent.futures import Future
+
+# Whether the GPU container post-processes a finished denoise on a worker
+# thread while the next request denoises
+PIPELINE_ENABLED = os.environ.get("SD_PIPELINE", "1") == "1"
+
+# Finished denoises allowed to wait for post-processing; when the hand-off
+# queue is full the next denoise waits, which bounds the latents held in memory
+PIPELINE_QUEUE_SIZE = int(os.environ.get("SD_PIPELINE_QUEUE_SIZE", "1"))
+
+# Inputs a GPU container accepts at once: one denoising, one being
+# post-processed and the ones waiting in the hand-off queue
+PIPELINE_MAX_INPUTS = PIPELINE_QUEUE_SIZE + 2 if PIPELINE_ENABLED else 1
+
+
+class PostProcessExecutor:
+    """
+    Run jobs one at a time, in submission order, on a single worker thread.
+
+    Jobs are handed over through a bounded queue, so ``submit`` blocks while
+    the worker is ``max_pending`` jobs behind.
+
+    Args:
+        max_pending: Jobs allowed to wait for the worker
+        initializer: Optional callable run on the worker thread before the
+            first job, e.g. to make a side CUDA stream current there
+    """
+
+    def __init__(self, max_pending=PIPELINE_QUEUE_SIZE, initializer=None):
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._initializer = initializer
+        self._thread = threading.Thread(target=self._run, name="postprocess", daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queue a job, waiting for room in the hand-off queue.
+
+        Args:
+            fn: The callable to run
+            *args: Positional arguments for fn
+            **kwargs: Keyword arguments for fn
+
+        Returns:
+            A concurrent.futures.Future for the job's result
+        """
+        future = Future()
+        self._queue.put((future, fn, args, kwargs))
+        return future
+
+    def drain(self):
+        """Wait until every submitted job has finished."""
+        self._queue.join()
+
+    def _run(self):
+        if self._initializer is not None:
+            self._initializer()
+        while True:
+            future, fn, args, kwargs = self._queue.get()
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(fn(*args, **kwargs))
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# profiling.py - On-demand profiler capture for individual generation requests
+
+import cProfile
+import os
+from contextlib import nullcontext
+
+
+class RequestProfiler:
+    """
+    Profile the enclosed block and write the result to ``output_dir``.
+
+    Uses ``torch.profiler`` when CUDA is available and writes a Chrome trace
+    (``<request_id>.json``); otherwise falls back to cProfile and writes a
+    pstats dump (``<request_id>.prof``).
+
+    Neither is limited to the request: torch.profiler captures the whole
+    process, so in a container running several inputs at once the profile
+    also holds the work of the other requests in flight while this one ran.
+
+    Args:
+        output_dir: The directory to write the profile to
+        request_id: The id the profile is stored under
+    """
+
+    def __init__(self, output_dir, request_id):
+        self.output_dir = output_dir
+        self.request_id = request_id
+        self.path = None
+        self._profiler = None
+        self._torch = False
+
+    def __enter__(self):
+        import torch
+
+        if torch.cuda.is_available():
+            from torch.profiler import ProfilerActivity, profile
+
+            self._torch = True
+            self._profiler = profile(
+                activities=[ProfilerActivity.CPU, ProfilerActivity.CUDA],
+                record_shapes=True,
+            )
+            self._profiler.__enter__()
+        else:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        os.makedirs(self.output_dir, exist_ok=True)
+        if self._torch:
+            self._profiler.__exit__(exc_type, exc_value, tb)
+            self.path = os.path.join(self.output_dir, f"{self.request_id}.json")
+            self._profiler.export_chrome_trace(self.path)
+        else:
+            self._profiler.disable()
+            self.path = os.path.join(self.output_dir, f"{self.request_id}.prof")
+            self._profiler.dump_stats(self.path)
+        print(f"Profile for request {self.request_id} written to {self.path}")
+        return False
+
+
+def maybe_profile(request_id, output_dir):
+    """
+    Get a context manager that profiles the block only when a request id is given.
+
+    When profiling is off this returns a ``nullcontext`` so normal requests
+    pay nothing beyond the ``with`` statement itself. Profiles are
+    container-wide, not limited to the request (see RequestProfiler).
+
+    Args:
+        request_id: The id to store the profile under, or None to disable profiling
+        output_dir: The directory to write the profile to
+
+    Returns:
+        A context manager yielding the RequestProfiler, or None when disabled
+    """
+    if request_id is None:
+        return nullcontext()
+    return RequestProfiler(output_dir, request_id)
+
+
+def find_profile(output_dir, request_id):
+    """
+    Find the profile written for a request.
+
+    Args:
+        output_dir: The directory profiles are written to
+        request_id: The id of the request
+
+    Returns:
+        The path to the profile, or None if there is none
+    """
+    for extension in (".json", ".prof"):
+        path = os.path.join(output_dir, f"{request_id}{extension}")
+        if os.path.exists(path):
+            return path
+    return None
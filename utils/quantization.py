@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# quantization.py - Quantised low-memory mode: int8/int4 linear layers, cached on the models volume
+
+import os
+import time
+
+# Quantisation of the linear layers of the text encoders and UNet:
+#   "none"          full-precision weights
+#   "int8-dynamic"  int8 weights, activations quantised on each call; runs
+#                   in fp32 on the CPU only (SD_GPU=cpu)
+#   "int8-weight"   int8 weights dequantised layer by layer, for small GPUs
+#   "int4-weight"   as int8-weight, with the UNet's weights in int4
+QUANTIZATION = os.environ.get("SD_QUANTIZATION", "none")
+QUANTIZATION_MODES = ("none", "int8-dynamic", "int8-weight", "int4-weight")
+
+# Only the torch backend is quantised this way; ONNX exports have their own
+# int8 precision (SD_ONNX_PRECISION)
+QUANTIZATION_ENABLED = QUANTIZATION != "none" and os.environ.get("SD_BACKEND", "torch") == "torch"
+
+# Weight scheme of each component in each mode. The text encoders are small
+# and the most sensitive to precision, so they never go below int8
+QUANTIZATION_SCHEMES = {
+    "int8-dynamic": {"text_encoder": "int8-dynamic", "text_encoder_2": "int8-dynamic", "unet": "int8-dynamic"},
+    "int8-weight": {"text_encoder": "int8", "text_encoder_2": "int8", "unet": "int8"},
+    "int4-weight": {"text_encoder": "int8", "text_encoder_2": "int8", "unet": "int4"},
+}
+
+
+def module_bytes(module):
+    """
+    Get the bytes of a module's parameters and buffers.
+
+    Args:
+        module: The torch module
+
+    Returns:
+        The size in bytes
+    """
+    tensors = list(module.parameters()) + list(module.buffers())
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+def quantize_component(module, scheme, cache_path):
+    """
+    Replace the linear layers of a component with quantised ones.
+
+    Quantised weights are read from cache_path when it exists, and written
+    there otherwise, so a checkpoint is only quantised once. int8 weights
+    are the same in the dynamic and weight-only schemes, so they share a file.
+
+    Args:
+        module: The text encoder or UNet
+        scheme: "int8-dynamic", "int8" or "int4"
+        cache_path: The safetensors file of the component's quantised weights
+
+    Returns:
+        A dictionary with the scheme, whether the weights came from the
+        cache, the layers quantised, and the component's bytes before and after
+    """
+    import torch
+    from safetensors.torch import load_file, save_file
+    from utils.quantized_modules import WeightOnlyLinear, can_quantize, dynamic_linear, quantize_weight
+
+    bits = 4 if scheme == "int4" else 8
+    cached = load_file(cache_path) if os.path.exists(cache_path) else None
+    tensors = {}
+    total_bytes = module_bytes(module)
+    quantized_bytes = total_bytes
+    layers = 0
+
+    linears = [(name, child) for name, child in module.named_modules() if isinstance(child, torch.nn.Linear)]
+    for name, linear in linears:
+        if not can_quantize(linear, bits):
+            continue
+        if cached is not None and f"{name}.qweight" in cached:
+            qweight, scale = cached[f"{name}.qweight"], cached[f"{name}.scale"]
+        else:
+            qweight, scale = quantize_weight(linear.weight, bits)
+        tensors[f"{name}.qweight"] = qweight.contiguous()
+        tensors[f"{name}.scale"] = scale.float().contiguous()
+
+        if scheme == "int8-dynamic":
+            replacement = dynamic_linear(linear, qweight, scale)
+        else:
+            replacement = WeightOnlyLinear.from_linear(linear, bits, qweight, scale)
+        parent_name, _, child_name = name.rpartition(".")
+        setattr(module.get_submodule(parent_name), child_name, replacement)
+
+        element_size = linear.weight.element_size()
+        quantized_bytes -= linear.weight.numel() * element_size
+        quantized_bytes += qweight.numel() * qweight.element_size() + scale.numel() * element_size
+        layers += 1
+
+    if cached is None:
+        # Written under another name first, so an interrupted save is never read
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        save_file(tensors, f"{cache_path}.partial")
+        os.replace(f"{cache_path}.partial", cache_path)
+
+    return {
+        "scheme": scheme,
+        "cached": cached is not None,
+        "layers": layers,
+        "bytes": total_bytes,
+        "quantized_bytes": quantized_bytes,
+    }
+
+
+def quantize_pipeline(pipe, mode, cache_dir):
+    """
+    Quantise the linear layers of a loaded pipeline's text encoders and UNet.
+
+    The VAE is left alone: it is mostly convolutions, and SDXL's VAE is
+    already the most precision-sensitive component. Components that weren't
+    loaded (the text encoders with remote text encoding) are skipped.
+
+    Args:
+        pipe: The loaded StableDiffusionXLPipeline, on the CPU
+        mode: "int8-dynamic", "int8-weight" or "int4-weight"
+        cache_dir: The directory the checkpoint's quantised weights are cached in
+
+    Returns:
+        The quantisation report: the mode, whether every component came from
+        the cache, the seconds taken, and per component the scheme, layers
+        and bytes before and after
+
+    Raises:
+        ValueError: If the mode is unknown, or int8-dynamic is used off the CPU
+    """
+    import torch
+
+    if mode not in QUANTIZATION_SCHEMES:
+        raise ValueError(f"Unknown quantization mode: {mode}. Available: {', '.join(QUANTIZATION_MODES)}")
+    if mode == "int8-dynamic" and pipe.unet.dtype != torch.float32:
+        raise ValueError("int8-dynamic quantization runs in fp32 on the CPU; deploy it with SD_GPU=cpu")
+
+    start = time.perf_counter()
+    components = {}
+    for name, scheme in QUANTIZATION_SCHEMES[mode].items():
+        module = getattr(pipe, name, None)
+        if module is None:
+            continue
+        bits = "int4" if scheme == "int4" else "int8"
+        components[name] = quantize_component(module, scheme, os.path.join(cache_dir, f"{name}-{bits}.safetensors"))
+
+    report = {
+        "mode": mode,
+        "cached": all(component["cached"] for component in components.values()),
+        "seconds": time.perf_counter() - start,
+        "bytes": sum(component["bytes"] for component in components.values()),
+        "quantized_bytes": sum(component["quantized_bytes"] for component in components.values()),
+        "components": components,
+    }
+    print(
+        f"Quantized to {mode} in {report['seconds']:.1f}s"
+        f"{' from cache' if report['cached'] else ''}: "
+        f"{report['bytes'] / 1024 ** 3:.2f} GB -> {report['quantized_bytes'] / 1024 ** 3:.2f} GB"
+    )
+    return report
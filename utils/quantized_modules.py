@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# quantized_modules.py - int8 and int4 linear layers standing in for the full-precision ones
+
+import torch
+import torch.nn.functional as F
+
+# Input features sharing one int4 scale. Layers whose input features aren't
+# a multiple of it keep their full-precision weights
+INT4_GROUP_SIZE = 64
+
+
+def quantize_weight(weight, bits, group_size=INT4_GROUP_SIZE):
+    """
+    Quantise the weight of a linear layer symmetrically.
+
+    int8 weights have one scale per output feature. int4 weights have one
+    scale per group of group_size input features, and are packed two to a
+    byte, offset by 8.
+
+    Args:
+        weight: The (out_features, in_features) weight
+        bits: 8 or 4
+        group_size: Input features sharing a scale in int4
+
+    Returns:
+        The int8 weight, or the packed uint8 int4 weight, and its float32 scales
+    """
+    weight = weight.detach().float()
+    if bits == 8:
+        scale = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+        qweight = torch.round(weight / scale[:, None]).clamp(-127, 127).to(torch.int8)
+        return qweight, scale
+
+    out_features, in_features = weight.shape
+    groups = weight.reshape(out_features, in_features // group_size, group_size)
+    scale = groups.abs().amax(dim=2).clamp(min=1e-8) / 7
+    values = (torch.round(groups / scale[:, :, None]).clamp(-7, 7) + 8).to(torch.uint8)
+    values = values.reshape(out_features, in_features)
+    return values[:, 0::2] | (values[:, 1::2] << 4), scale
+
+
+def can_quantize(linear, bits, group_size=INT4_GROUP_SIZE):
+    """
+    Check whether a linear layer's weight can be quantised.
+
+    Args:
+        linear: The nn.Linear
+        bits: 8 or 4
+        group_size: Input features sharing a scale in int4
+
+    Returns:
+        Whether the weight's shape suits the scheme
+    """
+    return bits == 8 or linear.in_features % group_size == 0
+
+
+class WeightOnlyLinear(torch.nn.Module):
+    """
+    A linear layer with int8 or int4 weights, dequantised to the input's dtype on each call.
+
+    Only the quantised weights stay resident; a layer's full-precision
+    weight exists only while the layer runs. The scales and bias follow the
+    module's dtype, the quantised weights never change type.
+
+    Args:
+        in_features: Size of each input sample
+        out_features: Size of each output sample
+        bits: 8 or 4
+        qweight: The weight returned by quantize_weight
+        scale: The scales returned by quantize_weight
+        bias: The bias, or None
+    """
+
+    def __init__(self, in_features, out_features, bits, qweight, scale, bias=None):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        self.register_buffer("qweight", qweight)
+        self.register_buffer("scale", scale)
+        self.bias = torch.nn.Parameter(bias, requires_grad=False) if bias is not None else None
+
+    @classmethod
+    def from_linear(cls, linear, bits, qweight=None, scale=None):
+        """
+        Quantise an nn.Linear, or wrap its already quantised weight.
+
+        Args:
+            linear: The nn.Linear to replace
+            bits: 8 or 4
+            qweight: Optional quantised weight, e.g. read from the cache
+            scale: The scales of qweight
+
+        Returns:
+            The WeightOnlyLinear, on the layer's device and in its dtype
+        """
+        weight = linear.weight
+        if qweight is None:
+            qweight, scale = quantize_weight(weight, bits)
+        bias = linear.bias.detach() if linear.bias is not None else None
+        return cls(
+            linear.in_features,
+            linear.out_features,
+            bits,
+            qweight.to(weight.device),
+            scale.to(device=weight.device, dtype=weight.dtype),
+            bias,
+        )
+
+    def dequantize(self, dtype):
+        """
+        Get the full-precision weight.
+
+        Args:
+            dtype: The dtype to dequantise to
+
+        Returns:
+            The (out_features, in_features) weight
+        """
+        if self.bits == 8:
+            return self.qweight.to(dtype) * self.scale.to(dtype)[:, None]
+        values = torch.stack((self.qweight & 0xF, self.qweight >> 4), dim=-1).reshape(self.out_features, -1)
+        groups = (values.to(dtype) - 8).reshape(self.out_features, self.scale.shape[1], -1)
+        return (groups * self.scale.to(dtype)[:, :, None]).reshape(self.out_features, self.in_features)
+
+    def forward(self, x):
+        bias = self.bias.to(x.dtype) if self.bias is not None else None
+        return F.linear(x, self.dequantize(x.dtype), bias)
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, bits={self.bits}"
+
+
+def dynamic_linear(linear, qweight=None, scale=None):
+    """
+    Replace an nn.Linear with a dynamically quantised int8 one.
+
+    The weights are int8 with a scale per output feature, as quantize_weight
+    makes them; activations are quantised on each call. Only runs in fp32 on
+    the CPU.
+
+    Args:
+        linear: The nn.Linear to replace
+        qweight: Optional int8 weight, e.g. read from the cache
+        scale: The scales of qweight
+
+    Returns:
+        The torch.ao dynamic quantized Linear
+    """
+    from torch.ao.nn.quantized.dynamic import Linear as DynamicLinear
+
+    if qweight is None:
+        qweight, scale = quantize_weight(linear.weight, 8)
+    scale = scale.double()
+    weight = torch.quantize_per_channel(
+        qweight.float() * scale[:, None].float(),
+        scale,
+        torch.zeros_like(scale, dtype=torch.int64),
+        0,
+        torch.qint8,
+    )
+    module = DynamicLinear(linear.in_features, linear.out_features, bias_=linear.bias is not None, dtype=torch.qint8)
+    module.set_weight_bias(weight, linear.bias.detach().float() if linear.bias is not None else None)
+    return module
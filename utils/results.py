@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# results.py - Typed result of a generation, passed from the GPU container to the web tier
+
+import base64
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+
+@dataclass
+class GeneratedImage:
+    """
+    One generated image.
+
+    Attributes:
+        path: Where the image was saved on the images volume
+        png: The PNG-encoded image
+        seed: The seed the image was generated with
+    """
+    path: str
+    png: bytes
+    seed: int
+
+    @property
+    def base64_png(self):
+        """The image as a base64 string, for JSON responses."""
+        return base64.b64encode(self.png).decode()
+
+
+@dataclass
+class GenerationResult:
+    """
+    The result of StableDiffusionModel.generate_image.
+
+    Images travel as raw PNG bytes rather than base64 strings, so the RPC
+    payload is about a quarter smaller and the GPU container skips an encode.
+
+    Attributes:
+        images: The generated images, in seed order
+        model_id: The checkpoint the images were generated with
+        timings: The per-stage timings from StageTimer.as_dict
+        trace: The trace id, cold start flag and spans of the call
+        memory: The memory profile used and the peak GPU memory
+        profile_path: Where the profile was saved, for profiled calls
+        compile: The resolution bucket used in compiled mode
+        backend: The runtime the images were generated with: "torch", or "onnx-"
+            followed by the precision of the export
+        quantization: The quantisation report of the container in the
+            quantised mode: the mode, and the weight bytes before and after
+        unet: The UNet calls made, and the blocks run and skipped by step caching
+        hires: The base size, scale, strength and refinement steps of hires generations
+        tiles: The tile size, overlap and tiles denoised of tiled generations
+    """
+    images: List[GeneratedImage]
+    model_id: str
+    timings: dict = field(default_factory=dict)
+    trace: dict = field(default_factory=dict)
+    memory: dict = field(default_factory=dict)
+    profile_path: Optional[str] = None
+    compile: Optional[dict] = None
+    backend: str = "torch"
+    quantization: Optional[dict] = None
+    unet: dict = field(default_factory=dict)
+    hires: Optional[dict] = None
+    tiles: Optional[dict] = None
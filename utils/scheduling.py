@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# scheduling.py - Per-client rate limiting and fair queueing of generation requests
+
+import json
+import math
+import os
+import time
+from collections import OrderedDict, deque
+
+# Priority lanes, highest priority first
+LANES = ("interactive", "batch")
+
+# Sustained rate each client may spend, in megapixel-steps per second
+CLIENT_RATE = float(os.environ.get("SD_CLIENT_RATE", "2"))
+
+# Burst each client may spend at once, in megapixel-steps. A request costing
+# more than its client's burst is rejected, so the default admits the largest
+# tiled request (SD_MAX_TILED_REQUEST_COST)
+CLIENT_BURST = float(os.environ.get("SD_CLIENT_BURST", "600"))
+
+# Cost a client's deficit grows by each time the fair queue passes over it
+DRR_QUANTUM = float(os.environ.get("SD_DRR_QUANTUM", "32"))
+
+
+class Client:
+    """
+    An identified caller of the API.
+
+    Args:
+        name: The name the client is tracked under
+        lane: The priority lane its requests are queued in
+        rate: Token bucket refill rate in cost units per second
+        burst: Token bucket capacity in cost units
+    """
+
+    def __init__(self, name, lane="interactive", rate=CLIENT_RATE, burst=CLIENT_BURST):
+        if lane not in LANES:
+            raise ValueError(f"Unknown lane: {lane}")
+        self.name = name
+        self.lane = lane
+        self.rate = rate
+        self.burst = burst
+
+
+def load_api_keys(config=None):
+    """
+    Load the API key table.
+
+    The table is JSON mapping each key to its client settings, e.g.
+    ``{"k1": {"name": "alice"}, "k2": {"name": "nightly", "lane": "batch", "rate": 20}}``.
+
+    Args:
+        config: JSON string to parse; defaults to the SD_API_KEYS environment variable
+
+    Returns:
+        A dictionary mapping API keys to Client objects
+    """
+    config = config if config is not None else os.environ.get("SD_API_KEYS", "{}")
+    return {key: Client(**settings) for key, settings in json.loads(config).items()}
+
+
+class UnknownApiKey(Exception):
+    """Raised when a request carries an API key that isn't configured."""
+
+
+def identify_client(api_key, remote_address, api_keys):
+    """
+    Identify the client behind a request.
+
+    Requests with an API key are tracked under the key's client; anonymous
+    requests are tracked per remote address in the interactive lane.
+
+    Args:
+        api_key: The API key sent with the request, if any
+        remote_address: The address the request came from
+        api_keys: The API key table from load_api_keys
+
+    Returns:
+        The Client making the request
+
+    Raises:
+        UnknownApiKey: If the API key isn't configured
+    """
+    if api_key:
+        if api_key not in api_keys:
+            raise UnknownApiKey("Unknown API key")
+        return api_keys[api_key]
+    return Client(f"anonymous:{remote_address}")
+
+
+class RateLimited(Exception):
+    """Raised when a client has used up its token bucket."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Rate limit exceeded, retry after {retry_after} seconds")
+        self.retry_after = retry_after
+
+
+class ExceedsBurst(Exception):
+    """Raised when a request costs more than its client's bucket can ever hold."""
+
+    def __init__(self, cost, burst):
+        super().__init__(f"Request cost {cost:.1f} exceeds the client's burst of {burst:.1f} megapixel-steps")
+        self.cost = cost
+        self.burst = burst
+
+
+class TokenBucket:
+    """
+    A token bucket measured in GPU cost units.
+
+    Args:
+        rate: Refill rate in cost units per second
+        burst: Capacity in cost units; the bucket starts full
+        clock: Monotonic clock, replaceable for testing
+    """
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, cost):
+        """
+        Take ``cost`` tokens from the bucket.
+
+        Args:
+            cost: The cost of the request
+
+        Raises:
+            ExceedsBurst: If the cost is more than the bucket holds when full
+            RateLimited: If there aren't enough tokens
+        """
+        if cost > self.burst:
+            raise ExceedsBurst(cost, self.burst)
+        self._refill()
+        if self.tokens < cost:
+            raise RateLimited(max(1, math.ceil((cost - self.tokens) / self.rate)))
+        self.tokens -= cost
+
+
+class RateLimiter:
+    """
+    Token buckets for every client, created on first use.
+
+    Args:
+        clock: Monotonic clock, replaceable for testing
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._buckets = {}
+
+    def consume(self, client, cost):
+        """
+        Charge a request to its client's bucket.
+
+        Args:
+            client: The Client making the request
+            cost: The cost of the request
+
+        Raises:
+            ExceedsBurst: If the request costs more than the client's burst
+            RateLimited: If the client has used up its bucket
+        """
+        bucket = self._buckets.get(client.name)
+        if bucket is None:
+            bucket = TokenBucket(client.rate, client.burst, clock=self.clock)
+            self._buckets[client.name] = bucket
+        bucket.consume(cost)
+
+
+class FairQueue:
+    """
+    Queue of waiting requests with priority lanes and deficit round robin.
+
+    Lanes are served in strict priority order. Within a lane, clients take
+    turns by deficit round robin: each pass over a client grows its deficit by
+    ``quantum`` cost units, and its next request is served once the deficit
+    covers the request's cost. A client submitting many or large requests
+    therefore gets the same share of GPU cost as one submitting few.
+
+    Args:
+        quantum: Deficit added per round, in cost units
+    """
+
+    def __init__(self, quantum=DRR_QUANTUM):
+        self.quantum = quantum
+        self._lanes = {lane: OrderedDict() for lane in LANES}
+        self._deficits = {}
+        self._selected = None
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        for clients in self._lanes.values():
+            for entries in clients.values():
+                yield from entries
+
+    def lane_size(self, lane):
+        """
+        Get the number of requests waiting in a lane.
+
+        Args:
+            lane: The priority lane
+
+        Returns:
+            The number of waiting requests
+        """
+        return sum(len(entries) for entries in self._lanes[lane].values())
+
+    def push(self, entry, client, lane, cost):
+        """
+        Add a waiting request.
+
+        Args:
+            entry: The object representing the request
+            client: The name of the client
+            lane: The priority lane
+            cost: The cost of the request
+        """
+        clients = self._lanes[lane]
+        if client not in clients:
+            clients[client] = deque()
+            self._deficits[(lane, client)] = 0.0
+        clients[client].append((cost, entry))
+        self._size += 1
+        # The new request may outrank the one peeked; selecting again keeps
+        # the peeked client's deficit, so it is picked again within its lane
+        self._selected = None
+
+    def peek(self):
+        """
+        Get the request that should run next without removing it.
+
+        Returns:
+            A (cost, entry) tuple, or None if the queue is empty
+        """
+        if self._selected is None:
+            self._selected = self._select()
+        if self._selected is None:
+            return None
+        lane, client = self._selected
+        return self._lanes[lane][client][0]
+
+    def pop(self):
+        """
+        Remove and return the request that should run next.
+
+        Returns:
+            A (cost, entry) tuple, or None if the queue is empty
+        """
+        head = self.peek()
+        if head is None:
+            return None
+        lane, client = self._selected
+        self._selected = None
+        self._deficits[(lane, client)] -= head[0]
+        self._discard_head(lane, client)
+        return head
+
+    def remove(self, entry):
+        """
+        Remove a specific waiting request, e.g. when its caller gave up.
+
+        Args:
+            entry: The object passed to push
+        """
+        for lane, clients in self._lanes.items():
+            for client, entries in clients.items():
+                for index, (cost, queued) in enumerate(entries):
+                    if queued is entry:
+                        if index == 0:
+                            self._discard_head(lane, client)
+                        else:
+                            del entries[index]
+                            self._size -= 1
+                        if self._selected == (lane, client):
+                            self._selected = None
+                        return
+
+    def _discard_head(self, lane, client):
+        entries = self._lanes[lane][client]
+        entries.popleft()
+        self._size -= 1
+        if not entries:
+            # An idle client doesn't keep its deficit
+            del self._lanes[lane][client]
+            del self._deficits[(lane, client)]
+
+    def _select(self):
+        for lane in LANES:
+            clients = self._lanes[lane]
+            if not clients:
+                continue
+            while True:
+                client, entries = next(iter(clients.items()))
+                if self._deficits[(lane, client)] >= entries[0][0]:
+                    return lane, client
+                # Not enough deficit yet: top it up and move to the back of the round
+                self._deficits[(lane, client)] += self.quantum
+                clients.move_to_end(client)
+        return None
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# stages.py - Individual stages of an SDXL generation, split out so they can be timed separately
+
+
+def encode_prompt(pipe, prompt, negative_prompt=None, guidance_scale=7.5, device="cuda"):
+    """
+    Run the SDXL text encoders for a prompt.
+
+    Args:
+        pipe: The loaded StableDiffusionXLPipeline
+        prompt: The text prompt
+        negative_prompt: Optional negative prompt
+        guidance_scale: Guidance scale; the negative embeddings are only computed
+            when classifier-free guidance is enabled
+        device: The device to run the text encoders on
+
+    Returns:
+        A dictionary of embedding keyword arguments accepted by the pipeline call
+    """
+    (
+        prompt_embeds,
+        negative_prompt_embeds,
+        pooled_prompt_embeds,
+        negative_pooled_prompt_embeds,
+    ) = pipe.encode_prompt(
+        prompt=prompt,
+        device=device,
+        num_images_per_prompt=1,
+        do_classifier_free_guidance=guidance_scale > 1.0,
+        negative_prompt=negative_prompt,
+    )
+    return {
+        "prompt_embeds": prompt_embeds,
+        "negative_prompt_embeds": negative_prompt_embeds,
+        "pooled_prompt_embeds": pooled_prompt_embeds,
+        "negative_pooled_prompt_embeds": negative_pooled_prompt_embeds,
+    }
+
+
+def decode_latents(pipe, latents, tiled=False):
+    """
+    Decode denoised latents into PIL images with the pipeline's VAE.
+
+    Mirrors the decode step at the end of StableDiffusionXLPipeline.__call__,
+    including upcasting the fp16 VAE when its config requires it.
+
+    Args:
+        pipe: The loaded StableDiffusionXLPipeline
+        latents: The latents returned by the pipeline with ``output_type="latent"``
+        tiled: Decode in overlapping tiles whatever the memory profile, so
+            decoding a very large image stays within the memory of one tile
+
+    Returns:
+        A list of PIL images
+    """
+    import torch
+
+    vae = pipe.vae
+    needs_upcasting = vae.dtype == torch.float16 and vae.config.force_upcast
+    if needs_upcasting:
+        pipe.upcast_vae()
+        latents = latents.to(next(iter(vae.post_quant_conv.parameters())).dtype)
+    elif latents.dtype != vae.dtype:
+        latents = latents.to(vae.dtype)
+
+    latents_mean = getattr(vae.config, "latents_mean", None)
+    latents_std = getattr(vae.config, "latents_std", None)
+    with torch.no_grad():
+        if latents_mean is not None and latents_std is not None:
+            latents_mean = torch.tensor(latents_mean).view(1, 4, 1, 1).to(latents.device, latents.dtype)
+            latents_std = torch.tensor(latents_std).view(1, 4, 1, 1).to(latents.device, latents.dtype)
+            latents = latents * latents_std / vae.config.scaling_factor + latents_mean
+        else:
+            latents = latents / vae.config.scaling_factor
+        decode = vae.tiled_decode if tiled else vae.decode
+        image = decode(latents, return_dict=False)[0]
+
+    if needs_upcasting:
+        vae.to(dtype=torch.float16)
+
+    return pipe.image_processor.postprocess(image, output_type="pil")
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# step_cache.py - Reuse deep UNet features across adjacent denoising steps (DeepCache)
+
+from contextlib import contextmanager
+
+# Largest cache interval accepted; beyond this the reused features are too
+# stale to be worth it
+MAX_CACHE_INTERVAL = 10
+
+# Down and up blocks at each end of the UNet that are recomputed on every
+# step; the blocks between them, and the mid block, are the deep ones reused
+SHALLOW_BLOCKS = 1
+
+
+class StepCache:
+    """
+    Cache the outputs of the deep UNet blocks and reuse them on the following steps.
+
+    Adjacent denoising steps produce very similar high-level features, so
+    only every ``interval``-th UNet call runs the whole network. The calls in
+    between recompute the shallow blocks (conv_in, the first down blocks and
+    the last up blocks, whose skip connections carry the fine detail) and
+    take the deep blocks' outputs from the last full call.
+
+    Every block is wrapped so calls can be counted, whether or not features
+    are reused. Use ``attach`` and ``detach``, or the step_cache context
+    manager.
+
+    Args:
+        unet: The pipeline's UNet2DConditionModel
+        interval: Run the whole UNet on one call in every ``interval``;
+            1 never reuses features
+        shallow_blocks: Down and up blocks at each end that are always recomputed
+    """
+
+    def __init__(self, unet, interval=1, shallow_blocks=SHALLOW_BLOCKS):
+        self.unet = unet
+        self.interval = interval
+        self.calls = 0
+        self.full_calls = 0
+        self.block_calls = 0
+        self.blocks_skipped = 0
+
+        blocks = len(unet.down_blocks)
+        shallow_blocks = min(shallow_blocks, blocks - 1)
+        self._deep = (
+            list(unet.down_blocks[shallow_blocks:])
+            + [unet.mid_block]
+            + list(unet.up_blocks[: blocks - shallow_blocks])
+        )
+        self._blocks = list(unet.down_blocks) + [unet.mid_block] + list(unet.up_blocks)
+        self._forwards = {}
+        self._cache = {}
+        self._cache_shape = None
+        self._reuse = False
+        self._hook = None
+
+    def attach(self):
+        """Start counting and caching the calls of the UNet's blocks."""
+        for block in self._blocks:
+            # Offload hooks may already have replaced forward on the instance
+            self._forwards[id(block)] = block.__dict__.get("forward")
+            block.forward = self._wrap(block, block in self._deep)
+        self._hook = self.unet.register_forward_pre_hook(self._before_unet, with_kwargs=True)
+
+    def detach(self):
+        """Restore the UNet's blocks and free the cached features."""
+        for block in self._blocks:
+            forward = self._forwards.pop(id(block), None)
+            if forward is not None:
+                block.forward = forward
+            else:
+                # Removing the instance attribute uncovers the class's forward
+                block.__dict__.pop("forward", None)
+        if self._hook is not None:
+            self._hook.remove()
+            self._hook = None
+        self._cache = {}
+
+    @property
+    def reusing(self):
+        """Whether the current UNet call reuses the cached deep features."""
+        return self._reuse
+
+    def _before_unet(self, module, args, kwargs):
+        sample = args[0] if args else kwargs["sample"]
+        shape = tuple(sample.shape)
+        # A full call is needed whenever the batch changes shape, e.g. when
+        # classifier-free guidance stops part way through
+        self._reuse = self.calls % self.interval != 0 and shape == self._cache_shape
+        if not self._reuse:
+            self._cache_shape = shape
+            self.full_calls += 1
+        self.calls += 1
+
+    def _wrap(self, block, deep):
+        forward = block.forward
+
+        def cached_forward(*args, **kwargs):
+            if deep and self._reuse:
+                self.blocks_skipped += 1
+                return self._cache[id(block)]
+            self.block_calls += 1
+            output = forward(*args, **kwargs)
+            if deep and self.interval > 1:
+                self._cache[id(block)] = output
+            return output
+
+        return cached_forward
+
+    def stats(self):
+        """
+        Get the UNet calls made while attached.
+
+        Returns:
+            A dictionary with the cache interval, the UNet calls, how many of
+            them ran the whole network, and the blocks run and skipped
+        """
+        return {
+            "cache_interval": self.interval,
+            "calls": self.calls,
+            "full_calls": self.full_calls,
+            "block_calls": self.block_calls,
+            "blocks_skipped": self.blocks_skipped,
+        }
+
+
+@contextmanager
+def step_cache(unet, interval=1, shallow_blocks=SHALLOW_BLOCKS):
+    """
+    Reuse deep UNet features across steps within the enclosed block.
+
+    Args:
+        unet: The pipeline's UNet2DConditionModel
+        interval: Run the whole UNet on one call in every ``interval``
+        shallow_blocks: Down and up blocks at each end that are always recomputed
+
+    Yields:
+        The attached StepCache, whose stats describe the calls made
+    """
+    cache = StepCache(unet, interval, shallow_blocks)
+    cache.attach()
+    try:
+        yield cache
+    finally:
+        cache.detach()
@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+# tensor_store.py - Content-addressed tensor store: checkpoints split into deduplicated per-tensor blobs
+
+import hashlib
+import json
+import os
+import shutil
+import time
+import weakref
+
+# Whether local checkpoints are loaded through the tensor store rather than
+# converted from the single-file checkpoint on every start
+TENSOR_STORE_ENABLED = os.environ.get("SD_TENSOR_STORE", "") == "1"
+
+# Components loaded while another resident pipeline holds an identical one
+# reuse its tensors, keyed by component digest and dtype. These modules are
+# never handed out, so nothing moves, offloads or quantises them. Weak
+# references, so a component is freed with the last pipeline built from it
+_resident_components = weakref.WeakValueDictionary()
+
+
+def tensor_buffer(tensor):
+    """
+    Get the raw bytes of a tensor as a numpy array, without copying contiguous CPU tensors.
+
+    Args:
+        tensor: The tensor
+
+    Returns:
+        A flat uint8 numpy array of the tensor's bytes
+    """
+    import torch
+
+    return tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy()
+
+
+class TensorStore:
+    """
+    A content-addressed store of model tensors on the models volume.
+
+    Each tensor is stored once as a blob named by the SHA-256 of its bytes,
+    so tensors shared by several checkpoints (the VAE and text encoders of
+    most SDXL fine-tunes are the base model's) take space only once. Each
+    model has a manifest listing its components, their configs and the blob
+    of every tensor; tokenizers and schedulers, which aren't tensors, are
+    saved next to it. Blobs are read by memory mapping, so loading only
+    touches the pages that are actually used, and the page cache is shared
+    by every model that references a blob.
+
+    Layout:
+        blobs/<first two hex digits>/<sha256>
+        models/<name>/manifest.json
+        models/<name>/<component>/   tokenizers and the scheduler
+
+    Args:
+        root: The directory of the store
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def blob_path(self, digest):
+        """
+        Get the path of a blob.
+
+        Args:
+            digest: The SHA-256 of the blob
+
+        Returns:
+            The path of the blob
+        """
+        return os.path.join(self.root, "blobs", digest[:2], digest)
+
+    def model_dir(self, name):
+        """
+        Get the directory of a model's manifest.
+
+        Args:
+            name: The name of the model
+
+        Returns:
+            The path of the directory
+        """
+        return os.path.join(self.root, "models", name)
+
+    def manifest(self, name):
+        """
+        Read a model's manifest.
+
+        Args:
+            name: The name of the model
+
+        Returns:
+            The manifest, or None if the model isn't in the store
+        """
+        path = os.path.join(self.model_dir(name), "manifest.json")
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def models(self):
+        """
+        Get the names of the models in the store.
+
+        Returns:
+            The sorted model names
+        """
+        models_dir = os.path.join(self.root, "models")
+        if not os.path.isdir(models_dir):
+            return []
+        return sorted(
+            name for name in os.listdir(models_dir)
+            if os.path.exists(os.path.join(models_dir, name, "manifest.json"))
+        )
+
+    def has_model(self, name, source):
+        """
+        Check whether a model is in the store, ingested from the given source.
+
+        Args:
+            name: The name of the model
+            source: The hash of the checkpoint the model should come from
+
+        Returns:
+            Whether the stored model is current
+        """
+        manifest = self.manifest(name)
+        return manifest is not None and manifest["source"] == source
+
+    def put_tensor(self, tensor):
+        """
+        Store a tensor's bytes, unless a blob with the same bytes exists.
+
+        Args:
+            tensor: The tensor
+
+        Returns:
+            The SHA-256 of the bytes and the bytes written, 0 for a duplicate
+        """
+        data = tensor_buffer(tensor)
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.blob_path(digest)
+        if os.path.exists(path):
+            return digest, 0
+
+        # Written under another name first, so an interrupted write is never read
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = f"{path}.{os.getpid()}.partial"
+        data.tofile(partial)
+        os.replace(partial, path)
+        return digest, data.nbytes
+
+    def ingest(self, name, pipe, source):
+        """
+        Split a loaded pipeline into blobs and write its manifest.
+
+        Args:
+            name: The name to store the model under
+            pipe: The loaded StableDiffusionXLPipeline, on the CPU
+            source: The hash of the checkpoint the pipeline was loaded from
+
+        Returns:
+            A dictionary with the seconds taken, and per component the bytes
+            of its tensors and the bytes newly written for them
+        """
+        import torch
+
+        start = time.perf_counter()
+        model_dir = self.model_dir(name)
+        partial_dir = f"{model_dir}.partial"
+        shutil.rmtree(partial_dir, ignore_errors=True)
+        os.makedirs(partial_dir)
+
+        components = {}
+        report = {}
+        for component_name, component in pipe.components.items():
+            if component is None:
+                continue
+            if not isinstance(component, torch.nn.Module):
+                component.save_pretrained(os.path.join(partial_dir, component_name))
+                components[component_name] = {"class": type(component).__name__, "library": library_of(component)}
+                continue
+
+            tensors = {}
+            total_bytes = written_bytes = 0
+            for key, tensor in component.state_dict().items():
+                digest, written = self.put_tensor(tensor)
+                tensors[key] = {"blob": digest, "dtype": str(tensor.dtype).removeprefix("torch."), "shape": list(tensor.shape)}
+                total_bytes += tensor.numel() * tensor.element_size()
+                written_bytes += written
+            config = component.config.to_dict() if hasattr(component.config, "to_dict") else dict(component.config)
+            components[component_name] = {
+                "class": type(component).__name__,
+                "library": library_of(component),
+                "config": config,
+                "digest": component_digest(type(component).__name__, tensors),
+                "bytes": total_bytes,
+                "tensors": tensors,
+            }
+            report[component_name] = {"bytes": total_bytes, "written_bytes": written_bytes}
+
+        manifest = {
+            "name": name,
+            "source": source,
+            "pipeline_config": {"force_zeros_for_empty_prompt": pipe.config.force_zeros_for_empty_prompt},
+            "components": components,
+        }
+        with open(os.path.join(partial_dir, "manifest.json"), "w") as f:
+            json.dump(manifest, f)
+        shutil.rmtree(model_dir, ignore_errors=True)
+        os.replace(partial_dir, model_dir)
+
+        seconds = time.perf_counter() - start
+        print(
+            f"Ingested {name} in {seconds:.1f}s: "
+            f"{sum(c['bytes'] for c in report.values()) / 1024 ** 3:.2f} GB of tensors, "
+            f"{sum(c['written_bytes'] for c in report.values()) / 1024 ** 3:.2f} GB new"
+        )
+        return {"seconds": seconds, "components": report}
+
+    def read_tensor(self, entry):
+        """
+        Read a tensor by memory mapping its blob.
+
+        The mapping is private: writes to the tensor never reach the blob.
+
+        Args:
+            entry: The tensor's manifest entry
+
+        Returns:
+            The tensor
+        """
+        import torch
+
+        dtype = getattr(torch, entry["dtype"])
+        numel = 1
+        for size in entry["shape"]:
+            numel *= size
+        if numel == 0:
+            return torch.empty(entry["shape"], dtype=dtype)
+        return torch.from_file(self.blob_path(entry["blob"]), shared=False, size=numel, dtype=dtype).reshape(entry["shape"])
+
+    def load_component(self, name, component_name, torch_dtype=None):
+        """
+        Load one component of a model, sharing the tensors of an identical resident one.
+
+        Modules are built with empty weights and take the memory-mapped
+        tensors as they are, so nothing is copied until the module is cast
+        or moved to the GPU. Every call returns a module of its own around
+        the shared tensors, so moving, offloading or quantising one pipeline's
+        component never reaches another pipeline.
+
+        Args:
+            name: The name of the model
+            component_name: The pipeline component, e.g. "vae"
+            torch_dtype: Optional dtype to cast the weights to
+
+        Returns:
+            The component, and whether its tensors were shared with a resident pipeline
+        """
+        import diffusers
+        import transformers
+        from accelerate import init_empty_weights
+
+        entry = self.manifest(name)["components"][component_name]
+        library = {"diffusers": diffusers, "transformers": transformers}[entry["library"]]
+        component_class = getattr(library, entry["class"])
+        if "tensors" not in entry:
+            return component_class.from_pretrained(os.path.join(self.model_dir(name), component_name)), False
+
+        def build(state_dict):
+            with init_empty_weights():
+                if entry["library"] == "transformers":
+                    module = component_class(component_class.config_class.from_dict(entry["config"]))
+                else:
+                    module = component_class.from_config(entry["config"])
+            module.load_state_dict(state_dict, strict=True, assign=True)
+            return module.eval()
+
+        key = f"{entry['digest']}-{torch_dtype}"
+        resident = _resident_components.get(key)
+        shared = resident is not None
+        if resident is None:
+            resident = build({tensor_key: self.read_tensor(tensor) for tensor_key, tensor in entry["tensors"].items()})
+            if torch_dtype is not None and resident.dtype != torch_dtype:
+                resident.to(torch_dtype)
+            _resident_components[key] = resident
+
+        module = build(resident.state_dict())
+        # Keeps the resident tensors shareable while this module lives. Set
+        # past nn.Module.__setattr__, so it isn't a submodule that .to() moves
+        object.__setattr__(module, "_store_resident", resident)
+        return module, shared
+
+    def load_pipeline(self, name, torch_dtype=None, **components):
+        """
+        Load a model's StableDiffusionXLPipeline, sharing components with resident pipelines.
+
+        Args:
+            name: The name of the model
+            torch_dtype: Optional dtype to cast the weights to
+            **components: Pipeline components to override; a component passed
+                as None isn't loaded at all
+
+        Returns:
+            The pipeline, on the CPU, and a load report: the seconds taken,
+            and per component whether it was shared and its bytes
+        """
+        from diffusers import StableDiffusionXLPipeline
+
+        start = time.perf_counter()
+        manifest = self.manifest(name)
+        report = {"model": name, "components": {}}
+        loaded = dict(components)
+        for component_name, entry in manifest["components"].items():
+            if component_name in loaded:
+                continue
+            loaded[component_name], shared = self.load_component(name, component_name, torch_dtype)
+            if "tensors" in entry:
+                report["components"][component_name] = {"shared": shared, "bytes": entry["bytes"]}
+
+        pipe = StableDiffusionXLPipeline(**loaded, **manifest["pipeline_config"])
+        report["seconds"] = time.perf_counter() - start
+        report["shared_bytes"] = sum(c["bytes"] for c in report["components"].values() if c["shared"])
+        shared_names = [component for component, c in report["components"].items() if c["shared"]]
+        print(
+            f"Loaded {name} from the tensor store in {report['seconds']:.2f}s"
+            f"{', sharing ' + ', '.join(shared_names) if shared_names else ''}"
+        )
+        return pipe, report
+
+    def stats(self):
+        """
+        Report how much the store deduplicates.
+
+        Returns:
+            A dictionary with the bytes the models' tensors would take as
+            separate checkpoints, the bytes the blobs take, their ratio, and
+            per model its bytes, the bytes only it references and the
+            components identical to another model's
+        """
+        manifests = [self.manifest(name) for name in self.models()]
+        blob_users = {}
+        blob_bytes = {}
+        component_users = {}
+        for manifest in manifests:
+            for entry in manifest["components"].values():
+                if "tensors" not in entry:
+                    continue
+                component_users.setdefault(entry["digest"], set()).add(manifest["name"])
+                for tensor in entry["tensors"].values():
+                    blob_users.setdefault(tensor["blob"], set()).add(manifest["name"])
+                    if tensor["blob"] not in blob_bytes:
+                        blob_bytes[tensor["blob"]] = os.path.getsize(self.blob_path(tensor["blob"]))
+
+        models = {}
+        for manifest in manifests:
+            name = manifest["name"]
+            entries = [entry for entry in manifest["components"].values() if "tensors" in entry]
+            blobs = {tensor["blob"] for entry in entries for tensor in entry["tensors"].values()}
+            models[name] = {
+                "bytes": sum(entry["bytes"] for entry in entries),
+                "unique_bytes": sum(blob_bytes[blob] for blob in blobs if blob_users[blob] == {name}),
+                "shared_components": sorted(
+                    component for component, entry in manifest["components"].items()
+                    if "tensors" in entry and len(component_users[entry["digest"]]) > 1
+                ),
+            }
+
+        logical_bytes = sum(model["bytes"] for model in models.values())
+        stored_bytes = sum(blob_bytes.values())
+        return {
+            "models": models,
+            "logical_bytes": logical_bytes,
+            "stored_bytes": stored_bytes,
+            "dedup_ratio": logical_bytes / stored_bytes if stored_bytes else 1.0,
+        }
+
+
+def library_of(component):
+    """
+    Get the library a pipeline component comes from.
+
+    Args:
+        component: The component
+
+    Returns:
+        "diffusers" or "transformers"
+    """
+    return type(component).__module__.split(".")[0]
+
+
+def component_digest(class_name, tensors):
+    """
+    Get the digest identifying a component by its class and tensors.
+
+    Args:
+        class_name: The class of the component
+        tensors: The component's tensor manifest entries, by state dict key
+
+    Returns:
+        The hex digest
+    """
+    digest = hashlib.sha256(class_name.encode())
+    for key in sorted(tensors):
+        tensor = tensors[key]
+        digest.update(f"{key}:{tensor['blob']}:{tensor['dtype']}:{tensor['shape']}\n".encode())
+    return digest.hexdigest()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# text_encoding.py - Prompt encoding on CPU workers, shipped to the GPU containers as fp16 buffers
+
+import os
+from collections import OrderedDict
+
+from utils.coalesce import normalize_prompt
+
+# Whether prompts are encoded by the CPU TextEncoder workers; the GPU
+# containers then load only the UNet and VAE
+REMOTE_TEXT_ENCODING = os.environ.get("SD_REMOTE_TEXT_ENCODING", "") == "1"
+
+# Number of encoded prompts each encoder worker keeps
+EMBEDDING_CACHE_SIZE = int(os.environ.get("SD_EMBEDDING_CACHE_SIZE", "512"))
+
+# Embedding keyword arguments of the SDXL pipeline call, as returned by stages.encode_prompt
+EMBEDDING_NAMES = (
+    "prompt_embeds",
+    "negative_prompt_embeds",
+    "pooled_prompt_embeds",
+    "negative_pooled_prompt_embeds",
+)
+
+
+def pack_embeddings(embeds):
+    """
+    Convert prompt embeddings into compact buffers that can be sent between containers.
+
+    Args:
+        embeds: The dictionary of embedding tensors returned by stages.encode_prompt
+
+    Returns:
+        A dictionary mapping each embedding name to its shape and raw fp16
+        bytes, or to None when the embedding wasn't computed
+    """
+    import torch
+
+    packed = {}
+    for name in EMBEDDING_NAMES:
+        tensor = embeds.get(name)
+        if tensor is None:
+            packed[name] = None
+            continue
+        tensor = tensor.detach().to("cpu", torch.float16).contiguous()
+        packed[name] = {"shape": list(tensor.shape), "data": tensor.numpy().tobytes()}
+    return packed
+
+
+def unpack_embeddings(packed, device="cuda"):
+    """
+    Turn buffers produced by pack_embeddings back into tensors.
+
+    Args:
+        packed: The dictionary returned by pack_embeddings
+        device: The device to place the tensors on
+
+    Returns:
+        A dictionary of fp16 embedding keyword arguments accepted by the pipeline call
+    """
+    import torch
+
+    embeds = {}
+    for name in EMBEDDING_NAMES:
+        buffer = packed.get(name)
+        if buffer is None:
+            embeds[name] = None
+            continue
+        tensor = torch.frombuffer(bytearray(buffer["data"]), dtype=torch.float16).reshape(buffer["shape"])
+        embeds[name] = tensor.to(device)
+    return embeds
+
+
+def embedding_key(prompt, negative_prompt, guidance_scale):
+    """
+    Build the cache key of an encoded prompt.
+
+    Only whether classifier-free guidance is on matters, not the guidance
+    scale itself: it decides whether negative embeddings are computed.
+
+    Args:
+        prompt: The text prompt
+        negative_prompt: Optional negative prompt
+        guidance_scale: Guidance scale of the request
+
+    Returns:
+        A hashable key
+    """
+    return normalize_prompt(prompt), normalize_prompt(negative_prompt), guidance_scale > 1.0
+
+
+class EmbeddingCache:
+    """
+    Least-recently-used cache of packed prompt embeddings.
+
+    Args:
+        max_entries: Number of encoded prompts to keep
+    """
+
+    def __init__(self, max_entries=EMBEDDING_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Look up an encoded prompt.
+
+        Args:
+            key: The key from embedding_key
+
+        Returns:
+            The packed embeddings, or None on a miss
+        """
+        packed = self._entries.get(key)
+        if packed is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return packed
+
+    def put(self, key, packed):
+        """
+        Store an encoded prompt, evicting the least recently used one if full.
+
+        Args:
+            key: The key from embedding_key
+            packed: The packed embeddings
+        """
+        self._entries[key] = packed
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+def fp16_weight_bytes(*modules):
+    """
+    Get the GPU memory the weights of some modules take in fp16.
+
+    Args:
+        *modules: torch modules, e.g. the two SDXL text encoders
+
+    Returns:
+        The size of their parameters at two bytes each
+    """
+    return sum(parameter.numel() * 2 for module in modules for parameter in module.parameters())
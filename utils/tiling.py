@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# tiling.py - Tiled (MultiDiffusion) denoising of canvases larger than the GPU can denoise at once
+
+import math
+import os
+from contextlib import contextmanager
+
+# Side of a tile in pixels; the UNet never sees a larger input, so its memory
+# use is bounded by the tile size whatever the size of the canvas
+TILE_SIZE = int(os.environ.get("SD_TILE_SIZE", "1024"))
+
+# Pixels adjacent tiles overlap by; predictions are blended across the
+# overlap so no seams show
+TILE_OVERLAP = int(os.environ.get("SD_TILE_OVERLAP", "256"))
+
+# Tiles run through the UNet in one batch
+TILE_BATCH_SIZE = int(os.environ.get("SD_TILE_BATCH_SIZE", "2"))
+
+
+def tile_starts(length, tile, overlap):
+    """
+    Get the start offsets of the tiles covering one side of a canvas.
+
+    Tiles are spread evenly, so they overlap by at least ``overlap`` and the
+    last one ends at the edge.
+
+    Args:
+        length: The length of the side
+        tile: The length of a tile
+        overlap: The minimum overlap of adjacent tiles
+
+    Returns:
+        The start offset of each tile
+    """
+    if length <= tile:
+        return [0]
+    count = math.ceil((length - overlap) / (tile - overlap))
+    return [round(i * (length - tile) / (count - 1)) for i in range(count)]
+
+
+def tile_windows(height, width, tile, overlap):
+    """
+    Get the windows of the tiles covering a canvas.
+
+    Args:
+        height: The height of the canvas
+        width: The width of the canvas
+        tile: The side of a tile
+        overlap: The minimum overlap of adjacent tiles
+
+    Returns:
+        A list of (top, left, height, width) windows, all the same size
+    """
+    tile_height, tile_width = min(tile, height), min(tile, width)
+    return [
+        (top, left, tile_height, tile_width)
+        for top in tile_starts(height, tile, overlap)
+        for left in tile_starts(width, tile, overlap)
+    ]
+
+
+def tile_coverage(width, height, tile=TILE_SIZE, overlap=TILE_OVERLAP):
+    """
+    Get how much more work tiled denoising does than denoising the canvas at once.
+
+    Args:
+        width: The width of the image in pixels
+        height: The height of the image in pixels
+        tile: The side of a tile in pixels
+        overlap: The overlap of adjacent tiles in pixels
+
+    Returns:
+        The pixels denoised across all tiles divided by the pixels of the image
+    """
+    windows = tile_windows(height, width, tile, overlap)
+    return sum(h * w for _, _, h, w in windows) / (width * height)
+
+
+def blend_weights(window, height, width, overlap, device, dtype):
+    """
+    Get the blending weights of a tile.
+
+    Weights ramp up linearly across the overlap on the sides that border
+    another tile, and are 1 elsewhere, so predictions fade into each other.
+
+    Args:
+        window: The (top, left, height, width) window of the tile
+        height: The height of the canvas
+        width: The width of the canvas
+        overlap: The overlap of adjacent tiles
+        device: The device to create the weights on
+        dtype: The dtype of the weights
+
+    Returns:
+        A (1, 1, height, width) tensor of weights for the tile
+    """
+    import torch
+
+    top, left, tile_height, tile_width = window
+
+    def ramp(start, size, length):
+        weights = torch.ones(size, device=device, dtype=torch.float32)
+        steps = min(overlap, size // 2)
+        if steps > 0:
+            fade = torch.arange(1, steps + 1, device=device, dtype=torch.float32) / (steps + 1)
+            if start > 0:
+                weights[:steps] = fade
+            if start + size < length:
+                weights[-steps:] = fade.flip(0)
+        return weights
+
+    rows = ramp(top, tile_height, height)
+    columns = ramp(left, tile_width, width)
+    return (rows[:, None] * columns[None, :]).to(dtype)[None, None]
+
+
+class TiledUNet:
+    """
+    Run the UNet tile by tile on latents larger than a tile, and blend the predictions.
+
+    This is MultiDiffusion with the blending moved onto the noise
+    predictions: a scheduler step is affine in the model output, so
+    averaging the predictions of overlapping tiles and taking one step over
+    the whole canvas is the same as stepping each tile and averaging the
+    results. Pipelines, schedulers and callbacks work unchanged, and tiles
+    are batched through the UNet for throughput.
+
+    SDXL's size conditioning is set per tile: each tile is conditioned as a
+    crop of the full image at its offset.
+
+    Args:
+        unet: The pipeline's UNet2DConditionModel
+        tile: The side of a tile in latents
+        overlap: The overlap of adjacent tiles in latents
+        batch_size: Tiles run through the UNet in one batch
+        vae_scale_factor: Pixels per latent, for the size conditioning
+    """
+
+    def __init__(self, unet, tile, overlap, batch_size=TILE_BATCH_SIZE, vae_scale_factor=8):
+        self.unet = unet
+        self.tile = tile
+        self.overlap = overlap
+        self.batch_size = max(1, batch_size)
+        self.vae_scale_factor = vae_scale_factor
+        self.tiles = 0
+        self.tiled_calls = 0
+        self._forward = None
+        self._weights = {}
+
+    def attach(self):
+        """Start tiling the UNet's calls."""
+        # Offload hooks may already have replaced forward on the instance
+        self._forward = self.unet.__dict__.get("forward")
+        self._unet_forward = self.unet.forward
+        self.unet.forward = self._tiled_forward
+
+    def detach(self):
+        """Restore the UNet's forward."""
+        if self._forward is not None:
+            self.unet.forward = self._forward
+        else:
+            self.unet.__dict__.pop("forward", None)
+        self._weights = {}
+
+    def _tiled_forward(self, sample, timestep, encoder_hidden_states, *args, added_cond_kwargs=None, return_dict=True, **kwargs):
+        import torch
+        from diffusers.models.unets.unet_2d_condition import UNet2DConditionOutput
+
+        height, width = sample.shape[-2:]
+        if height <= self.tile and width <= self.tile:
+            return self._unet_forward(
+                sample, timestep, encoder_hidden_states, *args,
+                added_cond_kwargs=added_cond_kwargs, return_dict=return_dict, **kwargs,
+            )
+
+        windows = tile_windows(height, width, self.tile, self.overlap)
+        batch = sample.shape[0]
+        prediction = None
+        total_weight = torch.zeros((1, 1, height, width), device=sample.device, dtype=torch.float32)
+        for start in range(0, len(windows), self.batch_size):
+            group = windows[start:start + self.batch_size]
+            count = len(group)
+            tiles = torch.cat([sample[..., top:top + h, left:left + w] for top, left, h, w in group])
+
+            # Conditioning is per image, so repeat it for every tile in the batch
+            tile_timestep = timestep
+            if torch.is_tensor(timestep) and timestep.ndim > 0 and timestep.shape[0] == batch:
+                tile_timestep = timestep.repeat(count)
+            tile_added = None
+            if added_cond_kwargs is not None:
+                tile_added = {name: value.repeat(count, *([1] * (value.ndim - 1))) for name, value in added_cond_kwargs.items()}
+                if "time_ids" in tile_added:
+                    tile_added["time_ids"] = self._tile_time_ids(added_cond_kwargs["time_ids"], group)
+
+            output = self._unet_forward(
+                tiles, tile_timestep, encoder_hidden_states.repeat(count, 1, 1), *args,
+                added_cond_kwargs=tile_added, return_dict=False, **kwargs,
+            )[0]
+
+            if prediction is None:
+                prediction = torch.zeros(
+                    (batch, output.shape[1], height, width), device=output.device, dtype=torch.float32
+                )
+            for i, window in enumerate(group):
+                top, left, h, w = window
+                key = window + (height, width)
+                if key not in self._weights:
+                    self._weights[key] = blend_weights(window, height, width, self.overlap, sample.device, torch.float32)
+                weights = self._weights[key]
+                prediction[..., top:top + h, left:left + w] += output[i * batch:(i + 1) * batch].float() * weights
+                total_weight[..., top:top + h, left:left + w] += weights
+
+        self.tiles += len(windows)
+        self.tiled_calls += 1
+        prediction = (prediction / total_weight).to(sample.dtype)
+        if not return_dict:
+            return (prediction,)
+        return UNet2DConditionOutput(sample=prediction)
+
+    def _tile_time_ids(self, time_ids, group):
+        import torch
+
+        # SDXL time ids are (original height, original width, crop top, crop
+        # left, target height, target width); each tile is a crop of the image
+        tile_ids = []
+        for top, left, h, w in group:
+            ids = time_ids.clone()
+            ids[:, 2] = top * self.vae_scale_factor
+            ids[:, 3] = left * self.vae_scale_factor
+            ids[:, 4] = h * self.vae_scale_factor
+            ids[:, 5] = w * self.vae_scale_factor
+            tile_ids.append(ids)
+        return torch.cat(tile_ids)
+
+    def stats(self):
+        """
+        Get the tiling done while attached.
+
+        Returns:
+            A dictionary with the tile size and overlap in latents, the UNet
+            calls that were tiled and the tiles denoised across them
+        """
+        return {
+            "tile": self.tile,
+            "overlap": self.overlap,
+            "batch_size": self.batch_size,
+            "tiled_calls": self.tiled_calls,
+            "tiles": self.tiles,
+        }
+
+
+@contextmanager
+def tiled_unet(unet, tile_size=TILE_SIZE, overlap=TILE_OVERLAP, batch_size=TILE_BATCH_SIZE, vae_scale_factor=8):
+    """
+    Denoise latents larger than a tile tile by tile within the enclosed block.
+
+    Args:
+        unet: The pipeline's UNet2DConditionModel
+        tile_size: The side of a tile in pixels
+        overlap: The overlap of adjacent tiles in pixels
+        batch_size: Tiles run through the UNet in one batch
+        vae_scale_factor: Pixels per latent
+
+    Yields:
+        The attached TiledUNet, whose stats describe the tiling done
+    """
+    tiler = TiledUNet(unet, tile_size // vae_scale_factor, overlap // vae_scale_factor, batch_size, vae_scale_factor)
+    tiler.attach()
+    try:
+        yield tiler
+    finally:
+        tiler.detach()
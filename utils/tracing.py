@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# tracing.py - OpenTelemetry tracing across the web and GPU containers
+
+import json
+import os
+import threading
+
+from opentelemetry import trace
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import (
+    ConsoleSpanExporter,
+    SimpleSpanProcessor,
+    SpanExporter,
+    SpanExportResult,
+)
+
+# Exporter used for finished spans: "console", "file" or "none"
+TRACE_EXPORTER = os.environ.get("SD_TRACE_EXPORTER", "none")
+
+# File that finished spans are appended to when the file exporter is selected
+TRACE_FILE = os.environ.get("SD_TRACE_FILE", "traces.jsonl")
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+
+class FileSpanExporter(SpanExporter):
+    """
+    Append finished spans to a file, one JSON object per line.
+
+    Args:
+        path: The path of the file to write to
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, spans):
+        with self._lock:
+            with open(self.path, "a") as f:
+                for span in spans:
+                    f.write(json.dumps(json.loads(span.to_json())) + "\n")
+        return SpanExportResult.SUCCESS
+
+    def shutdown(self):
+        pass
+
+
+def create_exporter(name):
+    """
+    Create a span exporter by name.
+
+    Args:
+        name: "console", "file" or "none"
+
+    Returns:
+        The span exporter, or None if tracing export is disabled
+    """
+    if name == "console":
+        return ConsoleSpanExporter()
+    if name == "file":
+        return FileSpanExporter(TRACE_FILE)
+    if name == "none":
+        return None
+    raise ValueError(f"Unknown trace exporter: {name}")
+
+
+def get_tracer(exporter=None):
+    """
+    Get the application tracer, configuring the tracer provider on first use.
+
+    Args:
+        exporter: Optional span exporter to use instead of the one selected
+            by the SD_TRACE_EXPORTER environment variable
+
+    Returns:
+        An OpenTelemetry tracer
+    """
+    global _tracer
+    with _tracer_lock:
+        if _tracer is None or exporter is not None:
+            provider = TracerProvider(resource=Resource.create({"service.name": "stable-diffusion-app"}))
+            exporter = exporter if exporter is not None else create_exporter(TRACE_EXPORTER)
+            if exporter is not None:
+                provider.add_span_processor(SimpleSpanProcessor(exporter))
+            _tracer = provider.get_tracer(__name__)
+        return _tracer
+
+
+def format_trace_id(span):
+    """
+    Get the trace id of a span as a 32-character hex string.
+
+    Args:
+        span: An OpenTelemetry span
+
+    Returns:
+        The hex-encoded trace id
+    """
+    return trace.format_trace_id(span.get_span_context().trace_id)
+
+
+def record_remote_spans(spans, attributes=None):
+    """
+    Re-emit spans recorded in another container as children of the current span.
+
+    The GPU container records its phases as plain dictionaries (see
+    ``StageTimer.add_span``) and returns them with the result; the web tier
+    replays them here so the whole request ends up in a single trace.
+
+    Args:
+        spans: A list of span dictionaries with name, start_ns, end_ns and attributes
+        attributes: Optional attributes added to every span, e.g. the cold-start label
+    """
+    tracer = get_tracer()
+    for recorded in spans:
+        span = tracer.start_span(
+            recorded["name"],
+            start_time=recorded["start_ns"],
+            attributes={**(attributes or {}), **recorded.get("attributes", {})},
+        )
+        span.end(end_time=recorded["end_ns"])
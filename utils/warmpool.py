@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+# warmpool.py - Demand forecasting and sizing of the pool of warm GPU containers
+
+import math
+import os
+
+# Whether the warm pool controller runs and the web tier records arrivals
+WARM_POOL_ENABLED = os.environ.get("SD_WARM_POOL", "") == "1"
+
+# Seconds between runs of the warm pool controller
+WARM_POOL_INTERVAL = int(os.environ.get("SD_WARM_POOL_INTERVAL", "60"))
+
+# Bounds on the number of containers kept warm
+WARM_POOL_MIN = int(os.environ.get("SD_WARM_POOL_MIN", "0"))
+WARM_POOL_MAX = int(os.environ.get("SD_WARM_POOL_MAX", "4"))
+
+# Seconds a GPU container is busy with one request, used to turn a rate into a
+# number of containers
+WARM_POOL_SERVICE_SECONDS = float(os.environ.get("SD_WARM_POOL_SERVICE_SECONDS", "10"))
+
+# Seconds from starting a GPU container to a loaded pipeline; demand is
+# predicted this far ahead, since a container started now is only useful then
+COLD_START_SECONDS = float(os.environ.get("SD_COLD_START_SECONDS", "90"))
+
+# Idle seconds before Modal stops a GPU container that isn't kept warm
+SCALEDOWN_WINDOW = int(os.environ.get("SD_SCALEDOWN_WINDOW", "300"))
+
+# Containers are only kept warm while at least one request is expected within
+# this many seconds; below that, the cold start is cheaper than the idle GPU
+WARM_POOL_HORIZON = float(os.environ.get("SD_WARM_POOL_HORIZON", "900"))
+
+# Extra containers kept warm, in standard deviations of the expected number of
+# busy containers (square-root staffing)
+WARM_POOL_HEADROOM = float(os.environ.get("SD_WARM_POOL_HEADROOM", "1.0"))
+
+# Price of an idle A10G, used by the simulator to cost warm containers
+GPU_COST_PER_HOUR = float(os.environ.get("SD_GPU_COST_PER_HOUR", "1.10"))
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+class DemandForecaster:
+    """
+    Forecast the request arrival rate from an EWMA and a time-of-day profile.
+
+    The short-term rate is an exponentially weighted moving average over
+    ``half_life`` seconds. The time-of-day profile keeps a slower moving
+    average of the rate seen in each slot of the day, so a daily peak is
+    anticipated before the short-term rate catches up with it.
+
+    Args:
+        half_life: Half-life of the short-term rate, in seconds
+        slot_seconds: Length of a time-of-day slot, in seconds
+        seasonal_weight: Weight of the time-of-day profile in predictions
+        seasonal_alpha: Weight each day's observations get in the profile
+    """
+
+    def __init__(self, half_life=600.0, slot_seconds=900, seasonal_weight=0.5, seasonal_alpha=0.3):
+        self.half_life = half_life
+        self.slot_seconds = slot_seconds
+        self.seasonal_weight = seasonal_weight
+        self.seasonal_alpha = seasonal_alpha
+        self.rate = 0.0
+        self.updated = None
+        self.profile = [None] * (SECONDS_PER_DAY // slot_seconds)
+
+    def _slot(self, timestamp):
+        return int(timestamp % SECONDS_PER_DAY) // self.slot_seconds
+
+    def observe(self, arrivals, now):
+        """
+        Fold the arrivals since the last update into the forecast.
+
+        Args:
+            arrivals: Arrival timestamps (seconds since the epoch) after the last update
+            now: The current time; the interval since the last update ends here
+        """
+        if self.updated is None:
+            self.updated = min(arrivals, default=now)
+        elapsed = now - self.updated
+        if elapsed <= 0:
+            return
+        observed = len(arrivals) / elapsed
+
+        decay = 0.5 ** (elapsed / self.half_life)
+        self.rate = decay * self.rate + (1 - decay) * observed
+
+        # Each day contributes about seasonal_alpha to a slot, however many
+        # updates fall into it
+        slot = self._slot(self.updated + elapsed / 2)
+        weight = min(1.0, self.seasonal_alpha * elapsed / self.slot_seconds)
+        previous = self.profile[slot]
+        self.profile[slot] = observed if previous is None else (1 - weight) * previous + weight * observed
+        self.updated = now
+
+    def predict(self, at):
+        """
+        Predict the arrival rate at a point in time.
+
+        Args:
+            at: The time to predict for, in seconds since the epoch
+
+        Returns:
+            The expected arrivals per second
+        """
+        seasonal = self.profile[self._slot(at)]
+        if seasonal is None:
+            return self.rate
+        return (1 - self.seasonal_weight) * self.rate + self.seasonal_weight * seasonal
+
+    def to_dict(self):
+        """
+        Get the state of the forecaster, for storing between controller runs.
+
+        Returns:
+            A JSON-serialisable dictionary
+        """
+        return {
+            "half_life": self.half_life,
+            "slot_seconds": self.slot_seconds,
+            "seasonal_weight": self.seasonal_weight,
+            "seasonal_alpha": self.seasonal_alpha,
+            "rate": self.rate,
+            "updated": self.updated,
+            "profile": self.profile,
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        """
+        Restore a forecaster saved with to_dict.
+
+        Args:
+            state: The saved state
+
+        Returns:
+            The DemandForecaster
+        """
+        forecaster = cls(state["half_life"], state["slot_seconds"], state["seasonal_weight"], state["seasonal_alpha"])
+        forecaster.rate = state["rate"]
+        forecaster.updated = state["updated"]
+        forecaster.profile = state["profile"]
+        return forecaster
+
+
+def target_warm_containers(
+    rate,
+    service_seconds=WARM_POOL_SERVICE_SECONDS,
+    headroom=WARM_POOL_HEADROOM,
+    horizon=WARM_POOL_HORIZON,
+    minimum=WARM_POOL_MIN,
+    maximum=WARM_POOL_MAX,
+):
+    """
+    Work out how many GPU containers to keep warm for a predicted arrival rate.
+
+    Args:
+        rate: Predicted arrivals per second
+        service_seconds: Seconds a container is busy with one request
+        headroom: Extra containers in standard deviations of the busy count
+        horizon: Seconds within which a request must be expected to keep any container warm
+        minimum: Fewest containers to keep warm
+        maximum: Most containers to keep warm
+
+    Returns:
+        The number of containers to keep warm
+    """
+    if rate * horizon < 1:
+        return minimum
+    busy = rate * service_seconds
+    target = math.ceil(busy + headroom * math.sqrt(busy))
+    return max(minimum, min(maximum, target))
+
+
+class ForecastPolicy:
+    """
+    Warm pool policy driven by a DemandForecaster, as run by the controller.
+
+    Args:
+        forecaster: The DemandForecaster to feed and query
+        lookahead: Seconds ahead to predict demand for
+        **target_options: Options passed on to target_warm_containers
+    """
+
+    def __init__(self, forecaster=None, lookahead=COLD_START_SECONDS, **target_options):
+        self.forecaster = forecaster if forecaster is not None else DemandForecaster()
+        self.lookahead = lookahead
+        self.target_options = target_options
+        self.name = "forecast"
+
+    def __call__(self, arrivals, now):
+        """
+        Update the forecast and get the number of containers to keep warm.
+
+        Args:
+            arrivals: Arrival timestamps since the previous call
+            now: The current time
+
+        Returns:
+            The number of containers to keep warm
+        """
+        self.forecaster.observe(arrivals, now)
+        # Cover both current demand and demand by the time a new container is up
+        rate = max(self.forecaster.predict(now), self.forecaster.predict(now + self.lookahead))
+        return target_warm_containers(rate, **self.target_options)
+
+
+class FixedPolicy:
+    """
+    Warm pool policy that always keeps the same number of containers warm.
+
+    Args:
+        size: The number of containers to keep warm
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.name = f"fixed_{size}"
+
+    def __call__(self, arrivals, now):
+        return self.size
+
+
+def simulate_warm_pool(
+    arrivals,
+    policy,
+    service_seconds=WARM_POOL_SERVICE_SECONDS,
+    cold_start_seconds=COLD_START_SECONDS,
+    scaledown_window=SCALEDOWN_WINDOW,
+    interval=WARM_POOL_INTERVAL,
+    gpu_cost_per_hour=GPU_COST_PER_HOUR,
+):
+    """
+    Replay an arrival trace against a warm pool policy.
+
+    Containers serve one request at a time. A request goes to the container
+    that can take it first: an idle one, a busy one about to finish, one that
+    is still starting, or a new one. It counts as a cold start when it has to
+    wait for a container to load the pipeline. Idle containers stop after
+    ``scaledown_window`` seconds unless the policy wants them kept warm, and
+    the policy is consulted every ``interval`` seconds with the arrivals since
+    its previous call.
+
+    Args:
+        arrivals: Arrival timestamps in seconds
+        policy: A callable taking (arrivals, now) and returning a warm pool size
+        service_seconds: Seconds a container is busy with one request
+        cold_start_seconds: Seconds from starting a container to a loaded pipeline
+        scaledown_window: Idle seconds before a container not kept warm stops
+        interval: Seconds between policy decisions
+        gpu_cost_per_hour: Price of a GPU container per hour
+
+    Returns:
+        A dictionary with the cold-start rate, the time requests waited for
+        containers to start or become free, and the GPU hours and cost spent
+        not serving requests
+    """
+    arrivals = sorted(arrivals)
+    if not arrivals:
+        raise ValueError("The trace has no arrivals")
+
+    # Each container: start time, time its pipeline is loaded, time it's free
+    # again, time it stopped (None while running) and seconds spent serving
+    containers = []
+    target = 0
+    cold_starts = 0
+    cold_wait = 0.0
+    queue_wait = 0.0
+    pending = []
+    next_tick = arrivals[0]
+
+    def running(now):
+        return [c for c in containers if c["stopped"] is None or c["stopped"] > now]
+
+    def scale_down(now):
+        # Stop idle containers beyond the warm pool, most idle first
+        alive = sorted(running(now), key=lambda c: c["free"])
+        excess = len(alive) - target
+        for container in alive:
+            if excess <= 0:
+                break
+            idle_until = max(container["free"], container["ready"]) + scaledown_window
+            if idle_until <= now:
+                container["stopped"] = idle_until
+                excess -= 1
+
+    def start(now):
+        container = {"started": now, "ready": now + cold_start_seconds, "free": now + cold_start_seconds, "stopped": None, "busy": 0.0}
+        containers.append(container)
+        return container
+
+    end = arrivals[-1] + scaledown_window
+    for arrival in arrivals + [end]:
+        # Run the controller for every tick up to this arrival
+        while next_tick <= arrival:
+            target = policy(pending, next_tick)
+            pending = []
+            scale_down(next_tick)
+            for _ in range(target - len(running(next_tick))):
+                start(next_tick)
+            next_tick += interval
+        if arrival == end:
+            break
+        pending.append(arrival)
+        scale_down(arrival)
+
+        container = min(running(arrival), key=lambda c: c["free"], default=None)
+        if container is None or container["free"] > arrival + cold_start_seconds:
+            container = start(arrival)
+        begin = max(container["free"], arrival)
+        if container["ready"] > arrival:
+            cold_starts += 1
+            cold_wait += begin - arrival
+        else:
+            queue_wait += begin - arrival
+        container["free"] = begin + service_seconds
+        container["busy"] += service_seconds
+
+    total_seconds = 0.0
+    busy_seconds = 0.0
+    for container in containers:
+        stopped = container["stopped"] if container["stopped"] is not None else max(end, container["free"])
+        total_seconds += stopped - container["started"]
+        busy_seconds += container["busy"]
+    unused_hours = (total_seconds - busy_seconds) / 3600
+
+    return {
+        "policy": getattr(policy, "name", "policy"),
+        "requests": len(arrivals),
+        "cold_starts": cold_starts,
+        "cold_start_rate": cold_starts / len(arrivals),
+        "mean_cold_wait": cold_wait / cold_starts if cold_starts else 0.0,
+        "mean_queue_wait": queue_wait / len(arrivals),
+        "containers_started": len(containers),
+        "unused_gpu_hours": unused_hours,
+        "unused_gpu_cost": unused_hours * gpu_cost_per_hour,
+    }